@@ -0,0 +1,155 @@
+"""
+Cross entropy of a linear prediction head that never materializes the (n_tokens, vocab_size) logits,
+the largest activation of a model with a GPT-2 sized vocabulary.
+"""
+from typing import Optional, Tuple
+
+import torch
+
+
+def _get_logits(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    vocab_start: int,
+    vocab_end: int,
+) -> torch.Tensor:
+    logits = hidden @ weight[vocab_start:vocab_end].t()
+    if bias is not None:
+        logits = logits + bias[vocab_start:vocab_end]
+    return logits.float()
+
+
+class LinearCrossEntropy(torch.autograd.Function):
+    """
+    Tokens are processed token_chunk_size at a time, each chunk against vocab_chunk_size rows of weight
+    at a time, with an online logsumexp and argmax. Only the logsumexp of every token is saved,
+    the backward pass recomputes the logits of every tile from it.
+    Matmuls run in the autocast dtype if autocast is enabled, the softmax statistics are kept in float32.
+    """
+
+    @staticmethod
+    @torch.cuda.amp.custom_fwd
+    def forward(
+        ctx,
+        hidden: torch.Tensor,
+        weight: torch.Tensor,
+        bias: Optional[torch.Tensor],
+        targets: torch.Tensor,
+        token_chunk_size: int,
+        vocab_chunk_size: int,
+    ):
+        n_tokens, vocab_size = hidden.shape[0], weight.shape[0]
+        losses = torch.empty(n_tokens, dtype=torch.float32, device=hidden.device)
+        logsumexp = torch.empty_like(losses)
+        correct = torch.empty(n_tokens, dtype=torch.bool, device=hidden.device)
+        for start in range(0, n_tokens, token_chunk_size):
+            chunk_hidden = hidden[start : start + token_chunk_size]
+            chunk_targets = targets[start : start + token_chunk_size]
+            running_max = torch.full_like(losses[: len(chunk_targets)], float("-inf"))
+            running_sum = torch.zeros_like(running_max)
+            target_logits = torch.zeros_like(running_max)
+            best_logits = torch.full_like(running_max, float("-inf"))
+            best_ids = torch.zeros_like(chunk_targets)
+            for vocab_start in range(0, vocab_size, vocab_chunk_size):
+                vocab_end = min(vocab_start + vocab_chunk_size, vocab_size)
+                logits = _get_logits(chunk_hidden, weight, bias, vocab_start, vocab_end)
+
+                chunk_max, chunk_argmax = logits.max(dim=-1)
+                new_max = torch.maximum(running_max, chunk_max)
+                running_sum = running_sum * torch.exp(
+                    running_max - new_max
+                ) + torch.exp(logits - new_max.unsqueeze(-1)).sum(dim=-1)
+                running_max = new_max
+
+                # strictly greater, so that ties go to the lowest id, as in argmax
+                is_better = chunk_max > best_logits
+                best_logits = torch.where(is_better, chunk_max, best_logits)
+                best_ids = torch.where(is_better, chunk_argmax + vocab_start, best_ids)
+
+                in_chunk = (chunk_targets >= vocab_start) & (chunk_targets < vocab_end)
+                local_targets = (chunk_targets - vocab_start).clamp(
+                    0, vocab_end - vocab_start - 1
+                )
+                target_logits += torch.where(
+                    in_chunk,
+                    logits.gather(1, local_targets.unsqueeze(-1)).squeeze(-1),
+                    0,
+                )
+            chunk_logsumexp = running_max + torch.log(running_sum)
+            losses[start : start + token_chunk_size] = chunk_logsumexp - target_logits
+            logsumexp[start : start + token_chunk_size] = chunk_logsumexp
+            correct[start : start + token_chunk_size] = best_ids == chunk_targets
+
+        ctx.save_for_backward(hidden, weight, bias, targets, logsumexp)
+        ctx.token_chunk_size = token_chunk_size
+        ctx.vocab_chunk_size = vocab_chunk_size
+        ctx.mark_non_differentiable(correct)
+        return losses, correct
+
+    @staticmethod
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_losses: torch.Tensor, grad_correct: Optional[torch.Tensor]):
+        hidden, weight, bias, targets, logsumexp = ctx.saved_tensors
+        n_tokens, vocab_size = hidden.shape[0], weight.shape[0]
+        grad_hidden = torch.empty(
+            hidden.shape, dtype=torch.float32, device=hidden.device
+        )
+        grad_weight = torch.zeros(
+            weight.shape, dtype=torch.float32, device=weight.device
+        )
+        grad_bias = None
+        if bias is not None:
+            grad_bias = torch.zeros(bias.shape, dtype=torch.float32, device=bias.device)
+
+        for start in range(0, n_tokens, ctx.token_chunk_size):
+            end = start + ctx.token_chunk_size
+            chunk_hidden = hidden[start:end]
+            chunk_targets = targets[start:end]
+            token_ids = torch.arange(len(chunk_targets), device=hidden.device)
+            chunk_grad_hidden = grad_hidden[start:end]
+            chunk_grad_hidden.zero_()
+            for vocab_start in range(0, vocab_size, ctx.vocab_chunk_size):
+                vocab_end = min(vocab_start + ctx.vocab_chunk_size, vocab_size)
+                logits = _get_logits(chunk_hidden, weight, bias, vocab_start, vocab_end)
+                # d loss / d logits = softmax - one_hot(target)
+                grad_logits = torch.exp(logits - logsumexp[start:end].unsqueeze(-1))
+                in_chunk = (chunk_targets >= vocab_start) & (chunk_targets < vocab_end)
+                grad_logits[
+                    token_ids[in_chunk], chunk_targets[in_chunk] - vocab_start
+                ] -= 1
+                grad_logits *= grad_losses[start:end].unsqueeze(-1)
+
+                chunk_grad_hidden += grad_logits @ weight[vocab_start:vocab_end]
+                grad_weight[vocab_start:vocab_end] += grad_logits.t() @ chunk_hidden
+                if grad_bias is not None:
+                    grad_bias[vocab_start:vocab_end] += grad_logits.sum(dim=0)
+
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+        return (
+            grad_hidden.to(hidden.dtype),
+            grad_weight.to(weight.dtype),
+            grad_bias,
+            None,
+            None,
+            None,
+        )
+
+
+def linear_cross_entropy(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    targets: torch.Tensor,
+    token_chunk_size: int = 4096,
+    vocab_chunk_size: int = 8192,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    hidden: (n_tokens, dmodel), weight: (vocab_size, dmodel), bias: (vocab_size,) or None, targets: (n_tokens,)
+    Returns the cross entropy of every token, as F.cross_entropy(hidden @ weight.T + bias, targets, reduction="none"),
+    and whether the argmax of its logits is the target.
+    """
+    return LinearCrossEntropy.apply(
+        hidden, weight, bias, targets.long(), token_chunk_size, vocab_chunk_size
+    )
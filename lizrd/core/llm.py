@@ -1,6 +1,6 @@
 from collections import OrderedDict
 from typing import Literal, Callable, Optional
-from functools import partial
+from functools import lru_cache, partial
 
 import torch
 import torch.nn as nn
@@ -9,6 +9,7 @@ import torch.nn.functional as F
 from lizrd.core import misc
 from lizrd.core.misc import default, Aggregate
 from lizrd.core.initialization import get_init_weight
+from lizrd.core.fused_cross_entropy import linear_cross_entropy
 from lizrd.core.misc import Linear, LoggingLayer
 
 
@@ -190,6 +191,99 @@ def LowRank(dinput, doutput, dlowrank):
     )
 
 
+AttentionBackend = Literal["flash", "sdpa", "math", "tiled"]
+
+
+@lru_cache(maxsize=64)
+def get_future_mask(
+    query_length: int, key_length: int, offset: int, device: torch.device
+) -> torch.Tensor:
+    """(query_length, key_length), True where key j is in the future of query i, i.e. j > i + offset"""
+    query_index = torch.arange(query_length, device=device).reshape(-1, 1)
+    key_index = torch.arange(key_length, device=device).reshape(1, -1)
+    return key_index > query_index + offset
+
+
+def attend_query_block(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    query_start: int,
+    dhead: int,
+    causal: bool,
+    block_size: int,
+) -> torch.Tensor:
+    """
+    Attention of a block of queries starting at query_start, over block_size keys at a time.
+    Softmax is computed online: the output is accumulated with the running maximum and sum of the scores.
+    """
+    n_keys = key.shape[-2]
+    if causal:
+        n_keys = min(n_keys, query_start + query.shape[-2])
+    stats_shape = query.shape[:-1] + (1,)
+    running_max = torch.full(
+        stats_shape, float("-inf"), dtype=torch.float32, device=query.device
+    )
+    running_sum = torch.zeros(stats_shape, dtype=torch.float32, device=query.device)
+    output = torch.zeros(query.shape, dtype=torch.float32, device=query.device)
+    for key_start in range(0, n_keys, block_size):
+        key_end = min(key_start + block_size, n_keys)
+        scores = query @ key[..., key_start:key_end, :].transpose(-1, -2)
+        scores = scores.float() * (1 / dhead**0.5)
+        if causal and key_end - 1 > query_start:
+            scores = scores.masked_fill(
+                get_future_mask(
+                    query.shape[-2],
+                    key_end - key_start,
+                    query_start - key_start,
+                    query.device,
+                ),
+                float("-inf"),
+            )
+        new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+        correction = torch.exp(running_max - new_max)
+        probabilities = torch.exp(scores - new_max)
+        running_sum = running_sum * correction + probabilities.sum(dim=-1, keepdim=True)
+        output = output * correction + (
+            probabilities.to(value.dtype) @ value[..., key_start:key_end, :]
+        )
+        running_max = new_max
+    return (output / running_sum).to(query.dtype)
+
+
+def tiled_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    dhead: int,
+    causal: bool,
+    block_size: int = 512,
+) -> torch.Tensor:
+    """
+    Memory-efficient attention for devices without fused kernels: at most (batch, heads, block_size, block_size)
+    scores exist at once. When gradients are needed, every query block is recomputed in the backward pass.
+    """
+    outputs = []
+    for query_start in range(0, query.shape[-2], block_size):
+        block_args = (
+            query[..., query_start : query_start + block_size, :],
+            key,
+            value,
+            query_start,
+            dhead,
+            causal,
+            block_size,
+        )
+        if torch.is_grad_enabled():
+            output = torch.utils.checkpoint.checkpoint(
+                attend_query_block, *block_args, use_reentrant=False
+            )
+        else:
+            output = attend_query_block(*block_args)
+        outputs.append(output)
+    return torch.cat(outputs, dim=-2)
+
+
 def attention_mechanism(
     query: torch.Tensor,
     key: torch.Tensor,
@@ -197,8 +291,20 @@ def attention_mechanism(
     dhead: int,
     causal: bool,
     flash: bool,
+    backend: Optional[AttentionBackend] = None,
+    block_size: int = 512,
 ):
-    if flash:
+    """
+    query, key, value: (batch, heads, seq_len, dhead)
+    backend, by default "flash" if flash else "math":
+        "flash" - SDPA restricted to the flash kernel on CUDA, any SDPA kernel on other devices
+        "sdpa" - SDPA with the kernel chosen by PyTorch
+        "math" - scores materialized with einsum
+        "tiled" - see tiled_attention, block_size queries and keys at a time
+    """
+    if backend is None:
+        backend = "flash" if flash else "math"
+    if backend == "flash" and query.device.type == "cuda":
         with torch.backends.cuda.sdp_kernel(
             enable_flash=True, enable_math=False, enable_mem_efficient=False
         ):
@@ -209,7 +315,17 @@ def attention_mechanism(
                 attn_mask=None,
                 is_causal=causal,
             )
-    else:
+    elif backend in ["flash", "sdpa"]:
+        output = F.scaled_dot_product_attention(
+            query=query,
+            key=key,
+            value=value,
+            attn_mask=None,
+            is_causal=causal,
+        )
+    elif backend == "tiled":
+        output = tiled_attention(query, key, value, dhead, causal, block_size)
+    elif backend == "math":
         # implementation without flash assumes other dim order
         query = query.transpose(1, 2)
         key = key.transpose(1, 2)
@@ -219,19 +335,30 @@ def attention_mechanism(
         a = a * (1 / dhead**0.5)
         if causal:
             a.masked_fill_(
-                torch.tril(torch.ones_like(a)) == 0, float("-inf")
+                get_future_mask(a.shape[-2], a.shape[-1], 0, a.device), float("-inf")
             )  # mask out future tokens
         a = torch.softmax(a, dim=-1)
         output = torch.einsum("... h l L, ... L h d -> ... l h d", a, value)
         output = output.transpose(1, 2)
+    else:
+        raise ValueError(f"Unknown attention backend {backend}")
 
     return output
 
 
 class AttentionMechanism(nn.Module):
-    def __init__(self, use_flash_attention: bool, *args, **kwargs) -> None:
+    def __init__(
+        self,
+        use_flash_attention: bool,
+        *args,
+        backend: Optional[AttentionBackend] = None,
+        block_size: int = 512,
+        **kwargs,
+    ) -> None:
         super().__init__(*args, **kwargs)
         self.use_flash_attention = use_flash_attention
+        self.backend = backend
+        self.block_size = block_size
 
     def forward(
         self,
@@ -250,9 +377,61 @@ class AttentionMechanism(nn.Module):
             dhead=dhead,
             causal=causal,
             flash=self.use_flash_attention,
+            backend=self.backend,
+            block_size=self.block_size,
         )
 
 
+class KVCache:
+    """
+    Keys and values of the tokens already processed, shared by all the attention layers of a model
+    during incremental decoding (see lizrd/support/decoding.py), so that a forward pass only processes new tokens.
+    Sequences are left-padded, padding_mask (batch, max_length) is False at the padding,
+    which is not attended to and doesn't count towards the positions of the tokens.
+    """
+
+    def __init__(self, padding_mask: torch.Tensor):
+        self.padding_mask = padding_mask
+        self.all_positions = (torch.cumsum(padding_mask, dim=-1) - 1).clamp(min=0)
+        self.length = 0
+        self.layers = {}
+
+    def get_positions(self, seq_len: int) -> torch.Tensor:
+        """(batch, seq_len) positions of the next seq_len tokens"""
+        return self.all_positions[:, self.length : self.length + seq_len]
+
+    def attend(self, layer: nn.Module, query, key, value):
+        """query, key, value: (batch, heads, seq_len, dhead) of the new tokens"""
+        assert layer.causal, "Incremental decoding needs causal attention"
+        batch, heads, seq_len, dhead = key.shape
+        if layer not in self.layers:
+            shape = (batch, heads, self.padding_mask.shape[-1], dhead)
+            self.layers[layer] = (
+                torch.zeros(shape, dtype=key.dtype, device=key.device),
+                torch.zeros(shape, dtype=value.dtype, device=value.device),
+            )
+        keys, values = self.layers[layer]
+        end = self.length + seq_len
+        keys[:, :, self.length : end] = key
+        values[:, :, self.length : end] = value
+
+        query_index = torch.arange(self.length, end, device=key.device).reshape(-1, 1)
+        key_index = torch.arange(0, end, device=key.device).reshape(1, -1)
+        mask = (key_index <= query_index) & self.padding_mask[:, None, :end]
+        # padding attends to itself only, so that it doesn't turn into NaNs
+        mask = mask | (key_index == query_index)
+        return F.scaled_dot_product_attention(
+            query=query,
+            key=keys[:, :, :end],
+            value=values[:, :, :end],
+            attn_mask=mask.unsqueeze(1),
+        )
+
+    def advance(self, seq_len: int):
+        """Called after every forward pass, when all the layers have stored the new tokens."""
+        self.length += seq_len
+
+
 class Attention(LoggingLayer):
     def __init__(
         self,
@@ -263,6 +442,8 @@ class Attention(LoggingLayer):
         init_scale: float,
         dhead=None,
         flash=False,
+        attention_backend: Optional[AttentionBackend] = None,
+        attention_block_size: int = 512,
     ):
         super(Attention, self).__init__()
         if dhead is None:
@@ -288,7 +469,12 @@ class Attention(LoggingLayer):
             init_type=init_type,
             init_scale=init_scale,
         )
-        self.attention_mechanism = AttentionMechanism(use_flash_attention=flash)
+        self.attention_mechanism = AttentionMechanism(
+            use_flash_attention=flash,
+            backend=attention_backend,
+            block_size=attention_block_size,
+        )
+        self.kv_cache: Optional[KVCache] = None
 
     def forward(self, x):
         projected = self.input_projection(x)
@@ -299,9 +485,12 @@ class Attention(LoggingLayer):
         ).transpose(1, 2)
         q, k, v = torch.chunk(projected, chunks=3, dim=-1)
 
-        attention_output = self.attention_mechanism(
-            query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
-        )
+        if self.kv_cache is not None:
+            attention_output = self.kv_cache.attend(self, q, k, v)
+        else:
+            attention_output = self.attention_mechanism(
+                query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
+            )
 
         output = self.output_projection(attention_output.transpose(1, 2).flatten(-2))
 
@@ -315,15 +504,58 @@ class RoPE(nn.Module):
         self.dhead = dhead
         self.length = length
         angle_exponents = torch.arange(0, dhead, 2) / dhead
-        angles = torch.pow(1 / 10000, angle_exponents).reshape(1, -1)
-        angle_per_token = angles * torch.arange(0, length).reshape(-1, 1)
-        self.register_buffer("sin", torch.sin(angle_per_token).repeat(1, 2))
-        self.register_buffer("cos", torch.cos(angle_per_token).repeat(1, 2))
+        angles = torch.pow(1 / 10000, angle_exponents)
+        self.register_buffer("angles", angles, persistent=False)
+        # (device, dtype) -> cos and sin tables, see get_tables
+        self.tables = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the tables were computed on the fly have full sin and cos buffers
+        state_dict.pop(prefix + "sin", None)
+        state_dict.pop(prefix + "cos", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_tables(self, n_positions: int, device: torch.device, dtype: torch.dtype):
+        """
+        cos and sin of the angles of positions 0, 1, ..., at least n_positions and length of them,
+        (n, dhead / 2) each. Computed in float32 and cast once per device and dtype.
+        """
+        key = (device, dtype)
+        if key not in self.tables or len(self.tables[key][0]) < n_positions:
+            positions = torch.arange(
+                0, max(n_positions, self.length), device=device, dtype=torch.float32
+            )
+            angle_per_token = positions.reshape(-1, 1) * self.angles.to(
+                device, torch.float32
+            ).reshape(1, -1)
+            self.tables[key] = (
+                torch.cos(angle_per_token).to(dtype),
+                torch.sin(angle_per_token).to(dtype),
+            )
+        return self.tables[key]
 
-    def forward(self, x):
-        [y1, y2] = torch.chunk(x, chunks=2, dim=-1)
-        x_rotated = torch.cat([-y2, y1], dim=-1)
-        return x * self.cos + x_rotated * self.sin
+    def forward(self, x, positions: Optional[torch.Tensor] = None):
+        """
+        positions: (batch, seq_len), by default 0, 1, ..., seq_len - 1.
+        Sequences can be shorter (e.g. during sequence length warmup) or longer than length,
+        and positions can be larger than length.
+        """
+        dtype = x.dtype if x.is_floating_point() else torch.get_default_dtype()
+        if positions is None:
+            seq_len = x.shape[-2]
+            cos, sin = self.get_tables(seq_len, x.device, dtype)
+            cos, sin = cos[:seq_len], sin[:seq_len]
+        else:
+            n_positions = int(positions.max()) + 1
+            cos, sin = self.get_tables(n_positions, x.device, dtype)
+            cos, sin = cos[positions].unsqueeze(1), sin[positions].unsqueeze(1)
+        # both halves are written into the output, x is never concatenated with its rotated copy
+        half = self.dhead // 2
+        y1, y2 = x[..., :half], x[..., half:]
+        out = torch.empty_like(x, dtype=dtype)
+        out[..., :half] = y1 * cos - y2 * sin
+        out[..., half:] = y2 * cos + y1 * sin
+        return out
 
 
 class AttentionRoPE(LoggingLayer):
@@ -337,6 +569,8 @@ class AttentionRoPE(LoggingLayer):
         init_scale: float,
         dhead=None,
         flash=False,
+        attention_backend: Optional[AttentionBackend] = None,
+        attention_block_size: int = 512,
     ):
         super(AttentionRoPE, self).__init__()
         if dhead is None:
@@ -363,7 +597,12 @@ class AttentionRoPE(LoggingLayer):
             init_scale=init_scale,
         )
         self.rope = RoPE(dhead, length=length)
-        self.attention_mechanism = AttentionMechanism(use_flash_attention=flash)
+        self.attention_mechanism = AttentionMechanism(
+            use_flash_attention=flash,
+            backend=attention_backend,
+            block_size=attention_block_size,
+        )
+        self.kv_cache: Optional[KVCache] = None
 
     def forward(self, x):
         projected = self.input_projection(x)
@@ -373,12 +612,18 @@ class AttentionRoPE(LoggingLayer):
             batch, seq_len, self.heads, 3 * self.dhead
         ).transpose(1, 2)
         q, k, v = torch.chunk(projected, chunks=3, dim=-1)
-        q = self.rope(q)
-        k = self.rope(k)
 
-        attention_output = self.attention_mechanism(
-            query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
-        )
+        if self.kv_cache is not None:
+            positions = self.kv_cache.get_positions(seq_len)
+            q = self.rope(q, positions)
+            k = self.rope(k, positions)
+            attention_output = self.kv_cache.attend(self, q, k, v)
+        else:
+            q = self.rope(q)
+            k = self.rope(k)
+            attention_output = self.attention_mechanism(
+                query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
+            )
 
         output = self.output_projection(attention_output.transpose(1, 2).flatten(-2))
 
@@ -395,6 +640,8 @@ class Attention(LoggingLayer):
         init_scale: float,
         dhead=None,
         flash=False,
+        attention_backend: Optional[AttentionBackend] = None,
+        attention_block_size: int = 512,
     ):
         super(Attention, self).__init__()
         if dhead is None:
@@ -420,7 +667,12 @@ class Attention(LoggingLayer):
             init_type=init_type,
             init_scale=init_scale,
         )
-        self.attention_mechanism = AttentionMechanism(use_flash_attention=flash)
+        self.attention_mechanism = AttentionMechanism(
+            use_flash_attention=flash,
+            backend=attention_backend,
+            block_size=attention_block_size,
+        )
+        self.kv_cache: Optional[KVCache] = None
 
     def forward(self, x):
         projected = self.input_projection(x)
@@ -431,9 +683,12 @@ class Attention(LoggingLayer):
         ).transpose(1, 2)
         q, k, v = torch.chunk(projected, chunks=3, dim=-1)
 
-        attention_output = self.attention_mechanism(
-            query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
-        )
+        if self.kv_cache is not None:
+            attention_output = self.kv_cache.attend(self, q, k, v)
+        else:
+            attention_output = self.attention_mechanism(
+                query=q, key=k, value=v, dhead=self.dhead, causal=self.causal
+            )
 
         output = self.output_projection(attention_output.transpose(1, 2).flatten(-2))
 
@@ -623,10 +878,14 @@ class PositionalEmbedding(nn.Module):
             dtype=default_weight.dtype,
         )
         # TODO(jaszczur): add initialization as positional encoding
+        self.kv_cache: Optional[KVCache] = None
 
     def forward(self, x):
-        positions = torch.arange(0, x.shape[-1], device=x.device)
-        positions = positions * torch.ones_like(x)
+        if self.kv_cache is not None:
+            positions = self.kv_cache.get_positions(x.shape[-1])
+        else:
+            positions = torch.arange(0, x.shape[-1], device=x.device)
+            positions = positions * torch.ones_like(x)
         embeddings = self.layer(positions)
         return embeddings
 
@@ -637,10 +896,100 @@ class EmbeddingLayer(Aggregate):
 
 
 class PredictionHead(Linear):
-    def __init__(self, embedding_dim, output_size, init_type, init_scale):
+    def __init__(
+        self,
+        embedding_dim,
+        output_size,
+        init_type,
+        init_scale,
+        fused_loss_chunk_sizes: Optional[tuple[int, int]] = None,
+    ):
+        """
+        fused_loss_chunk_sizes: tokens and vocabulary entries in a tile of the logits, if set the loss is computed
+        by linear_cross_entropy, which never materializes the full logits
+        """
         super(PredictionHead, self).__init__(
             embedding_dim, output_size, init_type=init_type, init_scale=init_scale
         )
+        self.fused_loss_chunk_sizes = fused_loss_chunk_sizes
+
+    def forward(self, x, targets=None):
+        """
+        With targets (n_tokens,) and x (n_tokens, embedding_dim), returns the cross entropy of every token
+        and whether the argmax of its logits is the target, otherwise the logits.
+        """
+        if targets is None:
+            return super().forward(x)
+        if self.fused_loss_chunk_sizes is not None:
+            return linear_cross_entropy(
+                x, self.weight, self.bias, targets, *self.fused_loss_chunk_sizes
+            )
+        logits = super().forward(x)
+        losses = F.cross_entropy(logits.float(), targets.long(), reduction="none")
+        return losses, logits.argmax(dim=-1) == targets
+
+
+class AdaptiveSoftmaxHead(nn.Module):
+    def __init__(
+        self,
+        embedding_dim,
+        output_size,
+        cutoffs: list[int],
+        init_type,
+        init_scale,
+        div_value: float = 4.0,
+        token_order: Optional[torch.Tensor] = None,
+    ):
+        """
+        Adaptive softmax (Grave et al., 2017): the first cluster holds the cutoffs[0] most frequent tokens
+        and one entry per tail cluster, the projections of the following clusters are div_value times smaller.
+        The loss of a token only needs the clusters it is in, see loss.
+        token_order: token ids from the most to the least frequent, by default ids are assumed to be ordered
+        """
+        super(AdaptiveSoftmaxHead, self).__init__()
+        self.adaptive_softmax = nn.AdaptiveLogSoftmaxWithLoss(
+            embedding_dim, output_size, cutoffs, div_value=div_value
+        )
+        for module in self.adaptive_softmax.modules():
+            if isinstance(module, nn.Linear):
+                module.weight.data = get_init_weight(
+                    shape=module.weight.shape,
+                    fan_in=module.in_features,
+                    init_type=init_type,
+                    scale=init_scale,
+                    dtype=module.weight.dtype,
+                )
+        if token_order is None:
+            self.token_ranks = None
+        else:
+            token_ranks = torch.empty_like(token_order)
+            token_ranks[token_order] = torch.arange(len(token_order))
+            self.register_buffer("token_ranks", token_ranks)
+
+    def forward(self, x, targets=None):
+        """
+        Log-probabilities of the whole vocabulary (in token id order), for evaluation and decoding.
+        With targets, the same as loss.
+        """
+        if targets is not None:
+            return self.loss(x, targets)
+        log_probs = self.adaptive_softmax.log_prob(x.flatten(0, -2))
+        if self.token_ranks is not None:
+            log_probs = log_probs[:, self.token_ranks]
+        return log_probs.reshape(*x.shape[:-1], -1)
+
+    def loss(self, x, targets):
+        """
+        x: (n_tokens, embedding_dim), targets: (n_tokens,)
+        Returns the cross entropy of every token and whether the most likely token is the target.
+        The latter needs the whole distribution only for tokens whose most likely first cluster entry is a tail cluster.
+        """
+        if self.token_ranks is not None:
+            targets = self.token_ranks[targets]
+        losses = -self.adaptive_softmax(x, targets).output
+        with torch.no_grad():
+            correct = self.adaptive_softmax.predict(x) == targets
+        return losses, correct
 
 
 class LLM(nn.Module):
@@ -650,8 +999,18 @@ class LLM(nn.Module):
         self.encoder = encoder_tower
         self.head = head
 
-    def forward(self, *args, **kwargs):
+    def forward(self, *args, targets=None, mask=None, **kwargs):
+        """
+        With targets and a mask of the tokens to compute the loss on (both of the shape of the input),
+        only tokens in the mask go through the head, which returns their losses and whether they were
+        predicted correctly instead of the logits.
+        Computing the loss here, rather than calling the head from outside, keeps it within DDP and FSDP.
+        """
         x = self.embedding_layer(*args, **kwargs)
         x = self.encoder(x)
-        x = self.head(x)
-        return x
+        if targets is None:
+            return self.head(x)
+        mask = mask.to(x.device).reshape(-1) == 1
+        hidden = x.flatten(0, -2)[mask]
+        targets = targets.to(x.device).reshape(-1)[mask].long()
+        return self.head(hidden, targets)
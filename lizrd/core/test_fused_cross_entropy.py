@@ -0,0 +1,47 @@
+import torch
+import torch.nn.functional as F
+
+from lizrd.core.fused_cross_entropy import linear_cross_entropy
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestLinearCrossEntropy(GeneralTestCase):
+    def test_same_as_cross_entropy(self):
+        n_tokens, dmodel, vocab_size = 37, 16, 101
+        for use_bias in [False, True]:
+            hidden = torch.normal(0.0, 1.0, (n_tokens, dmodel), requires_grad=True)
+            weight = torch.normal(0.0, 1.0, (vocab_size, dmodel), requires_grad=True)
+            bias = torch.normal(0.0, 1.0, (vocab_size,), requires_grad=True)
+            bias = bias if use_bias else None
+            targets = torch.randint(0, vocab_size, (n_tokens,))
+            loss_weights = torch.rand(n_tokens)
+            inputs = [hidden, weight] + ([bias] if use_bias else [])
+
+            logits = F.linear(hidden, weight, bias)
+            expected_losses = F.cross_entropy(logits, targets, reduction="none")
+            expected_grads = torch.autograd.grad(
+                (expected_losses * loss_weights).sum(), inputs
+            )
+            # chunks that don't divide the number of tokens and the vocabulary
+            losses, correct = linear_cross_entropy(
+                hidden, weight, bias, targets, token_chunk_size=10, vocab_chunk_size=32
+            )
+            grads = torch.autograd.grad((losses * loss_weights).sum(), inputs)
+
+            self.assertTensorAlmostEqual(losses, expected_losses)
+            self.assertTensorEqual(correct, logits.argmax(dim=-1) == targets)
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTensorAlmostEqual(grad, expected_grad)
+
+    def test_correct(self):
+        hidden = torch.eye(4)
+        weight = torch.eye(4)
+        losses, correct = linear_cross_entropy(
+            hidden,
+            weight,
+            None,
+            torch.tensor([0, 1, 3, 2]),
+            token_chunk_size=3,
+            vocab_chunk_size=3,
+        )
+        self.assertTensorEqual(correct, torch.tensor([True, True, False, False]))
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 from lizrd.core import llm
 import unittest
@@ -66,8 +67,58 @@ class RoPETest(GeneralTestCase):
         input = torch.normal(0.0, 1.0, (batch, seql, dhead))
         out = layer(input)
         self.assertShape(out, (batch, seql, dhead))
-        self.assertShape(layer.sin, (seql, dhead))
-        self.assertTensorEqual(layer.sin[:, : dhead // 2], layer.sin[:, dhead // 2 :])
+        cos, sin = layer.get_tables(seql, input.device, input.dtype)
+        self.assertShape(cos, (seql, dhead // 2))
+        self.assertShape(sin, (seql, dhead // 2))
+        self.assertEqual(list(layer.state_dict()), [])
+
+    def test_shorter_sequence(self):
+        batch, seql, dhead = 2, 16, 8
+        layer = llm.RoPE(dhead=dhead, length=seql)
+        input = torch.normal(0.0, 1.0, (batch, seql, dhead))
+        out = layer(input[:, : seql // 2])
+        self.assertTensorAlmostEqual(out, layer(input)[:, : seql // 2])
+
+    def test_longer_sequence(self):
+        batch, seql, dhead = 2, 16, 8
+        short_layer = llm.RoPE(dhead=dhead, length=seql // 2)
+        layer = llm.RoPE(dhead=dhead, length=seql)
+        input = torch.normal(0.0, 1.0, (batch, seql, dhead))
+        self.assertTensorAlmostEqual(short_layer(input), layer(input))
+
+    def test_positions(self):
+        batch, n_heads, seql, dhead = 2, 3, 8, 8
+        layer = llm.RoPE(dhead=dhead, length=seql)
+        input = torch.normal(0.0, 1.0, (batch, n_heads, seql, dhead))
+        positions = torch.tensor([[2, 3, 7], [0, 1, 5]])
+        out = layer(input[:, :, positions[0]], positions)
+        expected_out = layer(input)
+        self.assertTensorAlmostEqual(out[0], expected_out[0, :, positions[0]])
+        self.assertTensorAlmostEqual(
+            out[1, :, :2], layer(input[:, :, positions[0]])[1, :, :2]
+        )
+
+    def test_positions_beyond_length(self):
+        batch, n_heads, seql, dhead = 2, 3, 8, 8
+        layer = llm.RoPE(dhead=dhead, length=seql // 2)
+        input = torch.normal(0.0, 1.0, (batch, n_heads, seql, dhead))
+        positions = torch.tensor([[5, 6, 7], [0, 1, 2]])
+        out = layer(input[:, :, positions[0]], positions)
+        self.assertTensorAlmostEqual(out[0], layer(input)[0, :, positions[0]])
+
+    def test_load_old_state_dict(self):
+        seql, dhead = 8, 8
+        layer = llm.RoPE(dhead=dhead, length=seql)
+        old_state = {"sin": torch.zeros(seql, dhead), "cos": torch.zeros(seql, dhead)}
+        layer.load_state_dict(old_state)
+
+    def test_dtype(self):
+        batch, seql, dhead = 2, 16, 8
+        layer = llm.RoPE(dhead=dhead, length=seql)
+        input = torch.normal(0.0, 1.0, (batch, seql, dhead))
+        out = layer(input.bfloat16())
+        self.assertEqual(out.dtype, torch.bfloat16)
+        self.assertTrue(torch.allclose(out.float(), layer(input), atol=5e-2))
 
     def test_rotation(self):
         batch, n_heads, seql, d_head = 2, 2, 3, 4
@@ -211,6 +262,33 @@ class AttentionTest(GeneralTestCase):
 
         self.assertTensorAlmostEqual(out, out2)
 
+    def test_backend_equivalence(self):
+        batch, seql, dhead, heads = 2, 13, 16, 3
+        for causal in [False, True]:
+            q, k, v = [
+                torch.normal(0.0, 1.0, (batch, heads, seql, dhead), requires_grad=True)
+                for _ in range(3)
+            ]
+            expected_out = llm.attention_mechanism(
+                q, k, v, dhead, causal=causal, flash=False, backend="math"
+            )
+            expected_grads = torch.autograd.grad(expected_out.sum(), [q, k, v])
+            for backend, block_size in [("sdpa", 512), ("tiled", 4), ("tiled", 13)]:
+                out = llm.attention_mechanism(
+                    q,
+                    k,
+                    v,
+                    dhead,
+                    causal=causal,
+                    flash=False,
+                    backend=backend,
+                    block_size=block_size,
+                )
+                self.assertTensorAlmostEqual(out, expected_out)
+                grads = torch.autograd.grad(out.sum(), [q, k, v])
+                for grad, expected_grad in zip(grads, expected_grads):
+                    self.assertTensorAlmostEqual(grad, expected_grad)
+
     def test_nonstandard_dhead(self):
         batch, seql, dm, heads, dhead = 3, 7, 32, 4, 100
         layer = llm.Attention(
@@ -265,6 +343,51 @@ class EncoderTowerTest(GeneralTestCase):
         self.assertShape(out, (batch, seql, dm))
 
 
+class AdaptiveSoftmaxHeadTest(GeneralTestCase):
+    def test_loss(self):
+        n_tokens, dm, vocab_size = 50, 16, 40
+        token_order = torch.randperm(vocab_size)
+        for order in [None, token_order]:
+            head = llm.AdaptiveSoftmaxHead(
+                dm,
+                vocab_size,
+                cutoffs=[8, 20],
+                init_type="kaiming_uniform",
+                init_scale=1.0,
+                token_order=order,
+            )
+            input = torch.normal(0.0, 1.0, (2, n_tokens // 2, dm))
+            targets = torch.randint(0, vocab_size, (n_tokens,))
+            log_probs = head(input)
+            self.assertShape(log_probs, (2, n_tokens // 2, vocab_size))
+            self.assertTensorAlmostEqual(
+                torch.logsumexp(log_probs, dim=-1), torch.zeros(2, n_tokens // 2)
+            )
+
+            losses, correct = head.loss(input.flatten(0, 1), targets)
+            log_probs = log_probs.flatten(0, 1)
+            self.assertTensorAlmostEqual(
+                losses, F.cross_entropy(log_probs, targets, reduction="none")
+            )
+            self.assertTensorEqual(correct, log_probs.argmax(dim=-1) == targets)
+
+    def test_token_order(self):
+        dm, vocab_size = 16, 10
+        token_order = torch.tensor([3, 1, 4, 0, 5, 9, 2, 6, 8, 7])
+        head = llm.AdaptiveSoftmaxHead(
+            dm,
+            vocab_size,
+            cutoffs=[2],
+            init_type="kaiming_uniform",
+            init_scale=1.0,
+            token_order=token_order,
+        )
+        # the most frequent tokens are in the first cluster
+        self.assertEqual(head.token_ranks[3].item(), 0)
+        self.assertEqual(head.token_ranks[1].item(), 1)
+        self.assertEqual(head.token_ranks[7].item(), 9)
+
+
 class LLMTest(GeneralTestCase):
     def test_bert(self):
         batch, seql, dm, heads, dff = 3, 7, 32, 4, 64
@@ -1,5 +1,10 @@
 import copy
+import socket
+from functools import partial
+
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 from lizrd.core import llm
 from lizrd.core.misc import (
@@ -12,6 +17,7 @@ from lizrd.support.misc import get_ith_chunk
 
 from research.datasets import get_processed_dataset
 from lizrd.support.test_utils import GeneralTestCase, heavy_test
+from lizrd.text.data import LLMBatch
 from lizrd.train.train_utils import get_model
 from research.conditional.utils.model_utils import (
     calculate_llm_loss_and_gradient,
@@ -138,6 +144,173 @@ class TestChungus(GeneralTestCase):
             ).all(), f"parameter {name} failed, log of difference is: {torch.log10((grad - grad_checkpointed).abs().max())}"
 
 
+class TestHeadLoss(GeneralTestCase):
+    def get_model_and_batch(self, head_fn=None):
+        torch.manual_seed(0)
+        batch, seql, dm, heads, dff = 3, 16, 32, 4, 64
+        vocab_size = 1000
+        layers = {
+            "feedforward": lambda: llm.FeedForward(
+                dm, dff, init_type="kaiming_uniform", init_scale=1.0
+            ),
+            "attention": lambda: llm.Attention(
+                dm, heads, causal=True, init_type="kaiming_uniform", init_scale=1.0
+            ),
+        }
+        model = get_model(
+            max_length=seql,
+            vocab_size=vocab_size,
+            block_modules=layers,
+            dm=dm,
+            n_blocks=2,
+            device=torch.device("cpu"),
+            init_type="kaiming_uniform",
+            init_scale=1.0,
+            ddp_enabled=False,
+            fsdp_enabled=False,
+            fsdp_param_precision=None,
+            fsdp_mixed_precision_ignore_classes=None,
+            fsdp_offload_params=None,
+            fsdp_min_num_params=None,
+            fsdp_modules_to_wrap=None,
+            activation_checkpointing_modules=None,
+            is_logging_process=True,
+            head_fn=head_fn,
+        )
+        input_ids = torch.randint(0, vocab_size, (batch, seql))
+        batch = LLMBatch.from_tensors(
+            input_ids=input_ids,
+            target_ids=input_ids.roll(-1, dims=1),
+            should_calculate_loss=(torch.rand(batch, seql) < 0.5).long(),
+        )
+        return model, batch
+
+    def test_adaptive_softmax_head(self):
+        model, batch = self.get_model_and_batch(
+            head_fn=lambda: llm.AdaptiveSoftmaxHead(
+                32,
+                1000,
+                cutoffs=[100, 400],
+                init_type="kaiming_uniform",
+                init_scale=1.0,
+            )
+        )
+        loss, aux_info = calculate_llm_loss_and_gradient(
+            batch=batch,
+            model=model,
+            mixed_precision=False,
+            mixed_precision_dtype=torch.float16,
+            num_checkpoint_accumulation_steps=1,
+            masked_head_loss=True,
+        )
+        grads = [param.grad.clone() for param in model.parameters()]
+
+        model.zero_grad()
+        mask = batch.should_calculate_loss.flatten() == 1
+        log_probs = model(batch.input_ids).flatten(0, 1)[mask]
+        target_ids = batch.target_ids.flatten()[mask].long()
+        expected_loss = torch.nn.functional.cross_entropy(log_probs, target_ids)
+        expected_loss.backward()
+
+        self.assertAlmostEqual(loss, expected_loss.item(), places=5)
+        self.assertEqual(
+            aux_info["correct_tokens"],
+            (log_probs.argmax(dim=-1) == target_ids).sum(),
+        )
+        for grad, param in zip(grads, model.parameters()):
+            self.assertTrue(torch.allclose(grad, param.grad, atol=1e-5))
+
+    def test_outputs_and_grads(self):
+        model, batch = self.get_model_and_batch()
+
+        def run(loss_function, **kwargs):
+            model.zero_grad()
+            loss, aux_info = loss_function(
+                batch=batch,
+                model=model,
+                mixed_precision=False,
+                mixed_precision_dtype=torch.float16,
+                num_checkpoint_accumulation_steps=1,
+                **kwargs,
+            )
+            return loss, aux_info, [param.grad.clone() for param in model.parameters()]
+
+        for loss_function in [
+            calculate_llm_loss_and_gradient,
+            partial(chungized_llm_loss_and_gradient, n_chungs=3),
+        ]:
+            model.head.fused_loss_chunk_sizes = None
+            expected_loss, expected_aux_info, expected_grads = run(loss_function)
+            model.head.fused_loss_chunk_sizes = (7, 300)
+            loss, aux_info, grads = run(loss_function, masked_head_loss=True)
+            self.assertAlmostEqual(loss, expected_loss, places=5)
+            self.assertEqual(
+                aux_info["correct_tokens"], expected_aux_info["correct_tokens"]
+            )
+            self.assertEqual(
+                aux_info["total_masked_tokens"],
+                expected_aux_info["total_masked_tokens"],
+            )
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_ddp_wrapped_model(self):
+        head_fns = {
+            "linear": (None, False),
+            "fused": (
+                lambda: llm.PredictionHead(
+                    32,
+                    1000,
+                    init_type="kaiming_uniform",
+                    init_scale=1.0,
+                    fused_loss_chunk_sizes=(7, 300),
+                ),
+                True,
+            ),
+            "adaptive_softmax": (
+                lambda: llm.AdaptiveSoftmaxHead(
+                    32,
+                    1000,
+                    cutoffs=[100, 400],
+                    init_type="kaiming_uniform",
+                    init_scale=1.0,
+                ),
+                True,
+            ),
+        }
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            port = s.getsockname()[1]
+        dist.init_process_group(
+            "gloo", init_method=f"tcp://localhost:{port}", rank=0, world_size=1
+        )
+        try:
+            for name, (head_fn, masked_head_loss) in head_fns.items():
+                model, batch = self.get_model_and_batch(head_fn=head_fn)
+                ddp_model = DDP(copy.deepcopy(model))
+                losses = []
+                for m in [model, ddp_model]:
+                    m.zero_grad()
+                    loss, _ = calculate_llm_loss_and_gradient(
+                        batch=batch,
+                        model=m,
+                        mixed_precision=False,
+                        mixed_precision_dtype=torch.float16,
+                        num_checkpoint_accumulation_steps=1,
+                        masked_head_loss=masked_head_loss,
+                    )
+                    losses.append(loss)
+                self.assertAlmostEqual(losses[0], losses[1], places=5, msg=name)
+                for param, ddp_param in zip(
+                    model.parameters(), ddp_model.module.parameters()
+                ):
+                    self.assertTrue(
+                        torch.allclose(param.grad, ddp_param.grad, atol=1e-5), name
+                    )
+        finally:
+            dist.destroy_process_group()
+
+
 class TestChungizedCalculateLoss(GeneralTestCase):
     @heavy_test
     def test_outputs_and_grads(self):
@@ -0,0 +1,52 @@
+from argparse import ArgumentParser
+
+import numpy as np
+
+from lizrd.text.datasets import C4Dataset, get_token_index_path, save_token_index
+from lizrd.text.tokenizers import GPTTokenizer
+
+
+def count_tokens(batch, tokenizer):
+    return {"n_tokens": [len(ids) for ids in tokenizer.texts_to_ids(batch["text"])]}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="C4 saved with save_to_disk, e.g. by lizrd/scripts/download_c4",
+    )
+    parser.add_argument("--use_dummy_dataset", action="store_true")
+    parser.add_argument("--num_proc", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    args = parser.parse_args()
+
+    dataset = C4Dataset(
+        split=args.split,
+        use_dummy_dataset=args.use_dummy_dataset,
+        dataset_path=args.dataset_path,
+    ).dataset
+    index_path = get_token_index_path(dataset, "gpt2")
+    assert index_path is not None, "The dataset has no files to put the index next to"
+
+    token_counts = dataset.map(
+        count_tokens,
+        fn_kwargs={"tokenizer": GPTTokenizer()},
+        batched=True,
+        batch_size=args.batch_size,
+        num_proc=args.num_proc,
+        remove_columns=dataset.column_names,
+    )
+    token_lengths = np.array(token_counts["n_tokens"], dtype=np.uint32)
+    save_token_index(index_path, token_lengths)
+    print(
+        f"Indexed {len(token_lengths)} documents, {int(token_lengths.sum())} tokens, "
+        f"saved to {index_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Tokenizes a dataset with a pool of processes and saves it as token shards (see lizrd/text/token_shards.py).
+
+The dataset is cut into tasks of --documents_per_shard consecutive documents (one task per input file
+for local files), and every task is tokenized by a worker into its own shard. Shards are written under
+a temporary name and renamed when complete, so after a crash the script can be run again with the same
+arguments and only the missing shards are tokenized.
+"""
+from argparse import ArgumentParser, Namespace
+import json
+import multiprocessing
+import os
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import tqdm
+
+from lizrd.text.datasets import (
+    AbstractDataset,
+    C4Dataset,
+    WikiBookDataset,
+    get_token_index_path,
+    list_local_corpus_files,
+    read_local_corpus_file,
+    save_token_index,
+)
+from lizrd.text.token_shards import (
+    OFFSETS_SUFFIX,
+    get_shard_name,
+    get_token_dtype,
+    read_shard_entry,
+    write_manifest,
+    write_shard,
+)
+from lizrd.text.tokenizers import AbstractTokenizer, BertTokenizer, GPTTokenizer
+
+TOKENIZERS = {"gpt": GPTTokenizer, "bert": BertTokenizer}
+# arguments that determine the shard contents, a resumed run has to use the same ones
+PLAN_FILENAME = "pretokenize_plan.json"
+PLAN_ARGS = [
+    "dataset_type",
+    "split",
+    "dataset_path",
+    "use_dummy_dataset",
+    "tokenizer",
+    "documents_per_shard",
+    "text_field",
+]
+
+# state of a worker process, set by init_worker
+_worker = {}
+
+
+def make_dataset(args: Namespace) -> Optional[AbstractDataset]:
+    if args.dataset_type == "c4":
+        return C4Dataset(
+            split=args.split,
+            use_dummy_dataset=args.use_dummy_dataset,
+            dataset_path=args.dataset_path,
+        )
+    if args.dataset_type == "wikibook":
+        return WikiBookDataset(
+            use_dummy_dataset=args.use_dummy_dataset, split=args.split
+        )
+    return None
+
+
+def get_document_ids(dataset: AbstractDataset) -> np.ndarray:
+    """Every document of the split, as ids for get_documents_by_ids."""
+    if isinstance(dataset, C4Dataset):
+        return np.arange(len(dataset.dataset))
+    wiki_ids = dataset.wiki_ids.astype(np.int64)
+    if dataset.dataset_book is dataset.dataset_wiki:
+        return wiki_ids
+    return np.concatenate(
+        [wiki_ids, len(dataset.dataset_wiki) + dataset.book_ids.astype(np.int64)]
+    )
+
+
+def get_separator_id(tokenizer: AbstractTokenizer) -> int:
+    if isinstance(tokenizer, GPTTokenizer):
+        return tokenizer.eot_id
+    return tokenizer.sequence_separator_id
+
+
+def make_tasks(args: Namespace, dataset: Optional[AbstractDataset]) -> List[dict]:
+    if dataset is None:
+        return [
+            {"shard_name": get_shard_name(i), "path": path}
+            for i, path in enumerate(list_local_corpus_files(args.dataset_path))
+        ]
+    n_documents = len(get_document_ids(dataset))
+    return [
+        {
+            "shard_name": get_shard_name(i),
+            "start": start,
+            "end": min(start + args.documents_per_shard, n_documents),
+        }
+        for i, start in enumerate(range(0, n_documents, args.documents_per_shard))
+    ]
+
+
+def check_plan(args: Namespace):
+    plan = {name: getattr(args, name) for name in PLAN_ARGS}
+    path = os.path.join(args.output_dir, PLAN_FILENAME)
+    if os.path.isfile(path):
+        with open(path) as f:
+            previous_plan = json.load(f)
+        if previous_plan != plan:
+            raise ValueError(
+                f"{args.output_dir} was started with {previous_plan}, can't resume it with {plan}"
+            )
+    else:
+        with open(path, "w") as f:
+            json.dump(plan, f, indent=2)
+
+
+def init_worker(args: Namespace):
+    _worker["args"] = args
+    _worker["tokenizer"] = TOKENIZERS[args.tokenizer]()
+    _worker["dataset"] = make_dataset(args)
+    if _worker["dataset"] is not None:
+        _worker["document_ids"] = get_document_ids(_worker["dataset"])
+
+
+def iterate_texts(task: dict) -> Iterator[List[str]]:
+    """Texts of the task's documents in batches of args.batch_size."""
+    args = _worker["args"]
+    if "path" in task:
+        batch = []
+        for _, text in read_local_corpus_file(task["path"], args.text_field):
+            batch.append(text)
+            if len(batch) == args.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+    else:
+        document_ids = _worker["document_ids"][task["start"] : task["end"]]
+        for start in range(0, len(document_ids), args.batch_size):
+            yield _worker["dataset"].get_documents_by_ids(
+                document_ids[start : start + args.batch_size]
+            )
+
+
+def tokenize_shard(task: dict) -> Tuple[dict, int]:
+    """Writes the shard of a task, returns its manifest entry and the number of characters tokenized."""
+    args = _worker["args"]
+    tokenizer = _worker["tokenizer"]
+    n_characters = 0
+
+    def documents() -> Iterator[List[int]]:
+        nonlocal n_characters
+        for texts in iterate_texts(task):
+            n_characters += sum(len(text) for text in texts)
+            yield from tokenizer.texts_to_ids(texts)
+
+    entry = write_shard(
+        args.output_dir,
+        task["shard_name"],
+        documents(),
+        get_separator_id(tokenizer),
+        get_token_dtype(tokenizer.VOCAB_SIZE),
+    )
+    return entry, n_characters
+
+
+def save_c4_token_index(args: Namespace, dataset: C4Dataset, shards: List[dict]):
+    """Document lengths are already known from the shard offsets, so the token index comes for free."""
+    index_path = get_token_index_path(dataset.dataset, "gpt2")
+    assert index_path is not None, "The dataset has no files to put the index next to"
+    token_lengths = np.concatenate(
+        [
+            np.diff(
+                np.fromfile(
+                    os.path.join(args.output_dir, shard["name"] + OFFSETS_SUFFIX),
+                    dtype=np.int64,
+                )
+            )
+            - 1  # without the separator
+            for shard in shards
+        ]
+    )
+    save_token_index(index_path, token_lengths)
+    print(f"Saved the token index to {index_path}")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--dataset_type", type=str, choices=["c4", "wikibook", "local"], required=True
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        default=None,
+        help="train/validation for c4, train/eval for wikibook, unused for local files",
+    )
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="c4: C4 saved with save_to_disk, e.g. by lizrd/scripts/download_c4; "
+        "local: a directory or glob of .jsonl/.parquet/.txt files, optionally .gz/.zst compressed",
+    )
+    parser.add_argument("--use_dummy_dataset", action="store_true")
+    parser.add_argument(
+        "--tokenizer", type=str, choices=list(TOKENIZERS), default="gpt"
+    )
+    parser.add_argument(
+        "--text_field",
+        type=str,
+        default="text",
+        help="local only: the JSONL key / Parquet column holding the document text",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of tokenizing processes",
+    )
+    parser.add_argument(
+        "--documents_per_shard",
+        type=int,
+        default=100_000,
+        help="Documents in a single task and shard, unused for local files, which become one shard each",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Documents fetched and tokenized in a single call",
+    )
+    parser.add_argument(
+        "--write_token_index",
+        action="store_true",
+        help="c4 with the gpt tokenizer only: also save the token index used by C4Dataset, "
+        "see lizrd/scripts/index_token_lengths",
+    )
+    args = parser.parse_args()
+    assert args.dataset_type == "local" or args.split is not None, "Specify --split"
+    assert (
+        args.dataset_type != "local" or args.dataset_path is not None
+    ), "Local files need --dataset_path"
+    assert not args.write_token_index or (
+        args.dataset_type == "c4" and args.tokenizer == "gpt"
+    ), "The token index is only used for C4 with GPT-2 tokens"
+
+    # fails here rather than in every worker, which a Pool would keep restarting
+    tokenizer = TOKENIZERS[args.tokenizer]()
+    os.makedirs(args.output_dir, exist_ok=True)
+    check_plan(args)
+    dataset = make_dataset(args)
+    tasks = make_tasks(args, dataset)
+    shards = {
+        task["shard_name"]: read_shard_entry(args.output_dir, task["shard_name"])
+        for task in tasks
+    }
+    remaining_tasks = [task for task in tasks if shards[task["shard_name"]] is None]
+    print(
+        f"{len(tasks) - len(remaining_tasks)} of {len(tasks)} shards are already done, "
+        f"tokenizing the remaining {len(remaining_tasks)} with {args.num_workers} processes"
+    )
+
+    # every process tokenizes single-threaded, the pool is what makes it parallel
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    n_documents, n_tokens, n_characters = 0, 0, 0
+    start_time = time.time()
+    with multiprocessing.Pool(
+        args.num_workers, initializer=init_worker, initargs=(args,)
+    ) as pool, tqdm.tqdm(total=len(remaining_tasks), unit="shard") as progress:
+        for entry, shard_characters in pool.imap_unordered(
+            tokenize_shard, remaining_tasks
+        ):
+            shards[entry["name"]] = entry
+            n_documents += entry["n_documents"]
+            n_tokens += entry["n_tokens"]
+            n_characters += shard_characters
+            elapsed = time.time() - start_time
+            progress.set_postfix(
+                documents_per_s=f"{n_documents / elapsed:.0f}",
+                tokens_per_s=f"{n_tokens / elapsed:.3g}",
+                characters_per_s=f"{n_characters / elapsed:.3g}",
+            )
+            progress.update()
+    elapsed = time.time() - start_time
+
+    manifest = write_manifest(
+        args.output_dir,
+        tokenizer=args.tokenizer,
+        vocab_size=tokenizer.VOCAB_SIZE,
+        separator_id=get_separator_id(tokenizer),
+        shards=[shards[task["shard_name"]] for task in tasks],
+        source={name: getattr(args, name) for name in PLAN_ARGS},
+    )
+    print(
+        f"Tokenized {n_documents} documents, {n_tokens} tokens in {elapsed:.0f}s "
+        f"({n_tokens / max(elapsed, 1e-9):.3g} tokens/s). The dataset has "
+        f"{manifest['n_documents']} documents, {manifest['n_tokens']} tokens "
+        f"in {len(manifest['shards'])} shards at {args.output_dir}"
+    )
+    if args.write_token_index:
+        save_c4_token_index(args, dataset, manifest["shards"])
+
+
+if __name__ == "__main__":
+    main()
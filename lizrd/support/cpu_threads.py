@@ -0,0 +1,165 @@
+"""
+Splits the CPU cores of the host between the training process and its DataLoader workers, so that the
+torch thread pools and the Rayon pools of the HF fast tokenizers of all these processes don't oversubscribe it.
+"""
+import glob
+import os
+import re
+from typing import List, Literal, Optional, Sequence
+
+from attr import define
+
+AffinityMode = Literal["none", "cores", "numa"]
+
+
+@define
+class ProcessThreads:
+    cores: List[int]
+    torch_threads: int
+    tokenizer_threads: int
+    pin: bool
+
+    def apply(self):
+        """Applies the budget to the calling process. Call it before the tokenizers are first used."""
+        import torch
+
+        if self.pin and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)
+        torch.set_num_threads(self.torch_threads)
+        # picked up by OpenMP runtimes initialized later and by processes started from this one
+        os.environ["OMP_NUM_THREADS"] = str(self.torch_threads)
+        # the fast tokenizers size their Rayon pool from this the first time they run in parallel
+        os.environ["RAYON_RS_NUM_CPUS"] = str(self.tokenizer_threads)
+        os.environ["TOKENIZERS_PARALLELISM"] = (
+            "true" if self.tokenizer_threads > 1 else "false"
+        )
+
+    def describe(self) -> str:
+        return (
+            f"cores {format_cores(self.cores)} ({'pinned' if self.pin else 'not pinned'}), "
+            f"torch threads {self.torch_threads}, tokenizer threads {self.tokenizer_threads}"
+        )
+
+
+@define
+class ThreadPlan:
+    main: ProcessThreads
+    workers: List[ProcessThreads]
+
+    def worker(self, worker_id: int) -> ProcessThreads:
+        return self.workers[worker_id % len(self.workers)]
+
+    def report(self) -> str:
+        lines = [f"main process: {self.main.describe()}"]
+        lines += [
+            f"dataloader worker {i}: {worker.describe()}"
+            for i, worker in enumerate(self.workers)
+        ]
+        return "\n".join(lines)
+
+
+def format_cores(cores: Sequence[int]) -> str:
+    """[0, 1, 2, 3, 8] -> '0-3,8'"""
+    ranges = []
+    for core in sorted(cores):
+        if len(ranges) > 0 and ranges[-1][1] == core - 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(
+        str(start) if start == end else f"{start}-{end}" for start, end in ranges
+    )
+
+
+def parse_cores(cpulist: str) -> List[int]:
+    """'0-3,8' -> [0, 1, 2, 3, 8], the format of /sys/devices/system/node/node*/cpulist"""
+    cores = []
+    for part in cpulist.strip().split(","):
+        if part == "":
+            continue
+        start, _, end = part.partition("-")
+        cores.extend(range(int(start), int(end or start) + 1))
+    return cores
+
+
+def get_available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_numa_nodes() -> List[List[int]]:
+    """Cores of every NUMA node, an empty list if the topology is unknown."""
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.findall(r"node(\d+)", p)[-1])):
+        with open(path) as f:
+            nodes.append(parse_cores(f.read()))
+    return [node for node in nodes if len(node) > 0]
+
+
+def split_evenly(items: Sequence[int], n_parts: int) -> List[List[int]]:
+    """n_parts contiguous parts, if there are fewer items than parts, the items are shared round robin."""
+    if len(items) < n_parts:
+        return [[items[i % len(items)]] for i in range(n_parts)]
+    bounds = [len(items) * i // n_parts for i in range(n_parts + 1)]
+    return [list(items[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+
+def make_thread_plan(
+    num_workers: int,
+    affinity: AffinityMode = "none",
+    main_process_cores: Optional[int] = None,
+    local_rank: int = 0,
+    local_world_size: int = 1,
+    available_cores: Optional[List[int]] = None,
+    numa_nodes: Optional[List[List[int]]] = None,
+) -> ThreadPlan:
+    """
+    Training processes on the same host (local_world_size of them) get disjoint slices of the available cores.
+    Each one keeps main_process_cores of its slice for itself, by default an equal share with its workers,
+    and the rest is split between its num_workers DataLoader workers.
+    affinity: "cores" pins every process to its cores, "numa" pins every worker to all worker cores
+        of one NUMA node (round robin over the nodes), so that the OS can balance within the node,
+        "none" only sets the thread counts.
+    Workers keep a single torch thread, as the DataLoader does by default, their cores go to the tokenizer.
+    """
+    if available_cores is None:
+        available_cores = get_available_cores()
+    cores = split_evenly(available_cores, local_world_size)[local_rank]
+    pin = affinity != "none"
+
+    if num_workers == 0:
+        main = ProcessThreads(cores, len(cores), len(cores), pin)
+        return ThreadPlan(main=main, workers=[main])
+
+    if main_process_cores is None:
+        main_process_cores = max(1, len(cores) // (num_workers + 1))
+    # at least one core is left for the workers
+    main_process_cores = max(1, min(main_process_cores, len(cores) - 1))
+    main_cores, worker_cores = cores[:main_process_cores], cores[main_process_cores:]
+    if len(worker_cores) == 0:
+        worker_cores = main_cores
+    main = ProcessThreads(main_cores, len(main_cores), len(main_cores), pin)
+
+    if affinity == "numa":
+        if numa_nodes is None:
+            numa_nodes = get_numa_nodes()
+        groups = [
+            [core for core in worker_cores if core in set(node)] for node in numa_nodes
+        ]
+        groups = [group for group in groups if len(group) > 0] or [worker_cores]
+        workers_per_group = [
+            len(range(i, num_workers, len(groups))) for i in range(len(groups))
+        ]
+        workers = []
+        for i in range(num_workers):
+            group = groups[i % len(groups)]
+            n_threads = max(1, len(group) // workers_per_group[i % len(groups)])
+            workers.append(ProcessThreads(group, 1, n_threads, pin))
+    else:
+        workers = [
+            ProcessThreads(part, 1, len(part), pin)
+            for part in split_evenly(worker_cores, num_workers)
+        ]
+    return ThreadPlan(main=main, workers=workers)
@@ -1,23 +1,170 @@
+from contextlib import contextmanager
+from typing import List, Optional, Sequence
+
 import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 
+from lizrd.core import llm, misc
+from lizrd.core.llm import KVCache
 
-def decode_single_example(
+# modules that either process every token on its own, keep their state in the KV cache,
+# or only contain other modules (which are checked separately)
+KV_CACHE_COMPATIBLE_MODULES = (
+    llm.LLM,
+    llm.EmbeddingLayer,
+    llm.PositionalEmbedding,
+    llm.TransformerTower,
+    llm.TransformerBlock,
+    llm.Residual,
+    llm.ReZero,
+    llm.Parallel,
+    llm.Attention,
+    llm.AttentionRoPE,
+    llm.AttentionMechanism,
+    llm.RoPE,
+    llm.SwiGLUFeedForward,
+    llm.RMSNorm,
+    llm.PredictionHead,
+    llm.AdaptiveSoftmaxHead,
+    misc.Linear,
+    misc.Noop,
+    nn.Embedding,
+    nn.Linear,
+    nn.LayerNorm,
+    nn.ReLU,
+    nn.GELU,
+    nn.SiLU,
+    nn.Dropout,
+    nn.Identity,
+    nn.Sequential,
+    nn.ModuleList,
+    nn.AdaptiveLogSoftmaxWithLoss,
+    DistributedDataParallel,
+)
+
+
+def supports_kv_cache(model: nn.Module) -> bool:
+    """
+    Whether the model gives the same outputs when run on new tokens only, with a KV cache.
+    Layers mixing tokens outside of attention (e.g. mamba, expert choice or continuous MoE) don't.
+    """
+    return all(
+        type(module) in KV_CACHE_COMPATIBLE_MODULES for module in model.modules()
+    )
+
+
+@contextmanager
+def use_kv_cache(model: torch.nn.Module, kv_cache: KVCache):
+    """Makes the attention and positional embedding layers of the model process only new tokens."""
+    layers = [module for module in model.modules() if hasattr(module, "kv_cache")]
+    assert len(layers) > 0, "The model has no layers supporting a KV cache"
+    for layer in layers:
+        layer.kv_cache = kv_cache
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.kv_cache = None
+
+
+def generate(
     model: torch.nn.Module,
     max_sequence_length: int,
-    input_tokens_ids: torch.Tensor,
+    prompts: Sequence[torch.Tensor],
     end_token_id: int,
-) -> torch.Tensor:
-    output_tokens_ids = torch.nn.functional.pad(
-        input_tokens_ids, (0, max_sequence_length - len(input_tokens_ids))
+    pad_token_id: Optional[int] = None,
+) -> List[torch.Tensor]:
+    """
+    Greedy decoding of a batch of prompts (1D tensors of token ids). Prompts are left-padded and processed
+    in a single forward pass, then every step runs the model on the last generated tokens only.
+    Models that don't support a KV cache (see supports_kv_cache) decode every prompt on its own instead,
+    running the whole sequence at every step.
+    Returns every prompt followed by its continuation, ending with end_token_id or at max_sequence_length tokens.
+    """
+    if not supports_kv_cache(model):
+        return [
+            generate_without_cache(model, max_sequence_length, prompt, end_token_id)
+            for prompt in prompts
+        ]
+    device = next(model.parameters()).device
+    pad_token_id = end_token_id if pad_token_id is None else pad_token_id
+    prompt_length = max(len(prompt) for prompt in prompts)
+    assert prompt_length < max_sequence_length, "No space left for the continuation"
+
+    n_padding = torch.tensor([prompt_length - len(prompt) for prompt in prompts])
+    # every sequence can reach max_sequence_length tokens without its padding
+    tokens = torch.full(
+        (len(prompts), max_sequence_length + n_padding.max().item()),
+        pad_token_id,
+        device=device,
     )
-    output_length = len(input_tokens_ids)
+    padding_mask = torch.ones_like(tokens, dtype=torch.bool)
+    for i, prompt in enumerate(prompts):
+        tokens[i, n_padding[i] : prompt_length] = prompt.to(device)
+        padding_mask[i, : n_padding[i]] = False
+        # after the end of a sequence, so that the positions stay below max_sequence_length
+        padding_mask[i, n_padding[i] + max_sequence_length :] = False
+    kv_cache = KVCache(padding_mask)
+    n_padding = n_padding.to(device)
+
+    finished = torch.zeros(len(prompts), dtype=torch.bool, device=device)
+    length = prompt_length
+    was_training = model.training
     model.eval()
-    with torch.no_grad():
+    with torch.no_grad(), use_kv_cache(model, kv_cache):
+        input_ids = tokens[:, :length]
         while True:
-            predictions = model(output_tokens_ids)
-            next_token_id = torch.argmax(predictions, dim=-1)[output_length - 1].item()
-            output_tokens_ids[output_length] = next_token_id
-            output_length += 1
-            if output_length == max_sequence_length or next_token_id == end_token_id:
+            predictions = model(input_ids)
+            kv_cache.advance(input_ids.shape[-1])
+            next_token_ids = torch.argmax(predictions[:, -1], dim=-1)
+            next_token_ids.masked_fill_(finished, pad_token_id)
+            tokens[:, length] = next_token_ids
+            length += 1
+            finished |= next_token_ids == end_token_id
+            finished |= length - n_padding == max_sequence_length
+            if finished.all():
+                break
+            input_ids = tokens[:, length - 1 : length]
+    model.train(was_training)
+
+    outputs = []
+    for i in range(len(prompts)):
+        output = tokens[i, :length][padding_mask[i, :length]]
+        end_positions = torch.nonzero(
+            output[len(prompts[i]) :] == end_token_id
+        ).flatten()
+        if len(end_positions) > 0:
+            output = output[: len(prompts[i]) + end_positions[0] + 1]
+        outputs.append(output)
+    return outputs
+
+
+def generate_without_cache(
+    model: torch.nn.Module,
+    max_sequence_length: int,
+    prompt: torch.Tensor,
+    end_token_id: int,
+) -> torch.Tensor:
+    """Greedy decoding of a single prompt, the model is run on the whole sequence at every step."""
+    device = next(model.parameters()).device
+    tokens = prompt.to(device)
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        while len(tokens) < max_sequence_length:
+            next_token_id = torch.argmax(model(tokens[None])[0, -1])
+            tokens = torch.cat([tokens, next_token_id[None]])
+            if next_token_id == end_token_id:
                 break
-    return output_tokens_ids[:output_length]
+    model.train(was_training)
+    return tokens
+
+
+def decode_single_example(
+    model: torch.nn.Module,
+    max_sequence_length: int,
+    input_tokens_ids: torch.Tensor,
+    end_token_id: int,
+) -> torch.Tensor:
+    return generate(model, max_sequence_length, [input_tokens_ids], end_token_id)[0]
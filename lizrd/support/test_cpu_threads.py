@@ -0,0 +1,50 @@
+from lizrd.support.cpu_threads import format_cores, make_thread_plan, parse_cores
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestThreadPlan(GeneralTestCase):
+    def test_disjoint_cores(self):
+        plans = [
+            make_thread_plan(
+                num_workers=3,
+                affinity="cores",
+                local_rank=rank,
+                local_world_size=2,
+                available_cores=list(range(16)),
+            )
+            for rank in range(2)
+        ]
+        used_cores = []
+        for plan in plans:
+            self.assertEqual(len(plan.main.cores), 2)
+            self.assertEqual(plan.main.torch_threads, 2)
+            used_cores += plan.main.cores
+            for worker in plan.workers:
+                self.assertEqual(worker.torch_threads, 1)
+                self.assertEqual(worker.tokenizer_threads, len(worker.cores))
+                used_cores += worker.cores
+        self.assertEqual(sorted(used_cores), list(range(16)))
+
+    def test_numa(self):
+        plan = make_thread_plan(
+            num_workers=4,
+            affinity="numa",
+            main_process_cores=2,
+            available_cores=list(range(16)),
+            numa_nodes=[list(range(8)), list(range(8, 16))],
+        )
+        self.assertEqual(plan.main.cores, [0, 1])
+        self.assertEqual(plan.workers[0].cores, list(range(2, 8)))
+        self.assertEqual(plan.workers[1].cores, list(range(8, 16)))
+        self.assertEqual(
+            [worker.tokenizer_threads for worker in plan.workers], [3, 4, 3, 4]
+        )
+
+    def test_more_workers_than_cores(self):
+        plan = make_thread_plan(num_workers=5, available_cores=[0, 1, 2])
+        self.assertEqual(plan.main.cores, [0])
+        self.assertEqual([w.cores for w in plan.workers], [[1], [2], [1], [2], [1]])
+
+    def test_core_lists(self):
+        self.assertEqual(parse_cores("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(format_cores([0, 1, 2, 3, 8, 10, 11]), "0-3,8,10-11")
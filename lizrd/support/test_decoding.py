@@ -0,0 +1,105 @@
+import torch
+
+from lizrd.core import llm
+from lizrd.support.decoding import (
+    generate,
+    generate_without_cache,
+    supports_kv_cache,
+)
+from research.conditional.moe_layers.expert_choice import ExpertChoiceFF
+from research.conditional.moe_layers.expert_types import ExpertFF
+from lizrd.support.test_utils import GeneralTestCase
+
+
+def get_model(vocab_size, max_length, rope, expert_choice=False):
+    dm, heads, dff, n_blocks = 32, 4, 64, 2
+    embedding_layers = [
+        llm.TokenEmbedding(vocab_size, dm, init_type="kaiming_uniform", init_scale=1.0)
+    ]
+    if rope:
+        attention_fun = lambda: llm.AttentionRoPE(
+            dmodel=dm,
+            heads=heads,
+            causal=True,
+            length=max_length,
+            init_type="kaiming_uniform",
+            init_scale=1.0,
+        )
+    else:
+        embedding_layers.append(
+            llm.PositionalEmbedding(
+                max_length, dm, init_type="kaiming_uniform", init_scale=1.0
+            )
+        )
+        attention_fun = lambda: llm.Attention(
+            dmodel=dm,
+            heads=heads,
+            causal=True,
+            init_type="kaiming_uniform",
+            init_scale=1.0,
+        )
+    layer_dict = {
+        "attention": attention_fun,
+        "feedforward": lambda: llm.FeedForward(
+            dmodel=dm, dff=dff, init_type="kaiming_uniform", init_scale=1.0
+        ),
+    }
+    if expert_choice:
+        layer_dict["feedforward"] = lambda: ExpertChoiceFF(
+            dm,
+            n_experts=4,
+            topk_fraction=0.5,
+            init_type="kaiming_uniform",
+            init_scale=1.0,
+            expert_inner_function=ExpertFF(
+                dm, 4, dff // 4, init_type="kaiming_uniform", init_scale=1.0
+            ),
+        )
+    return llm.LLM(
+        llm.EmbeddingLayer(*embedding_layers),
+        llm.TransformerTower(n_blocks, dm, layer_dict, device=torch.device("cpu")),
+        llm.PredictionHead(dm, vocab_size, init_type="kaiming_uniform", init_scale=1.0),
+    )
+
+
+class TestGenerate(GeneralTestCase):
+    def test_same_as_without_cache(self):
+        vocab_size, max_length = 13, 24
+        for rope in [False, True]:
+            torch.manual_seed(0)
+            model = get_model(vocab_size, max_length, rope)
+            model.eval()
+            prompts = [torch.randint(0, vocab_size, (n,)) for n in [1, 7, 4]]
+            # vocab_size never ends a sequence, it is cut at max_length
+            for end_token_id in [0, vocab_size]:
+                outputs = generate(
+                    model, max_length, prompts, end_token_id, pad_token_id=0
+                )
+                for prompt, output in zip(prompts, outputs):
+                    expected = generate_without_cache(
+                        model, max_length, prompt, end_token_id
+                    )
+                    self.assertTensorEqual(output, expected)
+            self.assertTrue(
+                all(
+                    layer.kv_cache is None
+                    for layer in model.modules()
+                    if hasattr(layer, "kv_cache")
+                )
+            )
+
+    def test_expert_choice_without_cache(self):
+        # expert choice routes tokens depending on the whole sequence, so new tokens can't be run on their own
+        vocab_size, max_length = 13, 24
+        torch.manual_seed(0)
+        model = get_model(vocab_size, max_length, rope=True, expert_choice=True)
+        model.eval()
+        self.assertFalse(supports_kv_cache(model))
+        self.assertTrue(supports_kv_cache(get_model(vocab_size, max_length, True)))
+        prompts = [torch.randint(0, vocab_size, (n,)) for n in [2, 7, 4]]
+        outputs = generate(model, max_length, prompts, vocab_size, pad_token_id=0)
+        for prompt, output in zip(prompts, outputs):
+            self.assertEqual(len(output), max_length)
+            self.assertTensorEqual(
+                output, generate_without_cache(model, max_length, prompt, vocab_size)
+            )
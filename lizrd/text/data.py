@@ -1,32 +1,77 @@
-from typing import List
+from typing import List, Optional, Sequence, Union
 
 import numpy as np
 import torch
 from attr import dataclass
 
+# int32 is enough for every vocabulary we use (torch has no uint16 tensors), and embeddings accept it directly;
+# the loss widens target ids to int64 only where cross entropy needs it
+TOKEN_DTYPE = np.int32
+LOSS_MASK_DTYPE = np.bool_
+
 
 @dataclass
 class LLMExample(object):
-    input_ids: List[int]
-    target_ids: List[int]
-    should_calculate_loss: List[
-        int
+    input_ids: Union[np.ndarray, List[int]]
+    target_ids: Union[np.ndarray, List[int]]
+    should_calculate_loss: Union[
+        np.ndarray, List[int]
     ]  # e.g. in BERT loss is not calculated over non-masked tokens
 
 
 class LLMBatch:
-    def __init__(self, examples: List[LLMExample]):
-        self.input_ids = self._make_tensor([example.input_ids for example in examples])
+    def __init__(self, examples: List[LLMExample], out: Optional["LLMBatch"] = None):
+        """out: a batch of the same shape whose tensors are filled in place instead of allocating new ones"""
+        self.input_ids = self._make_tensor(
+            [example.input_ids for example in examples],
+            TOKEN_DTYPE,
+            None if out is None else out.input_ids,
+        )
         self.target_ids = self._make_tensor(
-            [example.target_ids for example in examples]
+            [example.target_ids for example in examples],
+            TOKEN_DTYPE,
+            None if out is None else out.target_ids,
         )
         self.should_calculate_loss = self._make_tensor(
-            [example.should_calculate_loss for example in examples]
+            [example.should_calculate_loss for example in examples],
+            LOSS_MASK_DTYPE,
+            None if out is None else out.should_calculate_loss,
         )
 
         assert self.input_ids.shape == self.target_ids.shape
         assert self.input_ids.shape == self.should_calculate_loss.shape
 
+    @classmethod
+    def from_tensors(
+        cls,
+        input_ids: torch.Tensor,
+        target_ids: torch.Tensor,
+        should_calculate_loss: torch.Tensor,
+    ) -> "LLMBatch":
+        batch = cls.__new__(cls)
+        batch.input_ids = input_ids
+        batch.target_ids = target_ids
+        batch.should_calculate_loss = should_calculate_loss
+        return batch
+
+    @classmethod
+    def concatenate(cls, batches: List["LLMBatch"]) -> "LLMBatch":
+        if len(batches) == 1:
+            return batches[0]
+        return cls.from_tensors(
+            torch.cat([batch.input_ids for batch in batches]),
+            torch.cat([batch.target_ids for batch in batches]),
+            torch.cat([batch.should_calculate_loss for batch in batches]),
+        )
+
+    def split_sequences(self, sequence_length: int) -> "LLMBatch":
+        """The same tokens as more, shorter sequences, each row is cut into pieces of sequence_length."""
+        return LLMBatch.from_tensors(
+            self.input_ids.reshape(-1, sequence_length),
+            self.target_ids.reshape(-1, sequence_length),
+            self.should_calculate_loss.reshape(-1, sequence_length),
+        )
+
     def pin_memory(self):
         """Pin memory for faster transfer to GPU as described in https://pytorch.org/docs/stable/data.html#memory-pinning"""
         self.input_ids = self.input_ids.pin_memory()
@@ -53,12 +98,25 @@ class LLMBatch:
         )
         return self.input_ids.device
 
-    def to(self, device) -> "LLMBatch":
-        self.input_ids = self.input_ids.to(device)
-        self.target_ids = self.target_ids.to(device)
-        self.should_calculate_loss = self.should_calculate_loss.to(device)
+    def to(self, device, non_blocking: bool = False) -> "LLMBatch":
+        self.input_ids = self.input_ids.to(device, non_blocking=non_blocking)
+        self.target_ids = self.target_ids.to(device, non_blocking=non_blocking)
+        self.should_calculate_loss = self.should_calculate_loss.to(
+            device, non_blocking=non_blocking
+        )
         return self
 
-    def _make_tensor(self, list_of_token_lists: List[List[int]]) -> torch.Tensor:
-        matrix = np.array(list_of_token_lists)
-        return torch.from_numpy(matrix)
+    def _make_tensor(
+        self,
+        rows: List[Sequence[int]],
+        dtype: np.dtype,
+        out: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # rows are copied straight into a preallocated (batch, seq) buffer, without intermediate lists
+        if out is None:
+            out = torch.from_numpy(np.empty((len(rows), len(rows[0])), dtype=dtype))
+        matrix = out.numpy()
+        assert matrix.shape == (len(rows), len(rows[0])) and matrix.dtype == dtype
+        for i, row in enumerate(rows):
+            matrix[i] = row
+        return out
@@ -1,12 +1,149 @@
 from abc import abstractmethod
+import glob
+import gzip
+import io
+import itertools
+import json
+import os
 import random
-from typing import Optional
+from typing import Callable, Iterator, List, Literal, Optional, Tuple
 
 from datasets import load_dataset, load_from_disk
 import numpy as np
 
+from lizrd.text.token_shards import TokenShards
+
+
+def get_token_index_path(dataset, tokenizer_name: str) -> Optional[str]:
+    """Token index of a HF dataset lives next to its arrow files, None for in-memory datasets."""
+    if len(dataset.cache_files) == 0:
+        return None
+    cache_dir = os.path.dirname(dataset.cache_files[0]["filename"])
+    return os.path.join(cache_dir, f"token_offsets_{tokenizer_name}_{len(dataset)}.npy")
+
+
+def save_token_index(path: str, token_lengths: np.ndarray):
+    """Stores cumulative token counts, int64 with a leading 0, like the offsets of token shards."""
+    offsets = np.zeros(len(token_lengths) + 1, dtype=np.int64)
+    np.cumsum(token_lengths, out=offsets[1:])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, offsets)
+    os.replace(tmp_path, path)
+
+
+def load_token_index(dataset, tokenizer_name: str) -> Optional[np.ndarray]:
+    path = get_token_index_path(dataset, tokenizer_name)
+    if path is None or not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+class ShardedIndexSampler:
+    """
+    Epochs over the positions [0, n_positions) split between n_shards disjoint participants
+    (dataloader workers of all ranks). The positions are cut into contiguous blocks, and every
+    participant gets a contiguous range of blocks. Each epoch, a participant visits its blocks in random
+    order, buffer_blocks at a time, shuffling positions only within the buffer. Reads then stay local,
+    and no position is sampled twice per epoch. The state is a few integers, every permutation is
+    recomputed from (seed, epoch, buffer).
+    """
+
+    def __init__(
+        self,
+        n_positions: int,
+        shard_index: int = 0,
+        n_shards: int = 1,
+        seed: int = 0,
+        block_size: int = 4096,
+        buffer_blocks: int = 16,
+    ):
+        assert (
+            n_positions >= n_shards
+        ), f"Cannot split {n_positions} positions into {n_shards} shards"
+        # small datasets (e.g. eval splits) get smaller blocks, so that every shard has some
+        block_size = max(1, min(block_size, n_positions // n_shards))
+        n_blocks = -(-n_positions // block_size)
+        self.n_positions = n_positions
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.seed = seed
+        self.blocks = np.arange(
+            n_blocks * shard_index // n_shards, n_blocks * (shard_index + 1) // n_shards
+        )
+        self.epoch = 0
+        self.buffer_index = 0
+        self.position_in_buffer = 0
+        self._buffer = None
+
+    def state_dict(self) -> dict:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "buffer_index": self.buffer_index,
+            "position_in_buffer": self.position_in_buffer,
+        }
+
+    def load_state_dict(self, state: dict):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.buffer_index = state["buffer_index"]
+        self.position_in_buffer = state["position_in_buffer"]
+        self._buffer = None
+
+    def sample(self, n: int) -> np.ndarray:
+        positions = []
+        while n > 0:
+            buffer = self._get_buffer()
+            taken = buffer[self.position_in_buffer : self.position_in_buffer + n]
+            positions.append(taken)
+            n -= len(taken)
+            self.position_in_buffer += len(taken)
+            if self.position_in_buffer == len(buffer):
+                self._next_buffer()
+        return np.concatenate(positions)
+
+    def _next_buffer(self):
+        self.buffer_index += 1
+        self.position_in_buffer = 0
+        self._buffer = None
+        if self.buffer_index * self.buffer_blocks >= len(self.blocks):
+            self.epoch += 1
+            self.buffer_index = 0
+
+    def _get_buffer(self) -> np.ndarray:
+        if self._buffer is None:
+            block_order = np.random.default_rng([self.seed, self.epoch]).permutation(
+                self.blocks
+            )
+            first = self.buffer_index * self.buffer_blocks
+            positions = np.concatenate(
+                [
+                    np.arange(
+                        block * self.block_size,
+                        min((block + 1) * self.block_size, self.n_positions),
+                    )
+                    for block in block_order[first : first + self.buffer_blocks]
+                ]
+            )
+            np.random.default_rng([self.seed, self.epoch, self.buffer_index]).shuffle(
+                positions
+            )
+            self._buffer = positions
+        return self._buffer
+
 
 class AbstractDataset:
+    # cumulative GPT-2 token counts of the documents (length n_documents + 1), for datasets that have a token index
+    token_offsets: Optional[np.ndarray] = None
+    # datasets that implement sample_document_ids and get_documents_by_ids set this
+    has_document_ids: bool = False
+    # identifies the collection the document ids refer to, e.g. for caching documents
+    name: Optional[str] = None
+    # datasets created with sharded_sampling sample through this, see set_shard
+    sharded_sampling: bool = False
+    sampler: Optional[ShardedIndexSampler] = None
+
     def __init__(self, seed: Optional[int] = None):
         self.set_rng(seed)
 
@@ -17,21 +154,76 @@ class AbstractDataset:
         self.np_rng = np_rng
         self.py_rng = py_rng
 
+    def state_dict(self) -> dict:
+        return {
+            "np_rng": self.np_rng.bit_generator.state,
+            "py_rng": self.py_rng.getstate(),
+            "sampler": None if self.sampler is None else self.sampler.state_dict(),
+        }
+
+    def load_state_dict(self, state: dict):
+        self.np_rng.bit_generator.state = state["np_rng"]
+        self.py_rng.setstate(state["py_rng"])
+        if self.sampler is not None and state.get("sampler") is not None:
+            self.sampler.load_state_dict(state["sampler"])
+
+    def set_shard(self, shard_index: int, n_shards: int):
+        """Which of the n_shards disjoint parts of the dataset to sample from, only used with sharded sampling."""
+        if self.sharded_sampling:
+            self.sampler = ShardedIndexSampler(
+                self._n_sampling_positions(),
+                shard_index,
+                n_shards,
+                seed=int(self.np_rng.integers(2**62)),
+            )
+
+    def _n_sampling_positions(self) -> int:
+        raise NotImplementedError()
+
     @abstractmethod
     def get_document(self) -> str:
         raise NotImplementedError()
 
+    def get_documents(self, n_documents: int) -> List[str]:
+        """Datasets with random row access should override this to fetch all rows in one call."""
+        return [self.get_document() for _ in range(n_documents)]
+
+    def sample_document_ids(self, n_documents: int) -> np.ndarray:
+        """Random document ids, get_documents(n) is get_documents_by_ids(sample_document_ids(n))."""
+        raise NotImplementedError()
+
+    def get_documents_by_ids(self, document_ids: np.ndarray) -> List[str]:
+        raise NotImplementedError()
+
+    def get_token_lengths(self, document_ids: np.ndarray) -> np.ndarray:
+        return self.token_offsets[document_ids + 1] - self.token_offsets[document_ids]
+
+    @property
+    def total_tokens(self) -> Optional[int]:
+        if self.token_offsets is None:
+            return None
+        return int(self.token_offsets[-1])
+
 
 class WikiBookDataset(AbstractDataset):
+    EVAL_PERCENTAGE = 5
+    has_document_ids = True
+
     def __init__(
         self,
         seed: Optional[int] = None,
         use_dummy_dataset: bool = False,
         split: str = "train",
+        sharded_sampling: bool = False,
     ):
+        """
+        sharded_sampling: go through the documents of the split in epochs, see ShardedIndexSampler.
+            Wiki and book documents are then sampled uniformly from their union.
+        """
         super().__init__(seed=seed)
         assert split in ["train", "eval"]
         self.split = split
+        self.name = f"wikibook-{'simple' if use_dummy_dataset else 'en'}"
 
         self.dataset_wiki = load_dataset(
             "wikipedia", f"20220301.{'simple' if use_dummy_dataset else 'en'}"
@@ -42,42 +234,127 @@ class WikiBookDataset(AbstractDataset):
             else self.dataset_wiki
         )
 
+        self.wiki_ids = self._load_split_ids(self.dataset_wiki)
+        self.book_ids = (
+            self._load_split_ids(self.dataset_book)
+            if not use_dummy_dataset
+            else self.wiki_ids
+        )
+
         self.bookcorpus_chance = len(self.dataset_book) / len(self.dataset_wiki)
 
+        self.sharded_sampling = sharded_sampling
+        self.set_shard(0, 1)
+
     def get_document(self) -> str:
+        if self.sampler is not None:
+            return self.get_documents(1)[0]
         selector = self.py_rng.random()
         if selector < self.bookcorpus_chance:
             return self._get_random_book_example()
         else:
             return self._get_random_wiki_example()
 
+    def get_documents(self, n_documents: int) -> List[str]:
+        return self.get_documents_by_ids(self.sample_document_ids(n_documents))
+
+    def sample_document_ids(self, n_documents: int) -> np.ndarray:
+        """Wiki and book documents share one id space, book ids come after all wiki ids."""
+        if self.sampler is not None:
+            positions = self.sampler.sample(n_documents)
+            is_book = positions >= len(self.wiki_ids)
+            return np.where(
+                is_book,
+                len(self.dataset_wiki)
+                + self.book_ids[np.maximum(positions - len(self.wiki_ids), 0)],
+                self.wiki_ids[np.minimum(positions, len(self.wiki_ids) - 1)],
+            )
+
+        is_book = self.np_rng.random(n_documents) < self.bookcorpus_chance
+        doc_ids = np.empty(n_documents, dtype=np.int64)
+        doc_ids[~is_book] = self._sample_split_ids(self.wiki_ids, (~is_book).sum())
+        doc_ids[is_book] = len(self.dataset_wiki) + self._sample_split_ids(
+            self.book_ids, is_book.sum()
+        )
+        return doc_ids
+
+    def get_documents_by_ids(self, document_ids: np.ndarray) -> List[str]:
+        is_book = document_ids >= len(self.dataset_wiki)
+        book_texts = iter(
+            self._get_texts(
+                self.dataset_book, document_ids[is_book] - len(self.dataset_wiki)
+            )
+        )
+        wiki_texts = iter(self._get_texts(self.dataset_wiki, document_ids[~is_book]))
+        return [next(book_texts) if book else next(wiki_texts) for book in is_book]
+
+    def _n_sampling_positions(self) -> int:
+        if self.dataset_book is self.dataset_wiki:
+            return len(self.wiki_ids)
+        return len(self.wiki_ids) + len(self.book_ids)
+
+    def _sample_split_ids(self, split_ids: np.ndarray, n_documents: int) -> np.ndarray:
+        return split_ids[self.np_rng.integers(0, len(split_ids), n_documents)]
+
+    def _get_texts(self, dataset, document_ids: np.ndarray) -> List[str]:
+        if len(document_ids) == 0:
+            return []
+        return dataset[document_ids.tolist()]["text"]
+
     def _belongs_to_split(self, document_id: int) -> bool:
-        eval_percentage = 5
+        return bool(self._split_mask(np.array([document_id]))[0])
 
+    def _split_mask(self, document_ids: np.ndarray) -> np.ndarray:
+        # same rule as hash(document_id) % 100, which is the identity for non-negative ints
         if self.split == "train":
-            return hash(document_id) % 100 >= eval_percentage
+            return document_ids % 100 >= self.EVAL_PERCENTAGE
         elif self.split == "eval":
-            return hash(document_id) % 100 < eval_percentage
+            return document_ids % 100 < self.EVAL_PERCENTAGE
         else:
             raise ValueError("split must be either 'train' or 'eval'")
 
+    def _load_split_ids(self, dataset) -> np.ndarray:
+        """
+        Ids of the documents in self.split, cached as .npy next to the HF cache files of the dataset,
+        so that they are computed once and memory-mapped (shared through the page cache) by all workers.
+        """
+        cache_path = None
+        if len(dataset.cache_files) > 0:
+            cache_dir = os.path.dirname(dataset.cache_files[0]["filename"])
+            cache_path = os.path.join(
+                cache_dir,
+                f"split_ids_{self.split}_{self.EVAL_PERCENTAGE}_{len(dataset)}.npy",
+            )
+            if os.path.exists(cache_path):
+                return np.load(cache_path, mmap_mode="r")
+
+        all_ids = np.arange(len(dataset), dtype=np.uint32)
+        split_ids = all_ids[self._split_mask(all_ids)]
+
+        if cache_path is not None:
+            try:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, split_ids)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass  # read-only HF cache, keep the index in memory
+        return split_ids
+
     def _get_random_book_example(self) -> str:
-        doc_id = None
-        while doc_id is None or not self._belongs_to_split(doc_id):
-            doc_id = self.py_rng.randint(0, len(self.dataset_book) - 1)
-        document = self.dataset_book[doc_id]
+        doc_id = self.book_ids[self.py_rng.randint(0, len(self.book_ids) - 1)]
+        document = self.dataset_book[int(doc_id)]
         return document["text"]
 
     def _get_random_wiki_example(self) -> str:
-        doc_id = None
-        while doc_id is None or not self._belongs_to_split(doc_id):
-            doc_id = self.py_rng.randint(0, len(self.dataset_book) - 1)
-        document = self.dataset_wiki[doc_id]
+        doc_id = self.wiki_ids[self.py_rng.randint(0, len(self.wiki_ids) - 1)]
+        document = self.dataset_wiki[int(doc_id)]
         return document["text"]
 
 
 class C4Dataset(AbstractDataset):
     total_gpt2_tokens = 173_648_052_806  # number of tokens in the C4 dataset when using GPT2TokenizerFast
+    has_document_ids = True
 
     def __init__(
         self,
@@ -85,19 +362,349 @@ class C4Dataset(AbstractDataset):
         split: str = "train",
         use_dummy_dataset: bool = False,
         dataset_path: Optional[str] = None,
+        token_weighted_sampling: bool = False,
+        sharded_sampling: bool = False,
     ):
+        """
+        token_weighted_sampling: sample documents proportionally to their token count, so that every token
+            is equally likely to be trained on. Requires the token index from lizrd/scripts/index_token_lengths.
+        sharded_sampling: go through the dataset in epochs, mostly sequentially, see ShardedIndexSampler
+        """
         super().__init__(seed=seed)
         assert split in ["train", "validation"]
         if dataset_path is not None:
             self.dataset = load_from_disk(dataset_path)
+            self.name = f"c4-{os.path.abspath(dataset_path)}"
         elif use_dummy_dataset:
             if split != "train":
                 raise NameError(
                     "Dummy dataset only supports train split for C4 dataset"
                 )
             self.dataset = load_dataset("stas/c4-en-10k", split=split)
+            self.name = f"c4-dummy-{split}"
         else:
             self.dataset = load_dataset("c4", "en", split=split)
+            self.name = f"c4-{split}"
+
+        self.token_offsets = load_token_index(self.dataset, "gpt2")
+        self.token_weighted_sampling = token_weighted_sampling
+        if token_weighted_sampling and self.token_offsets is None:
+            raise ValueError(
+                "Token weighted sampling needs a token index of the dataset, "
+                "build it with lizrd/scripts/index_token_lengths"
+            )
+        if token_weighted_sampling and sharded_sampling:
+            raise ValueError(
+                "Token weighted sampling and sharded sampling can't be used together"
+            )
+        self.sharded_sampling = sharded_sampling
+        self.set_shard(0, 1)
 
     def get_document(self) -> str:
+        if self.token_weighted_sampling or self.sampler is not None:
+            return self.get_documents(1)[0]
         return self.dataset[self.py_rng.randint(0, len(self.dataset) - 1)]["text"]
+
+    def get_documents(self, n_documents: int) -> List[str]:
+        return self.get_documents_by_ids(self.sample_document_ids(n_documents))
+
+    def sample_document_ids(self, n_documents: int) -> np.ndarray:
+        if self.sampler is not None:
+            return self.sampler.sample(n_documents)
+        if self.token_weighted_sampling:
+            positions = self.np_rng.integers(0, self.total_tokens, n_documents)
+            return np.searchsorted(self.token_offsets, positions, side="right") - 1
+        return self.np_rng.integers(0, len(self.dataset), n_documents)
+
+    def get_documents_by_ids(self, document_ids: np.ndarray) -> List[str]:
+        return self.dataset[document_ids.tolist()]["text"]
+
+    def _n_sampling_positions(self) -> int:
+        return len(self.dataset)
+
+
+class TokenShardDataset(AbstractDataset):
+    """
+    Pre-tokenized dataset stored in the format from lizrd/text/token_shards.py.
+    It has no text, only windows of token ids (get_window), for TokenShardGPTPacker.
+    """
+
+    def __init__(
+        self,
+        dataset_path: str,
+        seed: Optional[int] = None,
+    ):
+        super().__init__(seed=seed)
+        self.shards = TokenShards(dataset_path)
+        self.separator_id = self.shards.separator_id
+        self.tokenizer_name = self.shards.manifest["tokenizer"]
+
+    @property
+    def total_tokens(self) -> int:
+        return self.shards.n_tokens
+
+    def get_document(self) -> str:
+        raise TypeError(
+            "TokenShardDataset has no text documents, it can only be used with TokenShardGPTPacker"
+        )
+
+    def get_window(self, length: int) -> np.ndarray:
+        """Returns a memmap view of `length` consecutive tokens, documents separated by separator_id."""
+        shard_sizes = np.where(
+            self.shards.shard_n_tokens >= length, self.shards.shard_n_tokens, 0
+        )
+        assert shard_sizes.sum() > 0, f"No shard contains {length} tokens"
+        shard_idx = self._sample_shard(shard_sizes)
+        start = self.py_rng.randint(0, int(shard_sizes[shard_idx]) - length)
+        return self.shards.tokens(shard_idx)[start : start + length]
+
+    def _sample_shard(self, shard_sizes: np.ndarray) -> int:
+        # sample proportionally to size, so that every token is equally likely
+        if len(shard_sizes) == 1:
+            return 0
+        return int(
+            self.np_rng.choice(len(shard_sizes), p=shard_sizes / shard_sizes.sum())
+        )
+
+
+LOCAL_CORPUS_FORMATS = (".jsonl", ".json", ".parquet", ".txt")
+LOCAL_CORPUS_COMPRESSIONS = (".gz", ".zst", ".zstd")
+
+
+def _split_compression(path: str) -> Tuple[str, Optional[str]]:
+    root, extension = os.path.splitext(path)
+    if extension in LOCAL_CORPUS_COMPRESSIONS:
+        return root, extension
+    return path, None
+
+
+def list_local_corpus_files(dataset_path: str) -> List[str]:
+    """dataset_path is a directory (searched recursively), a single file or a glob pattern."""
+    if os.path.isdir(dataset_path):
+        candidates = glob.glob(os.path.join(dataset_path, "**", "*"), recursive=True)
+    else:
+        candidates = glob.glob(dataset_path)
+    files = sorted(
+        path
+        for path in candidates
+        if os.path.isfile(path)
+        and os.path.splitext(_split_compression(path)[0])[1] in LOCAL_CORPUS_FORMATS
+    )
+    if len(files) == 0:
+        raise ValueError(f"No .jsonl, .parquet or .txt files found at {dataset_path}")
+    return files
+
+
+def _open_binary(path: str, compression: Optional[str]) -> io.RawIOBase:
+    if compression is None:
+        return open(path, "rb", buffering=0)
+    if compression == ".gz":
+        return gzip.open(path, "rb")
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(f"Reading {path} requires the zstandard package") from e
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+
+
+def read_local_corpus_file(
+    path: str,
+    text_field: str = "text",
+    read_buffer_bytes: int = 2**23,
+    keep: Callable[[int], bool] = lambda index: True,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (index in file, text) of the documents for which keep(index) is true.
+    Skipped documents are not decoded, so resuming in the middle of a file is cheap.
+    .jsonl and .txt files hold one document per line, .parquet files one per row.
+    """
+    path_without_compression, compression = _split_compression(path)
+    file_format = os.path.splitext(path_without_compression)[1]
+
+    if file_format == ".parquet":
+        if compression is not None:
+            raise ValueError(f"Parquet files are compressed internally, got {path}")
+        import pyarrow.parquet as pq
+
+        index = 0
+        for record_batch in pq.ParquetFile(path).iter_batches(
+            batch_size=4096, columns=[text_field]
+        ):
+            texts = record_batch.column(0)
+            for i in range(len(texts)):
+                if keep(index):
+                    yield index, texts[i].as_py()
+                index += 1
+        return
+
+    with io.TextIOWrapper(
+        io.BufferedReader(
+            _open_binary(path, compression), buffer_size=read_buffer_bytes
+        ),
+        encoding="utf-8",
+    ) as f:
+        index = 0
+        while True:
+            lines = f.readlines(read_buffer_bytes)
+            if len(lines) == 0:
+                return
+            for line in lines:
+                if line.isspace():
+                    continue
+                if keep(index):
+                    if file_format == ".txt":
+                        yield index, line.rstrip("\n")
+                    else:
+                        yield index, json.loads(line)[text_field]
+                index += 1
+
+
+class LocalCorpusDataset(AbstractDataset):
+    """
+    Streams documents from local .jsonl, .parquet or .txt files, optionally .gz or .zst compressed,
+    so in-house corpora can be used without converting them to the HF format.
+
+    Files are read sequentially, in a new order every epoch, and documents are shuffled
+    in blocks of shuffle_buffer_size consecutive documents.
+    Every shard (see set_shard) reads a disjoint part of the corpus: shard_by="files" gives each shard
+    its own files, shard_by="documents" makes every shard read all files and keep every n_shards-th document.
+    "auto" shards by files whenever there are at least as many files as shards.
+
+    The state points to the start of the current block, resuming reads and shuffles it again
+    and skips the documents already taken from it, so the resumed stream is exactly the same.
+    """
+
+    def __init__(
+        self,
+        dataset_path: str,
+        seed: Optional[int] = None,
+        text_field: str = "text",
+        shuffle_buffer_size: int = 10_000,
+        shard_by: Literal["auto", "files", "documents"] = "auto",
+        read_buffer_bytes: int = 2**23,
+    ):
+        self.files = list_local_corpus_files(dataset_path)
+        self.name = f"local-{os.path.abspath(dataset_path)}"
+        self.text_field = text_field
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shard_by = shard_by
+        self.read_buffer_bytes = read_buffer_bytes
+        self.shard_index = 0
+        self.n_shards = 1
+        super().__init__(seed=seed)
+
+    def set_rng(self, seed: Optional[int] = None):
+        super().set_rng(seed)
+        self.stream_seed = int(self.np_rng.integers(2**62))
+        self._reset_stream()
+
+    def set_shard(self, shard_index: int, n_shards: int):
+        if self._shard_files(n_shards) and len(self.files) < n_shards:
+            raise ValueError(
+                f"Can't shard {len(self.files)} files into {n_shards} shards by files"
+            )
+        self.shard_index = shard_index
+        self.n_shards = n_shards
+        self._reset_stream()
+
+    def state_dict(self) -> dict:
+        return {
+            **super().state_dict(),
+            "stream_seed": self.stream_seed,
+            **(self._block_start or self._reader_position()),
+            "documents_taken_from_block": self.documents_taken_from_block,
+        }
+
+    def load_state_dict(self, state: dict):
+        super().load_state_dict(state)
+        self._reset_stream()
+        self.stream_seed = state["stream_seed"]
+        self.epoch = state["epoch"]
+        self.file_cursor = state["file_cursor"]
+        self.documents_read_from_file = state["documents_read_from_file"]
+        self.documents_taken_from_block = state.get("documents_taken_from_block", 0)
+
+    def get_document(self) -> str:
+        return self.get_documents(1)[0]
+
+    def get_documents(self, n_documents: int) -> List[str]:
+        if self._stream is None:
+            self._stream = self._shuffled_documents()
+        return list(itertools.islice(self._stream, n_documents))
+
+    def _reset_stream(self):
+        self._stream = None
+        self.epoch = 0
+        self.file_cursor = 0
+        self.documents_read_from_file = 0
+        # reader position at the start of the current shuffle block, None when not shuffling
+        self._block_start: Optional[dict] = None
+        self.documents_taken_from_block = 0
+
+    def _reader_position(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "file_cursor": self.file_cursor,
+            "documents_read_from_file": self.documents_read_from_file,
+        }
+
+    def _shard_files(self, n_shards: int) -> bool:
+        if self.shard_by == "auto":
+            return len(self.files) >= n_shards
+        return self.shard_by == "files"
+
+    def _epoch_files(self) -> List[str]:
+        if self._shard_files(self.n_shards):
+            files = self.files[self.shard_index :: self.n_shards]
+        else:
+            files = self.files
+        order = np.random.default_rng([self.stream_seed, self.epoch]).permutation(
+            len(files)
+        )
+        return [files[i] for i in order]
+
+    def _documents(self) -> Iterator[str]:
+        shard_documents = not self._shard_files(self.n_shards)
+        while True:
+            resumed = self.file_cursor > 0 or self.documents_read_from_file > 0
+            documents_in_epoch = 0
+            files = self._epoch_files()
+            while self.file_cursor < len(files):
+                skip = self.documents_read_from_file
+                for index, text in read_local_corpus_file(
+                    files[self.file_cursor],
+                    self.text_field,
+                    self.read_buffer_bytes,
+                    keep=lambda index: index >= skip
+                    and (
+                        not shard_documents or index % self.n_shards == self.shard_index
+                    ),
+                ):
+                    self.documents_read_from_file = index + 1
+                    documents_in_epoch += 1
+                    yield text
+                self.file_cursor += 1
+                self.documents_read_from_file = 0
+            if documents_in_epoch == 0 and not resumed:
+                raise ValueError(
+                    f"Shard {self.shard_index}/{self.n_shards} of {self.name} has no documents"
+                )
+            self.epoch += 1
+            self.file_cursor = 0
+
+    def _shuffled_documents(self) -> Iterator[str]:
+        documents = self._documents()
+        if self.shuffle_buffer_size <= 1:
+            yield from documents
+            return
+        while True:
+            self._block_start = self._reader_position()
+            block = list(itertools.islice(documents, self.shuffle_buffer_size))
+            # the order only depends on where the block starts, so it is the same after resuming
+            order = np.random.default_rng(
+                [self.stream_seed, *self._block_start.values()]
+            ).permutation(len(block))
+            for i in order[self.documents_taken_from_block :]:
+                self.documents_taken_from_block += 1
+                yield block[i]
+            self.documents_taken_from_block = 0
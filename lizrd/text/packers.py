@@ -1,20 +1,20 @@
 from abc import ABC, abstractmethod
-import itertools
 import random
-from typing import Callable, Iterator, List, Optional, Tuple
+from typing import Callable, Iterator, List, Optional
 from attr import define
 
 import numpy as np
+import torch
 from torch.utils.data import IterableDataset
 
-from lizrd.text.datasets import AbstractDataset
-from lizrd.text.data import LLMExample
-from lizrd.text.tokenizers import AbstractTokenizer, BertTokenizer
+from lizrd.text.datasets import AbstractDataset, TokenShardDataset
+from lizrd.text.data import LLMBatch, LLMExample, LOSS_MASK_DTYPE, TOKEN_DTYPE
+from lizrd.text.tokenization_cache import TokenizationCache
+from lizrd.text.tokenizers import AbstractTokenizer
 
 
-def take_circular(iterable, start, stop):
-    cycle = itertools.cycle(iterable)
-    return itertools.islice(cycle, start, stop)
+def take_circular(array: np.ndarray, start: int, stop: int) -> np.ndarray:
+    return np.take(array, np.arange(start, stop), mode="wrap")
 
 
 class AbstractPacker(ABC, IterableDataset):
@@ -24,6 +24,8 @@ class AbstractPacker(ABC, IterableDataset):
         dataset_maker: Callable[[], AbstractDataset],
         tokenizer_maker: Callable[[], AbstractTokenizer],
         seed: Optional[int] = None,
+        document_buffer_size: int = 32,
+        tokenization_cache: Optional[TokenizationCache] = None,
     ):
         super().__init__()
         self._tokenizer = None
@@ -34,6 +36,12 @@ class AbstractPacker(ABC, IterableDataset):
         self.np_rng = np.random.default_rng(seed)
         self.py_rng = random.Random(seed)
         self.seed = seed
+        self.document_buffer_size = document_buffer_size
+        self.tokenization_cache = tokenization_cache
+        self._document_buffer: List[List[int]] = []
+        # dataset state from right before the last buffer refill, lets us rebuild the buffer instead of saving it
+        self._document_buffer_dataset_state: Optional[dict] = None
+        self.samples_produced = 0
 
     def set_rng(self, seed: Optional[int] = None):
         np_rng = np.random.default_rng(seed)
@@ -43,10 +51,89 @@ class AbstractPacker(ABC, IterableDataset):
         self.py_rng = py_rng
 
         self.dataset.set_rng(seed)
+        self._document_buffer = []
+        self._document_buffer_dataset_state = None
+
+    def get_tokenized_document(self) -> List[int]:
+        """
+        Documents are fetched and tokenized document_buffer_size at a time,
+        with one dataset call and one batched tokenizer call.
+        """
+        if len(self._document_buffer) == 0:
+            self._refill_document_buffer()
+        return self._document_buffer.pop()
+
+    def _refill_document_buffer(self):
+        self._document_buffer_dataset_state = self.dataset.state_dict()
+        if self.tokenization_cache is not None and self.dataset.has_document_ids:
+            doc_ids = self.dataset.sample_document_ids(self.document_buffer_size)
+            self._document_buffer = self._get_tokenized_documents_by_ids(doc_ids)
+        else:
+            documents = self.dataset.get_documents(self.document_buffer_size)
+            self._document_buffer = self.tokenizer.texts_to_ids(documents)
+        self._document_buffer.reverse()
+
+    def _get_tokenized_documents_by_ids(self, doc_ids: np.ndarray) -> List[List[int]]:
+        """With a tokenization cache, only documents missing from it are fetched from the dataset and tokenized."""
+        if self.tokenization_cache is None:
+            texts = self.dataset.get_documents_by_ids(doc_ids)
+            return self.tokenizer.texts_to_ids(texts)
+
+        key_prefix = f"{type(self.tokenizer).__name__}/{self.dataset.name}"
+        keys = [f"{key_prefix}/{doc_id}" for doc_id in doc_ids.tolist()]
+        key_doc_ids = dict(zip(keys, doc_ids.tolist()))
+        tokenized = {key: self.tokenization_cache.get(key) for key in key_doc_ids}
+
+        missing = [key for key, tokens in tokenized.items() if tokens is None]
+        if len(missing) > 0:
+            texts = self.dataset.get_documents_by_ids(
+                np.array([key_doc_ids[key] for key in missing])
+            )
+            for key, tokens in zip(missing, self.tokenizer.texts_to_ids(texts)):
+                self.tokenization_cache.set(key, tokens)
+                tokenized[key] = tokens
+        return [tokenized[key] for key in keys]
+
+    def state_dict(self) -> dict:
+        """
+        Everything needed to continue the stream of samples exactly where it stopped.
+        The document buffer is stored as the dataset state it was fetched with,
+        so the state stays small enough to be sent along with every batch.
+        """
+        if self._document_buffer_dataset_state is None:
+            dataset_state = self.dataset.state_dict()
+            documents_taken_from_buffer = None
+        else:
+            dataset_state = self._document_buffer_dataset_state
+            documents_taken_from_buffer = self.document_buffer_size - len(
+                self._document_buffer
+            )
+        return {
+            "np_rng": self.np_rng.bit_generator.state,
+            "py_rng": self.py_rng.getstate(),
+            "dataset": dataset_state,
+            "documents_taken_from_buffer": documents_taken_from_buffer,
+            "samples_produced": self.samples_produced,
+        }
+
+    def load_state_dict(self, state: dict):
+        self.np_rng.bit_generator.state = state["np_rng"]
+        self.py_rng.setstate(state["py_rng"])
+        self.samples_produced = state["samples_produced"]
+        self.dataset.load_state_dict(state["dataset"])
+        self._document_buffer = []
+        self._document_buffer_dataset_state = None
+        if state["documents_taken_from_buffer"] is not None:
+            self._refill_document_buffer()
+            del self._document_buffer[
+                len(self._document_buffer) - state["documents_taken_from_buffer"] :
+            ]
 
     def __iter__(self) -> Iterator[LLMExample]:
         while True:
-            yield self.get_sample()
+            sample = self.get_sample()
+            self.samples_produced += 1
+            yield sample
 
     @abstractmethod
     def get_sample(self) -> LLMExample:
@@ -81,6 +168,69 @@ class MaskingReplacementConfig:
         ) == 1.0
 
 
+class BatchMasker:
+    """
+    MLM masking of a whole collated batch in one vectorized pass, on whatever device the batch is.
+    Expects batches from BERTPacker, whose input_ids are the raw tokens, same as target_ids.
+
+    Separator tokens are never masked, wherever they are. Masking used to be done per document, before
+    packing, and left out only the separators inserted between documents, so a separator the tokenizer
+    puts inside a document (e.g. the [SEP] at the end of every BERT encoding) could be masked.
+    Those are trivial to predict, and the masking rate of all other tokens is still mask_percentage.
+    """
+
+    NUMBER_OF_SPECIAL_TOKENS = (
+        999  # random replacements are drawn from the rest of the vocabulary
+    )
+
+    def __init__(
+        self,
+        tokenizer_maker: Callable[[], AbstractTokenizer],
+        mask_replace_config: MaskingReplacementConfig = MaskingReplacementConfig(),
+    ):
+        self.tokenizer_maker = tokenizer_maker
+        self.mask_replace_config = mask_replace_config
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self) -> AbstractTokenizer:
+        if self._tokenizer is None:
+            self._tokenizer = self.tokenizer_maker()
+        return self._tokenizer
+
+    def __call__(self, batch: LLMBatch, generator: torch.Generator) -> LLMBatch:
+        mask_id = self.tokenizer.mask_id
+        sep_id = self.tokenizer.sequence_separator_id
+        assert mask_id is not None and sep_id is not None
+        config = self.mask_replace_config
+
+        tokens = batch.target_ids
+        random_kwargs = dict(
+            size=tokens.shape, generator=generator, device=tokens.device
+        )
+
+        is_mask = torch.rand(**random_kwargs) < config.mask_percentage
+        is_mask &= tokens != sep_id
+        how_to_mask = torch.rand(**random_kwargs)
+        replace_with_mask = how_to_mask < config.replace_with_mask
+        replace_with_random = ~replace_with_mask & (
+            how_to_mask < config.replace_with_mask + config.replace_with_random
+        )
+        random_tokens = torch.randint(
+            self.NUMBER_OF_SPECIAL_TOKENS,
+            self.tokenizer.VOCAB_SIZE,
+            dtype=tokens.dtype,
+            **random_kwargs,
+        )
+
+        input_ids = tokens.masked_fill(is_mask & replace_with_mask, mask_id)
+        input_ids = torch.where(is_mask & replace_with_random, random_tokens, input_ids)
+
+        batch.input_ids = input_ids
+        batch.should_calculate_loss = is_mask
+        return batch
+
+
 class BERTPacker(
     AbstractPacker,
 ):
@@ -89,86 +239,47 @@ class BERTPacker(
         sequence_length: int,
         dataset: AbstractDataset,
         tokenizer_maker: Callable[[], AbstractTokenizer],
-        mask_replace_config: MaskingReplacementConfig = MaskingReplacementConfig(),
         seed: Optional[int] = None,
+        document_buffer_size: int = 32,
+        tokenization_cache: Optional[TokenizationCache] = None,
     ):
+        """Samples are not masked here, masking happens on whole batches in BatchMasker."""
         super().__init__(
             sequence_length,
             dataset,
             tokenizer_maker,
             seed=seed,
+            document_buffer_size=document_buffer_size,
+            tokenization_cache=tokenization_cache,
         )
-        self.mask_replace_config = mask_replace_config
 
     def get_sample(self) -> LLMExample:
         """
         Sample examples from the dataset until we reach the desired sequence length.
         """
-        target_ids: List[int] = []
-        input_ids: List[int] = []
-        calculate_loss: List[int] = []
+        buffer: List[int] = []
         document_lengths: List[int] = []
 
         sep_id = self.tokenizer.sequence_separator_id
         assert sep_id is not None
 
         while True:
-            document = self.dataset.get_document()
-            tokens = self.tokenizer.text_to_ids(document)
-            masked_input, is_mask = self._mask_text(tokens)
-
-            target_ids.extend(tokens + [sep_id])
-            input_ids.extend(masked_input + [sep_id])
-            calculate_loss.extend(is_mask + [0])
+            tokens = self.get_tokenized_document()
+            buffer.extend(tokens + [sep_id])
 
             document_lengths.append(len(tokens) + 1)
             if (sum(document_lengths) - max(document_lengths)) > self.sequence_length:
                 break
 
-        sample_start = self.py_rng.randint(0, len(target_ids) - 1)
+        sample_start = self.py_rng.randint(0, len(buffer) - 1)
         sample_end = sample_start + self.sequence_length
 
-        target_ids = list(take_circular(target_ids, sample_start, sample_end))
-        input_ids = list(take_circular(input_ids, sample_start, sample_end))
-        calculate_loss = list(take_circular(calculate_loss, sample_start, sample_end))
-
-        return LLMExample(input_ids, target_ids, calculate_loss)
-
-    def _mask_text(self, tokens: List[int]) -> Tuple[List[int], List[int]]:
-        mask_id = self.tokenizer.mask_id
-        assert mask_id is not None
-
-        is_mask = self.np_rng.binomial(
-            1, self.mask_replace_config.mask_percentage, len(tokens)
-        )
-        how_to_mask = self.np_rng.multinomial(
-            1,
-            [
-                self.mask_replace_config.replace_with_mask,
-                self.mask_replace_config.replace_with_random,
-                self.mask_replace_config.replace_with_original,
-            ],
-            size=len(tokens),
-        ).nonzero()[1]
-        replacements = (
-            (how_to_mask == 0) * mask_id
-            + (how_to_mask == 1) * self._get_valid_random_tokens(len(tokens))
-            + (how_to_mask == 2) * tokens
+        target_ids = take_circular(
+            np.array(buffer, dtype=TOKEN_DTYPE), sample_start, sample_end
         )
+        calculate_loss = np.zeros(self.sequence_length, dtype=LOSS_MASK_DTYPE)
 
-        input_tokens = np.where(is_mask.astype(bool), replacements, tokens)
-
-        return input_tokens.tolist(), is_mask.tolist()
-
-    def _get_valid_random_tokens(self, tokens_count):
-        assert isinstance(self.tokenizer, BertTokenizer)
-        NUMBER_OF_SPECIAL_TOKENS = 999
-        return (
-            self.np_rng.choice(
-                self.tokenizer.VOCAB_SIZE - NUMBER_OF_SPECIAL_TOKENS, tokens_count
-            )
-            + NUMBER_OF_SPECIAL_TOKENS
-        )
+        return LLMExample(target_ids, target_ids, calculate_loss)
 
 
 class GPTPacker(
@@ -180,12 +291,44 @@ class GPTPacker(
         dataset_maker: AbstractDataset,
         tokenizer_maker: Callable[[], AbstractTokenizer],
         seed: Optional[int] = None,
+        document_buffer_size: int = 32,
+        streaming: bool = False,
+        tokenization_cache: Optional[TokenizationCache] = None,
     ):
+        """
+        streaming: instead of taking one random window out of freshly tokenized documents,
+            keep a rolling token buffer and emit consecutive windows from it, so that every
+            tokenized token is trained on exactly once.
+        """
         super().__init__(
             sequence_length,
             dataset_maker,
             tokenizer_maker,
             seed=seed,
+            document_buffer_size=document_buffer_size,
+            tokenization_cache=tokenization_cache,
+        )
+        self.streaming = streaming
+        self._token_buffer: List[int] = []
+        # document ids sampled, but not used by the last _get_indexed_sample, the next one starts with them
+        self._pending_document_ids = np.empty(0, dtype=np.int64)
+
+    def set_rng(self, seed: Optional[int] = None):
+        super().set_rng(seed)
+        self._token_buffer = []
+        self._pending_document_ids = np.empty(0, dtype=np.int64)
+
+    def state_dict(self) -> dict:
+        state = super().state_dict()
+        state["token_buffer"] = np.array(self._token_buffer, dtype=TOKEN_DTYPE)
+        state["pending_document_ids"] = self._pending_document_ids
+        return state
+
+    def load_state_dict(self, state: dict):
+        super().load_state_dict(state)
+        self._token_buffer = state["token_buffer"].tolist()
+        self._pending_document_ids = state.get(
+            "pending_document_ids", np.empty(0, dtype=np.int64)
         )
 
     def get_sample(self) -> LLMExample:
@@ -195,13 +338,17 @@ class GPTPacker(
         eot_id = self.tokenizer.eot_id
         assert eot_id is not None
 
+        if self.streaming:
+            return self._get_streaming_sample(eot_id)
+        if self.dataset.token_offsets is not None:
+            return self._get_indexed_sample(eot_id)
+
         buffer: List[int] = []
         calculate_loss: List[int] = []
         document_lengths: List[int] = []
 
         while True:
-            document = self.dataset.get_document()
-            tokens = self.tokenizer.text_to_ids(document)
+            tokens = self.get_tokenized_document()
             buffer.extend(tokens + [eot_id])
 
             document_lengths.append(len(tokens) + 1)
@@ -211,8 +358,104 @@ class GPTPacker(
         sample_start = self.py_rng.randint(0, len(buffer) - 1)
         sample_end = sample_start + self.sequence_length
 
-        input_ids = list(take_circular(buffer, sample_start, sample_end))
-        target_ids = list(take_circular(buffer, sample_start + 1, sample_end + 1))
-        calculate_loss = [1] * len(target_ids)
+        buffer = np.array(buffer, dtype=TOKEN_DTYPE)
+        input_ids = take_circular(buffer, sample_start, sample_end)
+        target_ids = take_circular(buffer, sample_start + 1, sample_end + 1)
+        calculate_loss = np.ones(self.sequence_length, dtype=LOSS_MASK_DTYPE)
+
+        return LLMExample(input_ids, target_ids, calculate_loss)
+
+    def _get_indexed_sample(self, eot_id: int) -> LLMExample:
+        """
+        Same sample as get_sample, but document lengths come from the dataset's token index,
+        so only the documents that overlap the chosen window are fetched and tokenized.
+        Ids are sampled document_buffer_size at a time, the ones left over are kept for the next sample,
+        so that a sharded sampler goes through its epoch at the pace documents are used.
+        """
+        doc_ids = self._pending_document_ids
+        lengths = self.dataset.get_token_lengths(doc_ids) + 1
+        while True:
+            # the packing loop of get_sample stops at the first document for which this holds
+            enough = np.cumsum(lengths) - np.maximum.accumulate(lengths)
+            enough = np.flatnonzero(enough > self.sequence_length)
+            if len(enough) > 0:
+                self._pending_document_ids = doc_ids[enough[0] + 1 :]
+                doc_ids = doc_ids[: enough[0] + 1]
+                lengths = lengths[: enough[0] + 1]
+                break
+            new_ids = self.dataset.sample_document_ids(self.document_buffer_size)
+            doc_ids = np.concatenate([doc_ids, new_ids])
+            lengths = np.concatenate(
+                [lengths, self.dataset.get_token_lengths(new_ids) + 1]
+            )
+
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        sample_start = self.py_rng.randint(0, int(offsets[-1]) - 1)
+        positions = np.arange(sample_start, sample_start + self.sequence_length + 1)
+        positions %= offsets[-1]
+        position_docs = np.searchsorted(offsets, positions, side="right") - 1
+        # a document whose only position in the window is its eot does not need to be fetched
+        is_eot = positions == offsets[position_docs + 1] - 1
+        needed = np.unique(position_docs[~is_eot])
+
+        tokenized = self._get_tokenized_documents_by_ids(doc_ids[needed])
+        buffer = np.empty(offsets[-1], dtype=TOKEN_DTYPE)
+        buffer[offsets[1:] - 1] = eot_id
+        for i, tokens in zip(needed, tokenized):
+            if len(tokens) + 1 != lengths[i]:
+                raise ValueError(
+                    f"Document {doc_ids[i]} has {len(tokens)} tokens, but {lengths[i] - 1} in the token index, "
+                    "the index was built with a different tokenizer"
+                )
+            buffer[offsets[i] : offsets[i + 1] - 1] = tokens
+
+        window = buffer[positions]
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones(self.sequence_length, dtype=LOSS_MASK_DTYPE)
+
+        return LLMExample(input_ids, target_ids, calculate_loss)
+
+    def _get_streaming_sample(self, eot_id: int) -> LLMExample:
+        # consecutive windows overlap by one token, the last target is the next first input
+        while len(self._token_buffer) < self.sequence_length + 1:
+            self._token_buffer.extend(self.get_tokenized_document() + [eot_id])
+
+        window = np.array(
+            self._token_buffer[: self.sequence_length + 1], dtype=TOKEN_DTYPE
+        )
+        del self._token_buffer[: self.sequence_length]
+
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones(self.sequence_length, dtype=LOSS_MASK_DTYPE)
+
+        return LLMExample(input_ids, target_ids, calculate_loss)
+
+
+class TokenShardGPTPacker(
+    AbstractPacker,
+):
+    """GPT packer over pre-tokenized shards: a sample is a slice of a memmap, no tokenization happens here."""
+
+    def __init__(
+        self,
+        sequence_length: int,
+        dataset_maker: Callable[[], TokenShardDataset],
+        seed: Optional[int] = None,
+    ):
+        super().__init__(
+            sequence_length,
+            dataset_maker,
+            tokenizer_maker=None,
+            seed=seed,
+        )
+
+    def get_sample(self) -> LLMExample:
+        window = self.dataset.get_window(self.sequence_length + 1).astype(TOKEN_DTYPE)
+
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones(self.sequence_length, dtype=LOSS_MASK_DTYPE)
 
         return LLMExample(input_ids, target_ids, calculate_loss)
@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.data import LLMBatch, LLMExample
+
+
+class TestLLMBatch(GeneralTestCase):
+    def test_collation(self):
+        examples = [
+            LLMExample(
+                np.arange(4), np.arange(1, 5), np.array([1, 0, 1, 1], dtype=bool)
+            ),
+            LLMExample([4, 5, 6, 7], [5, 6, 7, 8], [0, 0, 1, 1]),
+        ]
+        batch = LLMBatch(examples)
+
+        self.assertEqual(batch.input_ids.dtype, torch.int32)
+        self.assertEqual(batch.target_ids.dtype, torch.int32)
+        self.assertEqual(batch.should_calculate_loss.dtype, torch.bool)
+        self.assertTensorEqual(
+            batch.input_ids, torch.arange(8, dtype=torch.int32).reshape(2, 4)
+        )
+        self.assertTensorEqual(
+            batch.should_calculate_loss,
+            torch.tensor([[1, 0, 1, 1], [0, 0, 1, 1]], dtype=torch.bool),
+        )
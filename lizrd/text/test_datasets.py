@@ -0,0 +1,220 @@
+import gzip
+import json
+import os
+import tempfile
+from functools import partial
+from unittest.mock import patch
+
+from datasets import Dataset, load_from_disk
+import numpy as np
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.datasets import (
+    C4Dataset,
+    LocalCorpusDataset,
+    ShardedIndexSampler,
+    WikiBookDataset,
+    get_token_index_path,
+    save_token_index,
+)
+from lizrd.text.packers import GPTPacker
+from lizrd.text.test_packers import NumbersTokenizer
+
+
+def make_wikibook(directory, split, n_wiki, n_book):
+    def fake_load_dataset(name, *args, **kwargs):
+        n_documents = n_wiki if name == "wikipedia" else n_book
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            Dataset.from_dict(
+                {"text": [f"{name} {i}" for i in range(n_documents)]}
+            ).save_to_disk(path)
+        return {"train": load_from_disk(path)}
+
+    with patch("lizrd.text.datasets.load_dataset", fake_load_dataset):
+        return WikiBookDataset(seed=0, split=split)
+
+
+class TestWikiBookDataset(GeneralTestCase):
+    def test_split_ids(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for split in ["train", "eval"]:
+                dataset = make_wikibook(directory, split, n_wiki=1000, n_book=300)
+                for split_ids, n_documents in [
+                    (dataset.wiki_ids, 1000),
+                    (dataset.book_ids, 300),
+                ]:
+                    expected = [
+                        i for i in range(n_documents) if dataset._belongs_to_split(i)
+                    ]
+                    self.assertEqual(split_ids.tolist(), expected)
+
+                # wiki documents are drawn from the whole wiki dataset, not from the first len(book) ids
+                documents = dataset.get_documents(2000)
+                wiki_ids = {int(d.split()[1]) for d in documents if "wikipedia" in d}
+                self.assertTrue(all(dataset._belongs_to_split(i) for i in wiki_ids))
+                self.assertGreater(max(wiki_ids), 300)
+
+            # the second dataset of the same split reuses the index saved on disk
+            dataset = make_wikibook(directory, "eval", n_wiki=1000, n_book=300)
+            self.assertIsInstance(dataset.wiki_ids, np.memmap)
+
+
+class TestC4TokenIndex(GeneralTestCase):
+    def test_token_weighted_sampling(self):
+        lengths = np.array([1, 1, 98])
+        with tempfile.TemporaryDirectory() as directory:
+            Dataset.from_dict({"text": ["a", "b", "c " * 98]}).save_to_disk(directory)
+            with self.assertRaises(ValueError):
+                C4Dataset(dataset_path=directory, token_weighted_sampling=True)
+
+            dataset = C4Dataset(dataset_path=directory)
+            save_token_index(get_token_index_path(dataset.dataset, "gpt2"), lengths)
+
+            dataset = C4Dataset(
+                seed=0, dataset_path=directory, token_weighted_sampling=True
+            )
+            self.assertEqual(dataset.total_tokens, 100)
+            self.assertEqual(
+                dataset.get_token_lengths(np.arange(3)).tolist(), [1, 1, 98]
+            )
+            counts = np.bincount(dataset.sample_document_ids(10_000), minlength=3)
+            self.assertGreater(counts[2], 9_500)
+            self.assertEqual(dataset.get_documents(1), ["c " * 98])
+
+
+class TestShardedIndexSampler(GeneralTestCase):
+    def test_disjoint_epochs(self):
+        n_positions, n_shards = 1000, 3
+        samplers = [
+            ShardedIndexSampler(
+                n_positions, i, n_shards, seed=i, block_size=32, buffer_blocks=4
+            )
+            for i in range(n_shards)
+        ]
+        shard_sizes = [len(sampler.blocks) * 32 for sampler in samplers]
+        shard_sizes[-1] -= 32 * 32 - n_positions  # the last block is shorter
+
+        epochs = [
+            sampler.sample(2 * size) for sampler, size in zip(samplers, shard_sizes)
+        ]
+        first_epochs = [epoch[: len(epoch) // 2] for epoch in epochs]
+        self.assertEqual(
+            sorted(np.concatenate(first_epochs).tolist()), list(range(n_positions))
+        )
+        for epoch, size in zip(epochs, shard_sizes):
+            self.assertEqual(sorted(epoch[:size]), sorted(epoch[size:]))
+            self.assertNotEqual(epoch[:size].tolist(), epoch[size:].tolist())
+
+    def test_resume(self):
+        sampler = ShardedIndexSampler(500, seed=0, block_size=16, buffer_blocks=2)
+        sampler.sample(77)
+        state = sampler.state_dict()
+        expected = sampler.sample(600)
+
+        resumed = ShardedIndexSampler(500, seed=1, block_size=16, buffer_blocks=2)
+        resumed.load_state_dict(state)
+        self.assertEqual(resumed.sample(600).tolist(), expected.tolist())
+
+    def test_c4(self):
+        with tempfile.TemporaryDirectory() as directory:
+            texts = [str(i) for i in range(100)]
+            Dataset.from_dict({"text": texts}).save_to_disk(directory)
+            datasets = [
+                C4Dataset(seed=i, dataset_path=directory, sharded_sampling=True)
+                for i in range(2)
+            ]
+            for i, dataset in enumerate(datasets):
+                dataset.set_shard(i, 2)
+            documents = [dataset.get_documents(50) for dataset in datasets]
+            self.assertEqual(sorted(documents[0] + documents[1], key=int), texts)
+
+
+def write_local_corpus(directory, n_documents):
+    """Documents "0" .. str(n_documents - 1) spread over a .jsonl, .jsonl.gz, .txt and .parquet file."""
+    texts = [str(i) for i in range(n_documents)]
+    parts = np.array_split(np.array(texts, dtype=object), 4)
+    with open(os.path.join(directory, "a.jsonl"), "w") as f:
+        f.writelines(json.dumps({"text": text}) + "\n" for text in parts[0])
+    with gzip.open(os.path.join(directory, "b.jsonl.gz"), "wt") as f:
+        f.writelines(json.dumps({"text": text}) + "\n" for text in parts[1])
+    with open(os.path.join(directory, "c.txt"), "w") as f:
+        f.writelines(text + "\n" for text in parts[2])
+    Dataset.from_dict({"text": list(parts[3])}).to_parquet(
+        os.path.join(directory, "d.parquet")
+    )
+    return texts
+
+
+class TestLocalCorpusDataset(GeneralTestCase):
+    def test_reads_every_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            texts = write_local_corpus(directory, 40)
+            dataset = LocalCorpusDataset(directory, seed=0, shuffle_buffer_size=1)
+            documents = dataset.get_documents(80)
+            self.assertEqual(sorted(documents[:40], key=int), texts)
+            self.assertEqual(sorted(documents[40:], key=int), texts)
+            self.assertNotEqual(documents[:40], documents[40:])
+
+            shuffled = LocalCorpusDataset(directory, seed=0, shuffle_buffer_size=8)
+            documents = shuffled.get_documents(100)
+            self.assertEqual(set(documents), set(texts))
+            self.assertNotEqual(documents[:40], dataset.get_documents(40))
+
+    def test_sharding(self):
+        with tempfile.TemporaryDirectory() as directory:
+            texts = write_local_corpus(directory, 40)
+            for shard_by, n_shards in [("files", 2), ("documents", 3)]:
+                documents = []
+                for i in range(n_shards):
+                    dataset = LocalCorpusDataset(
+                        directory, seed=i, shard_by=shard_by, shuffle_buffer_size=4
+                    )
+                    dataset.set_shard(i, n_shards)
+                    # more than an epoch of the shard, every document shows up
+                    documents.append(set(dataset.get_documents(len(texts))))
+                self.assertEqual(set.union(*documents), set(texts))
+                self.assertEqual(sum(len(shard) for shard in documents), len(texts))
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_local_corpus(directory, 40)
+            for shuffle_buffer_size in [1, 8]:
+                dataset = LocalCorpusDataset(
+                    directory, seed=0, shuffle_buffer_size=shuffle_buffer_size
+                )
+                dataset.get_documents(13)
+                state = dataset.state_dict()
+                expected = dataset.get_documents(50)
+
+                resumed = LocalCorpusDataset(
+                    directory, seed=1, shuffle_buffer_size=shuffle_buffer_size
+                )
+                resumed.load_state_dict(state)
+                self.assertEqual(resumed.get_documents(50), expected)
+
+    def test_resume_packer(self):
+        def make_packer():
+            return GPTPacker(
+                4,
+                partial(LocalCorpusDataset, directory, shuffle_buffer_size=8),
+                NumbersTokenizer,
+                seed=0,
+                document_buffer_size=3,
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            write_local_corpus(directory, 40)
+            packer = make_packer()
+            samples = iter(packer)
+            for _ in range(7):
+                next(samples)
+            state = packer.state_dict()
+            expected = [next(samples).input_ids.tolist() for _ in range(30)]
+
+            resumed = make_packer()
+            resumed.load_state_dict(state)
+            samples = iter(resumed)
+            self.assertEqual(
+                [next(samples).input_ids.tolist() for _ in range(30)], expected
+            )
@@ -0,0 +1,268 @@
+import pickle
+import tempfile
+from typing import List
+
+import numpy as np
+import torch
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.datasets import AbstractDataset, ShardedIndexSampler
+from lizrd.text.data import LLMBatch
+from lizrd.text.packers import BatchMasker, BERTPacker, GPTPacker
+from lizrd.text.tokenization_cache import TokenizationCache
+from lizrd.text.tokenizers import AbstractTokenizer
+
+
+class NumbersDataset(AbstractDataset):
+    """Documents are strings of consecutive numbers, e.g. "3 4 5"."""
+
+    def __init__(self, seed=None):
+        super().__init__(seed=seed)
+        self.n_fetches = 0
+
+    def get_document(self) -> str:
+        self.n_fetches += 1
+        start = self.py_rng.randint(1, 100)
+        length = self.py_rng.randint(1, 20)
+        return " ".join(str(i) for i in range(start, start + length))
+
+
+class NumbersTokenizer(AbstractTokenizer):
+    VOCAB_SIZE = 200
+    eot_id = 0
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def text_to_ids(self, text: str) -> List[int]:
+        return [int(token) for token in text.split()]
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        self.n_calls += 1
+        return super().texts_to_ids(texts)
+
+
+class TestGPTPacker(GeneralTestCase):
+    def test_document_buffer(self):
+        packer = GPTPacker(
+            16, NumbersDataset, NumbersTokenizer, seed=0, document_buffer_size=8
+        )
+        for _ in range(10):
+            sample = packer.get_sample()
+            self.assertEqual(len(sample.input_ids), 16)
+            self.assertEqual(
+                sample.input_ids[1:].tolist(), sample.target_ids[:-1].tolist()
+            )
+
+        n_documents = packer.dataset.n_fetches
+        self.assertEqual(n_documents % 8, 0)
+        self.assertEqual(packer.tokenizer.n_calls, n_documents // 8)
+
+    def test_streaming_uses_every_token_once(self):
+        seq_len = 16
+        packer = GPTPacker(seq_len, NumbersDataset, NumbersTokenizer, streaming=True)
+        samples = [packer.get_sample() for _ in range(20)]
+
+        stream = samples[0].input_ids[:1].tolist()
+        for sample in samples:
+            self.assertEqual(sample.input_ids[0], stream[-1])
+            self.assertEqual(
+                sample.input_ids[1:].tolist(), sample.target_ids[:-1].tolist()
+            )
+            stream.extend(sample.target_ids.tolist())
+
+        # the stream is made of whole tokenized documents, each followed by eot
+        document = []
+        for token in stream:
+            if token == NumbersTokenizer.eot_id:
+                self.assertEqual(
+                    document, list(range(document[0], document[0] + len(document)))
+                )
+                document = []
+            else:
+                document.append(token)
+        self.assertLessEqual(len(packer._token_buffer), seq_len + 20)
+
+    def test_resume_from_state(self):
+        for streaming in [False, True]:
+            packer = GPTPacker(
+                16, NumbersDataset, NumbersTokenizer, seed=0, streaming=streaming
+            )
+            for _ in range(7):
+                packer.get_sample()
+            state = pickle.loads(pickle.dumps(packer.state_dict()))
+            expected = [packer.get_sample().input_ids.tolist() for _ in range(10)]
+
+            resumed = GPTPacker(
+                16, NumbersDataset, NumbersTokenizer, seed=1, streaming=streaming
+            )
+            resumed.load_state_dict(state)
+            self.assertEqual(
+                [resumed.get_sample().input_ids.tolist() for _ in range(10)],
+                expected,
+            )
+
+
+class IndexedNumbersDataset(AbstractDataset):
+    """Fixed documents "i i+1 ... " of known lengths, like a dataset with a token index."""
+
+    def __init__(self, seed=None):
+        super().__init__(seed=seed)
+        self.lengths = np.array([3, 50, 1, 7, 12, 2, 30])
+        self.token_offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.fetched_ids = []
+
+    def sample_document_ids(self, n_documents):
+        return self.np_rng.integers(0, len(self.lengths), n_documents)
+
+    def get_documents_by_ids(self, document_ids):
+        self.fetched_ids.extend(document_ids.tolist())
+        return [
+            " ".join(str(100 * i + j) for j in range(1, self.lengths[i] + 1))
+            for i in document_ids
+        ]
+
+
+class TestIndexedGPTPacker(GeneralTestCase):
+    def test_fetches_only_window_documents(self):
+        seq_len = 8
+        packer = GPTPacker(
+            seq_len,
+            IndexedNumbersDataset,
+            NumbersTokenizer,
+            seed=0,
+            document_buffer_size=4,
+        )
+        for _ in range(50):
+            sample = packer.get_sample()
+            self.assertEqual(
+                sample.input_ids[1:].tolist(), sample.target_ids[:-1].tolist()
+            )
+            window = sample.input_ids.tolist() + sample.target_ids[-1:].tolist()
+            # tokens are consecutive within a document, and documents are separated by eot
+            for previous, token in zip(window, window[1:]):
+                if (
+                    previous != NumbersTokenizer.eot_id
+                    and token != NumbersTokenizer.eot_id
+                ):
+                    self.assertEqual(token, previous + 1)
+
+            documents_in_window = {token // 100 for token in window if token != 0}
+            self.assertEqual(set(packer.dataset.fetched_ids), documents_in_window)
+            packer.dataset.fetched_ids = []
+
+    def test_sampler_follows_used_documents(self):
+        n_documents, document_length, seq_len = 50, 4, 8
+        # with documents of equal length, every sample uses seq_len // length + 2 of them
+        documents_per_sample = seq_len // (document_length + 1) + 2
+
+        def make_dataset():
+            dataset = IndexedNumbersDataset(seed=0)
+            dataset.lengths = np.full(n_documents, document_length)
+            dataset.token_offsets = np.concatenate([[0], np.cumsum(dataset.lengths)])
+            dataset.sampler = ShardedIndexSampler(
+                n_documents, block_size=n_documents, buffer_blocks=1
+            )
+            dataset.sample_document_ids = dataset.sampler.sample
+            return dataset
+
+        packer = GPTPacker(
+            seq_len, make_dataset, NumbersTokenizer, seed=0, document_buffer_size=32
+        )
+        for n_samples in range(1, 40):
+            packer.get_sample()
+            sampler = packer.dataset.sampler
+            n_sampled = sampler.epoch * n_documents + sampler.position_in_buffer
+            n_pending = len(packer.state_dict()["pending_document_ids"])
+            self.assertLess(n_pending, 32)
+            self.assertEqual(n_sampled - n_pending, n_samples * documents_per_sample)
+
+
+class MaskingTokenizer(NumbersTokenizer):
+    VOCAB_SIZE = 2000
+    mask_id = 1
+    sequence_separator_id = 2
+
+
+class TestBatchMasker(GeneralTestCase):
+    def test_masking(self):
+        batch_size, seq_len = 64, 128
+        packer = BERTPacker(seq_len, NumbersDataset, MaskingTokenizer, seed=0)
+        batch = LLMBatch([packer.get_sample() for _ in range(batch_size)])
+        self.assertTensorEqual(batch.input_ids, batch.target_ids)
+
+        masker = BatchMasker(MaskingTokenizer)
+        batch = masker(batch, torch.Generator().manual_seed(0))
+        self.assertEqual(batch.input_ids.dtype, torch.int32)
+        self.assertEqual(batch.should_calculate_loss.dtype, torch.bool)
+
+        is_mask = batch.should_calculate_loss
+        is_sep = batch.target_ids == MaskingTokenizer.sequence_separator_id
+        self.assertFalse((is_mask & is_sep).any())
+        self.assertTensorEqual(batch.input_ids[~is_mask], batch.target_ids[~is_mask])
+        self.assertAlmostEqual(is_mask.float().mean().item(), 0.15, delta=0.02)
+
+        masked_input = batch.input_ids[is_mask]
+        replaced_with_mask = (masked_input == MaskingTokenizer.mask_id).float().mean()
+        self.assertAlmostEqual(replaced_with_mask.item(), 0.8, delta=0.05)
+        self.assertTrue(
+            (masked_input[masked_input != MaskingTokenizer.mask_id] > 0).all()
+        )
+
+    def test_separators_inside_documents(self):
+        # every other token is a separator, as if each document ended with one from the tokenizer
+        tokens = torch.full((64, 128), 5, dtype=torch.int32)
+        tokens[:, ::2] = MaskingTokenizer.sequence_separator_id
+        batch = LLMBatch.from_tensors(tokens, tokens.clone(), torch.zeros_like(tokens))
+        batch = BatchMasker(MaskingTokenizer)(batch, torch.Generator().manual_seed(0))
+
+        is_mask = batch.should_calculate_loss
+        self.assertFalse(is_mask[:, ::2].any())
+        self.assertAlmostEqual(is_mask[:, 1::2].float().mean().item(), 0.15, delta=0.02)
+
+
+class FewNumbersDataset(AbstractDataset):
+    """Five documents that are sampled over and over, addressable by id."""
+
+    has_document_ids = True
+    name = "few_numbers"
+
+    def sample_document_ids(self, n_documents):
+        return self.np_rng.integers(0, 5, n_documents)
+
+    def get_documents_by_ids(self, document_ids):
+        return [" ".join(str(10 * i + j) for j in range(1, 6)) for i in document_ids]
+
+    def get_documents(self, n_documents):
+        return self.get_documents_by_ids(self.sample_document_ids(n_documents))
+
+
+class TestTokenizationCache(GeneralTestCase):
+    def test_cache_hits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TokenizationCache(directory, size_limit_bytes=2**20)
+            packers = [
+                GPTPacker(
+                    16,
+                    FewNumbersDataset,
+                    NumbersTokenizer,
+                    seed=0,
+                    document_buffer_size=4,
+                    tokenization_cache=tokenization_cache,
+                )
+                for tokenization_cache in [
+                    None,
+                    cache,
+                    pickle.loads(pickle.dumps(cache)),
+                ]
+            ]
+            for _ in range(10):
+                samples = [packer.get_sample().input_ids.tolist() for packer in packers]
+                self.assertEqual(samples[0], samples[1])
+                self.assertEqual(samples[0], samples[2])
+
+            hits, misses = cache.stats()
+            self.assertEqual(misses, 5)
+            self.assertGreater(hits, 5)
+            # the third packer only ever hits documents tokenized by the second one
+            self.assertEqual(packers[2].tokenizer.n_calls, 0)
@@ -0,0 +1,86 @@
+from functools import partial
+import tempfile
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.data import LLMBatch
+from lizrd.text.datasets import TokenShardDataset
+from lizrd.text.packers import TokenShardGPTPacker
+from lizrd.text.token_shards import (
+    TokenShards,
+    TokenShardWriter,
+    is_token_shard_dir,
+    read_shard_entry,
+)
+
+EOT = 9
+
+
+def write_documents(directory, documents, shard_size_tokens):
+    writer = TokenShardWriter(
+        directory,
+        tokenizer="gpt",
+        vocab_size=10,
+        separator_id=EOT,
+        shard_size_tokens=shard_size_tokens,
+    )
+    for document in documents:
+        writer.add_document(document)
+    return writer.close()
+
+
+class TestTokenShards(GeneralTestCase):
+    def test_roundtrip(self):
+        documents = [[1, 2, 3], [4], [5, 6], [7, 8, 1, 2]]
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = write_documents(directory, documents, shard_size_tokens=5)
+            self.assertTrue(is_token_shard_dir(directory))
+            self.assertEqual(manifest["n_documents"], 4)
+            self.assertEqual(manifest["n_tokens"], 10 + 4)
+            self.assertEqual(manifest["dtype"], "uint16")
+
+            shards = TokenShards(directory)
+            self.assertEqual(len(shards), 2)
+            read_documents = [
+                shards.document(shard_idx, document_idx).tolist()
+                for shard_idx in range(len(shards))
+                for document_idx in range(shards.shard_n_documents[shard_idx])
+            ]
+            self.assertEqual(read_documents, documents)
+            self.assertEqual(shards.tokens(0).tolist(), [1, 2, 3, EOT, 4, EOT])
+            for entry in manifest["shards"]:
+                self.assertEqual(read_shard_entry(directory, entry["name"]), entry)
+            self.assertIsNone(read_shard_entry(directory, "shard_00002"))
+
+            counts = shards.count_tokens(vocab_size=EOT + 1)
+            self.assertEqual(counts[1], 2)
+            self.assertEqual(counts[EOT], 4)
+            self.assertEqual(counts.sum(), 14)
+
+    def test_packer(self):
+        documents = [list(range(1, 9))] * 20
+        seq_len, batch_size = 6, 3
+        with tempfile.TemporaryDirectory() as directory:
+            write_documents(directory, documents, shard_size_tokens=40)
+            packer = TokenShardGPTPacker(
+                seq_len,
+                partial(TokenShardDataset, dataset_path=directory),
+                seed=0,
+            )
+            batch = next(
+                iter(DataLoader(packer, batch_size=batch_size, collate_fn=LLMBatch))
+            )
+            self.assertShape(batch.input_ids, (batch_size, seq_len))
+            self.assertTensorEqual(batch.input_ids[:, 1:], batch.target_ids[:, :-1])
+            with self.assertRaises(TypeError):
+                packer.dataset.get_document()
+            stream = np.array(([*range(1, 9), EOT]) * 3)
+            for row in batch.input_ids.tolist():
+                self.assertTrue(
+                    any(
+                        stream[start : start + seq_len].tolist() == row
+                        for start in range(9)
+                    )
+                )
@@ -0,0 +1,229 @@
+"""On-disk format for pre-tokenized datasets.
+
+A token shard directory contains:
+    manifest.json            - tokenizer, dtype, separator id and per-shard sizes
+    shard_XXXXX.tokens       - flat array of token ids, every document followed by the separator
+    shard_XXXXX.offsets      - int64 array of n_documents + 1 document start offsets into .tokens
+
+Shards are read with np.memmap, so serving a sample is a slice of the page cache
+and no tokenization happens at train time.
+"""
+import json
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+MANIFEST_FILENAME = "manifest.json"
+TOKENS_SUFFIX = ".tokens"
+OFFSETS_SUFFIX = ".offsets"
+FORMAT_VERSION = 1
+
+
+def get_token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= 2**16 else np.dtype(np.uint32)
+
+
+def get_shard_name(shard_idx: int) -> str:
+    return f"shard_{shard_idx:05d}"
+
+
+def is_token_shard_dir(path: Optional[str]) -> bool:
+    return path is not None and os.path.isfile(os.path.join(path, MANIFEST_FILENAME))
+
+
+def read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    assert (
+        manifest["format_version"] == FORMAT_VERSION
+    ), f"Unsupported token shard format version: {manifest['format_version']}"
+    return manifest
+
+
+def write_manifest(
+    directory: str,
+    tokenizer: str,
+    vocab_size: int,
+    separator_id: int,
+    shards: List[dict],
+    **extra,
+) -> dict:
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "tokenizer": tokenizer,
+        "vocab_size": vocab_size,
+        "dtype": get_token_dtype(vocab_size).name,
+        "separator_id": separator_id,
+        "n_documents": sum(shard["n_documents"] for shard in shards),
+        "n_tokens": sum(shard["n_tokens"] for shard in shards),
+        "shards": shards,
+        **extra,
+    }
+    # write to a temporary file first, so that a partially written manifest is never read
+    tmp_path = os.path.join(directory, MANIFEST_FILENAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_FILENAME))
+    return manifest
+
+
+def write_shard(
+    directory: str,
+    shard_name: str,
+    documents: Iterable[List[int]],
+    separator_id: int,
+    dtype: np.dtype,
+) -> dict:
+    """Writes tokenized documents as a single shard and returns its manifest entry."""
+    offsets = [0]
+    tokens_path = os.path.join(directory, shard_name + TOKENS_SUFFIX)
+    with open(tokens_path + ".tmp", "wb") as f:
+        for document in documents:
+            array = np.empty(len(document) + 1, dtype=dtype)
+            array[:-1] = document
+            array[-1] = separator_id
+            array.tofile(f)
+            offsets.append(offsets[-1] + len(array))
+    np.array(offsets, dtype=np.int64).tofile(
+        os.path.join(directory, shard_name + OFFSETS_SUFFIX)
+    )
+    os.replace(tokens_path + ".tmp", tokens_path)
+    return {
+        "name": shard_name,
+        "n_documents": len(offsets) - 1,
+        "n_tokens": offsets[-1],
+    }
+
+
+def read_shard_entry(directory: str, shard_name: str) -> Optional[dict]:
+    """Manifest entry of a shard already written by write_shard, None if it is missing or unfinished."""
+    # write_shard renames the .tokens file into place last, so its presence means the shard is complete
+    if not os.path.isfile(os.path.join(directory, shard_name + TOKENS_SUFFIX)):
+        return None
+    offsets = np.fromfile(
+        os.path.join(directory, shard_name + OFFSETS_SUFFIX), dtype=np.int64
+    )
+    return {
+        "name": shard_name,
+        "n_documents": len(offsets) - 1,
+        "n_tokens": int(offsets[-1]),
+    }
+
+
+class TokenShardWriter:
+    """Accumulates tokenized documents and rolls them into shards of roughly shard_size_tokens tokens."""
+
+    def __init__(
+        self,
+        directory: str,
+        tokenizer: str,
+        vocab_size: int,
+        separator_id: int,
+        shard_size_tokens: int = 2**28,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tokenizer = tokenizer
+        self.vocab_size = vocab_size
+        self.separator_id = separator_id
+        self.shard_size_tokens = shard_size_tokens
+        self.dtype = get_token_dtype(vocab_size)
+        self.shards: List[dict] = []
+        self._pending: List[List[int]] = []
+        self._pending_tokens = 0
+
+    def add_document(self, token_ids: List[int]):
+        self._pending.append(token_ids)
+        self._pending_tokens += len(token_ids) + 1
+        if self._pending_tokens >= self.shard_size_tokens:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        self.shards.append(
+            write_shard(
+                self.directory,
+                get_shard_name(len(self.shards)),
+                self._pending,
+                self.separator_id,
+                self.dtype,
+            )
+        )
+        self._pending = []
+        self._pending_tokens = 0
+
+    def close(self) -> dict:
+        self.flush()
+        return write_manifest(
+            self.directory,
+            tokenizer=self.tokenizer,
+            vocab_size=self.vocab_size,
+            separator_id=self.separator_id,
+            shards=self.shards,
+        )
+
+
+class TokenShards:
+    """Read-only view of a token shard directory. Memmaps are opened lazily and never pickled."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.dtype = np.dtype(self.manifest["dtype"])
+        self.separator_id: int = self.manifest["separator_id"]
+        self.shard_n_tokens = np.array(
+            [shard["n_tokens"] for shard in self.manifest["shards"]], dtype=np.int64
+        )
+        self.shard_n_documents = np.array(
+            [shard["n_documents"] for shard in self.manifest["shards"]], dtype=np.int64
+        )
+        self._tokens: List[Optional[np.memmap]] = [None] * len(self)
+        self._offsets: List[Optional[np.memmap]] = [None] * len(self)
+
+    def __len__(self) -> int:
+        return len(self.manifest["shards"])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = [None] * len(self)
+        state["_offsets"] = [None] * len(self)
+        return state
+
+    @property
+    def n_tokens(self) -> int:
+        return int(self.shard_n_tokens.sum())
+
+    @property
+    def n_documents(self) -> int:
+        return int(self.shard_n_documents.sum())
+
+    def tokens(self, shard_idx: int) -> np.memmap:
+        if self._tokens[shard_idx] is None:
+            self._tokens[shard_idx] = self._open(shard_idx, TOKENS_SUFFIX, self.dtype)
+        return self._tokens[shard_idx]
+
+    def offsets(self, shard_idx: int) -> np.memmap:
+        if self._offsets[shard_idx] is None:
+            self._offsets[shard_idx] = self._open(shard_idx, OFFSETS_SUFFIX, np.int64)
+        return self._offsets[shard_idx]
+
+    def count_tokens(self, vocab_size: int) -> np.ndarray:
+        """Occurrences of every token id in all shards, separators included."""
+        counts = np.zeros(vocab_size, dtype=np.int64)
+        for shard_idx in range(len(self)):
+            counts += np.bincount(self.tokens(shard_idx), minlength=vocab_size)
+        return counts
+
+    def document(self, shard_idx: int, document_idx: int) -> np.ndarray:
+        """Returns token ids of a document, without the trailing separator."""
+        offsets = self.offsets(shard_idx)
+        start, end = offsets[document_idx], offsets[document_idx + 1]
+        return self.tokens(shard_idx)[start : end - 1]
+
+    def _open(self, shard_idx: int, suffix: str, dtype) -> np.memmap:
+        name = self.manifest["shards"][shard_idx]["name"]
+        return np.memmap(
+            os.path.join(self.directory, name + suffix), dtype=dtype, mode="r"
+        )
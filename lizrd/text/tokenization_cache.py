@@ -0,0 +1,49 @@
+from typing import List, Optional, Tuple
+
+from diskcache import Cache
+import numpy as np
+
+from lizrd.text.data import TOKEN_DTYPE
+
+
+class TokenizationCache:
+    """
+    Tokenized documents shared by all dataloader workers (and runs) on a machine.
+    Backed by diskcache in a directory that should be on tmpfs (e.g. /dev/shm), so lookups are
+    shared memory reads. The size is bounded, least recently used documents are evicted first.
+    """
+
+    def __init__(self, directory: str, size_limit_bytes: int = 2**32):
+        self.directory = directory
+        self.size_limit_bytes = size_limit_bytes
+        self._cache = None
+
+    def __getstate__(self):
+        # sqlite connections can't be sent to workers, every process opens its own
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+
+    @property
+    def cache(self) -> Cache:
+        if self._cache is None:
+            self._cache = Cache(
+                self.directory,
+                size_limit=self.size_limit_bytes,
+                eviction_policy="least-recently-used",
+                statistics=1,
+            )
+        return self._cache
+
+    def get(self, key: str) -> Optional[List[int]]:
+        tokens = self.cache.get(key)
+        if tokens is None:
+            return None
+        return np.frombuffer(tokens, dtype=TOKEN_DTYPE).tolist()
+
+    def set(self, key: str, tokens: List[int]):
+        self.cache.set(key, np.array(tokens, dtype=TOKEN_DTYPE).tobytes())
+
+    def stats(self) -> Tuple[int, int]:
+        """(hits, misses) of all processes using the cache directory, since it was created."""
+        return self.cache.stats()
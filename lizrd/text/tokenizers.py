@@ -14,6 +14,9 @@ class AbstractTokenizer(ABC):
     def text_to_ids(self, text: str) -> List[int]:
         raise NotImplementedError()
 
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return [self.text_to_ids(text) for text in texts]
+
 
 def disable_tokenizer_warnings(hf_tokenizer):
     # set model max length to high number to disable warnings
@@ -36,6 +39,10 @@ class BertTokenizer(AbstractTokenizer):
         # TODO: encode or tokenize + convert_tokens_to_ids?
         return self.tokenizer.encode(text)
 
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        # batched call goes through the multithreaded encode_batch of the fast tokenizer
+        return self.tokenizer(texts)["input_ids"]
+
 
 class GPTTokenizer(AbstractTokenizer):
     VOCAB_SIZE = 50257
@@ -50,3 +57,6 @@ class GPTTokenizer(AbstractTokenizer):
     def text_to_ids(self, text: str) -> List[int]:
         # TODO: encode or tokenize + convert_tokens_to_ids?
         return self.tokenizer.encode(text)
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts)["input_ids"]
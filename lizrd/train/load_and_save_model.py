@@ -66,7 +66,9 @@ def save_checkpoint(
     path: str,
     rank: int,
     step: int,
+    data_state=None,
 ):
+    """data_state: this rank's data pipeline state, the checkpoint stores a list of them indexed by rank"""
     if rank == 0 or rank is None:
         print(f"Saving weights...")
     if isinstance(model, FSDP):
@@ -78,11 +80,18 @@ def save_checkpoint(
         model_state_dict = model.state_dict()
         optimizer_state_dict = optimizer.state_dict()
 
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        data_states = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(data_states, data_state)
+    else:
+        data_states = [data_state]
+
     if rank == 0 or rank is None:
         checkpoint = {
             "model": model_state_dict,
             "optimizer": optimizer_state_dict,
             "step": step,
+            "data_state": data_states,
         }
         if scaler is not None:
             checkpoint["scaler"] = scaler.state_dict()
@@ -1,6 +1,6 @@
 from abc import ABC
 import math
-from typing import Optional
+from typing import Literal, Optional
 
 from torch.optim import Optimizer
 
@@ -93,3 +93,107 @@ class CosineScheduler(AbstractLRScheduler):
             )
         else:
             return self.lr * self.final_lr_fraction
+
+
+def get_sequence_length_scheduler(args) -> Optional["SequenceLengthScheduler"]:
+    if args.sequence_length_warmup_steps == 0:
+        return None
+    return SequenceLengthScheduler(
+        initial_length=args.initial_sequence_length,
+        final_length=args.cutoff,
+        warmup_steps=args.sequence_length_warmup_steps,
+    )
+
+
+class SequenceLengthScheduler:
+    """
+    Sequence length warmup, the length grows linearly from initial_length to final_length over warmup_steps.
+    Lengths are rounded down to divisors of final_length, so full-length sequences split evenly
+    into shorter ones (see LLMBatch.split_sequences) and the number of tokens per batch stays the same.
+    """
+
+    def __init__(self, initial_length: int, final_length: int, warmup_steps: int):
+        assert 0 < initial_length <= final_length
+        self.initial_length = initial_length
+        self.final_length = final_length
+        self.warmup_steps = warmup_steps
+        self.lengths = [
+            length
+            for length in range(initial_length, final_length + 1)
+            if final_length % length == 0
+        ]
+
+    def get_length(self, step: int) -> int:
+        if step >= self.warmup_steps:
+            return self.final_length
+        target = (
+            self.initial_length
+            + (self.final_length - self.initial_length) * step / self.warmup_steps
+        )
+        shorter = [length for length in self.lengths if length <= target]
+        return shorter[-1] if len(shorter) > 0 else self.lengths[0]
+
+
+def get_batch_size_scheduler(args) -> Optional["BatchSizeScheduler"]:
+    if args.batch_size_ramp_steps == 0:
+        return None
+    return BatchSizeScheduler(
+        initial_micro_batches=max(
+            1,
+            round(
+                args.initial_batch_size
+                / args.batch_size
+                * args.gradient_accumulation_steps
+            ),
+        ),
+        final_micro_batches=args.gradient_accumulation_steps,
+        ramp_steps=args.batch_size_ramp_steps,
+    )
+
+
+class BatchSizeScheduler:
+    """
+    Batch size ramp, the number of micro-batches accumulated per optimizer step grows linearly
+    from initial_micro_batches to final_micro_batches over ramp_steps.
+    """
+
+    def __init__(
+        self, initial_micro_batches: int, final_micro_batches: int, ramp_steps: int
+    ):
+        assert 0 < initial_micro_batches <= final_micro_batches
+        self.initial_micro_batches = initial_micro_batches
+        self.final_micro_batches = final_micro_batches
+        self.ramp_steps = ramp_steps
+
+    def get_n_micro_batches(self, step: int) -> int:
+        if step >= self.ramp_steps:
+            return self.final_micro_batches
+        return self.initial_micro_batches + int(
+            (self.final_micro_batches - self.initial_micro_batches)
+            * step
+            / self.ramp_steps
+        )
+
+    def get_batch_size_fraction(self, step: int) -> float:
+        return self.get_n_micro_batches(step) / self.final_micro_batches
+
+
+class BatchSizeCoupledLRScheduler(AbstractLRScheduler):
+    """Scales the learning rate of lr_scheduler with the batch size, linearly or with its square root."""
+
+    def __init__(
+        self,
+        lr_scheduler: AbstractLRScheduler,
+        batch_size_scheduler: BatchSizeScheduler,
+        coupling: Literal["linear", "sqrt"],
+    ):
+        super().__init__(ratios=lr_scheduler.ratios)
+        self.lr_scheduler = lr_scheduler
+        self.batch_size_scheduler = batch_size_scheduler
+        self.coupling = coupling
+
+    def get_lr(self, step: int):
+        fraction = self.batch_size_scheduler.get_batch_size_fraction(step)
+        if self.coupling == "sqrt":
+            fraction = math.sqrt(fraction)
+        return self.lr_scheduler.get_lr(step) * fraction
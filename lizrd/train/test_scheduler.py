@@ -4,7 +4,13 @@ from torch.optim import AdamW
 from torch.nn import Linear
 
 from lizrd.support.test_utils import GeneralTestCase
-from lizrd.train.scheduler import ConstantScheduler, CosineScheduler
+from lizrd.train.scheduler import (
+    BatchSizeCoupledLRScheduler,
+    BatchSizeScheduler,
+    ConstantScheduler,
+    CosineScheduler,
+    SequenceLengthScheduler,
+)
 
 
 class TestSchedulers(GeneralTestCase):
@@ -60,3 +66,32 @@ class TestSchedulers(GeneralTestCase):
                 assert math.isclose(optim.param_groups[0]["lr"], 0.01, abs_tol=1e-6)
             elif step == 99:
                 assert math.isclose(optim.param_groups[0]["lr"], 0.01, abs_tol=1e-6)
+
+    def test_sequence_length_scheduler(self):
+        scheduler = SequenceLengthScheduler(
+            initial_length=60, final_length=512, warmup_steps=100
+        )
+        lengths = [scheduler.get_length(step) for step in range(120)]
+        self.assertEqual(lengths[0], 64)
+        self.assertEqual(lengths[100:], [512] * 20)
+        self.assertEqual(sorted(lengths), lengths)
+        self.assertEqual(set(lengths), {64, 128, 256, 512})
+
+    def test_batch_size_scheduler(self):
+        batch_size_scheduler = BatchSizeScheduler(
+            initial_micro_batches=2, final_micro_batches=8, ramp_steps=60
+        )
+        n_micro_batches = [
+            batch_size_scheduler.get_n_micro_batches(step) for step in range(80)
+        ]
+        self.assertEqual(n_micro_batches[0], 2)
+        self.assertEqual(n_micro_batches[60:], [8] * 20)
+        self.assertEqual(sorted(n_micro_batches), n_micro_batches)
+
+        lr_scheduler = BatchSizeCoupledLRScheduler(
+            ConstantScheduler(lr_warmup_steps=0, lr=0.1, ratios=[1.0]),
+            batch_size_scheduler,
+            coupling="linear",
+        )
+        assert math.isclose(lr_scheduler.get_lr(0), 0.1 * 2 / 8)
+        assert math.isclose(lr_scheduler.get_lr(70), 0.1)
@@ -34,6 +34,7 @@ def get_model(
     residual_fn: Callable[[], torch.nn.Module] = None,
     include_positional_embedding: bool = True,
     checkpoint: dict[str, torch.Tensor] = None,
+    head_fn: Optional[Callable[[], torch.nn.Module]] = None,
 ):
     if model_fragmentation is None or device == torch.device("cpu"):
         first_gpu = device
@@ -65,9 +66,13 @@ def get_model(
         residual_fn=residual_fn,
     )
 
-    head = llm.PredictionHead(
-        dm, vocab_size, init_type=init_type, init_scale=init_scale
-    ).to(last_gpu)
+    if head_fn is None:
+        head = llm.PredictionHead(
+            dm, vocab_size, init_type=init_type, init_scale=init_scale
+        )
+    else:
+        head = head_fn()
+    head = head.to(last_gpu)
 
     model = llm.LLM(embedding_layer, encoder_tower, head)
 
@@ -4,6 +4,8 @@ import numpy as np
 import torch
 from attr import dataclass
 
+from research.blanks.utils import make_blanks_attention_mask_batch
+
 
 @dataclass
 class BlanxExample(object):
@@ -12,7 +14,9 @@ class BlanxExample(object):
     should_calculate_loss: List[
         int
     ]  # e.g. in BERT loss is not calculated over non-masked tokens
-    attention_mask: np.ndarray
+    # the attention mask is described by these two, see make_blanks_attention_mask
+    blank_insertion_point: int
+    n_blanks: int
 
 
 class BlanxBatch:
@@ -24,9 +28,10 @@ class BlanxBatch:
         self.should_calculate_loss = self._make_tensor(
             [example.should_calculate_loss for example in examples]
         )
-        self.attention_mask = torch.from_numpy(
-            np.stack([example.attention_mask for example in examples])
+        self.blank_insertion_points = torch.tensor(
+            [example.blank_insertion_point for example in examples]
         )
+        self.n_blanks = torch.tensor([example.n_blanks for example in examples])
 
         assert self.input_ids.shape == self.target_ids.shape
         assert self.input_ids.shape == self.should_calculate_loss.shape
@@ -36,8 +41,17 @@ class BlanxBatch:
         self.input_ids = self.input_ids.pin_memory()
         self.target_ids = self.target_ids.pin_memory()
         self.should_calculate_loss = self.should_calculate_loss.pin_memory()
+        self.blank_insertion_points = self.blank_insertion_points.pin_memory()
+        self.n_blanks = self.n_blanks.pin_memory()
         return self
 
+    @property
+    def attention_mask(self) -> torch.Tensor:
+        """(batch, seq_len, seq_len) mask, expanded on the device of the batch only when it is needed."""
+        return make_blanks_attention_mask_batch(
+            self.input_ids.shape[1], self.blank_insertion_points, self.n_blanks
+        )
+
     def __iter__(self):
         all_attrs = vars(self).items()
         return iter(
@@ -57,10 +71,16 @@ class BlanxBatch:
         )
         return self.input_ids.device
 
-    def to(self, device) -> "BlanxBatch":
-        self.input_ids = self.input_ids.to(device)
-        self.target_ids = self.target_ids.to(device)
-        self.should_calculate_loss = self.should_calculate_loss.to(device)
+    def to(self, device, non_blocking: bool = False) -> "BlanxBatch":
+        self.input_ids = self.input_ids.to(device, non_blocking=non_blocking)
+        self.target_ids = self.target_ids.to(device, non_blocking=non_blocking)
+        self.should_calculate_loss = self.should_calculate_loss.to(
+            device, non_blocking=non_blocking
+        )
+        self.blank_insertion_points = self.blank_insertion_points.to(
+            device, non_blocking=non_blocking
+        )
+        self.n_blanks = self.n_blanks.to(device, non_blocking=non_blocking)
         return self
 
     def _make_tensor(self, list_of_token_lists: List[List[int]]) -> torch.Tensor:
@@ -9,7 +9,6 @@ from research.blanks.utils import (
     get_last_point_to_fit_blanks,
     insert_blanks_input,
     insert_blanks_target,
-    make_blanks_attention_mask,
     make_blanks_loss_mask,
 )
 
@@ -43,8 +42,9 @@ class BlankPacker(GPTPacker):
     def get_sample(self) -> BlanxExample:
         sample = super().get_sample()
 
-        input_tokens = sample.input_ids
-        target_tokens = sample.target_ids
+        input_tokens = sample.input_ids.tolist()
+        target_tokens = sample.target_ids.tolist()
+        should_calculate_loss = sample.should_calculate_loss.astype(int).tolist()
         seq_len = len(input_tokens)
         if self.extend_sequence_by_n_blanks:
             input_tokens.extend(
@@ -52,7 +52,7 @@ class BlankPacker(GPTPacker):
             )  # will be cut off by inserting blanks
             target_tokens.extend([0] * self.n_blanks)
             seq_len += self.n_blanks
-            sample.should_calculate_loss.extend([1] * self.n_blanks)
+            should_calculate_loss.extend([1] * self.n_blanks)
 
         blank_insertion_point = self.py_rng.randint(
             1, get_last_point_to_fit_blanks(seq_len, self.n_blanks)
@@ -69,15 +69,14 @@ class BlankPacker(GPTPacker):
             )
             assert len(should_calculate_loss) == seq_len
         else:
-            should_calculate_loss = sample.should_calculate_loss
             assert should_calculate_loss == [1] * seq_len
 
-        att_mask = make_blanks_attention_mask(
-            seq_len, blank_insertion_point, self.n_blanks
-        )
-
         return BlanxExample(
-            input_tokens, target_tokens, should_calculate_loss, att_mask
+            input_tokens,
+            target_tokens,
+            should_calculate_loss,
+            blank_insertion_point,
+            self.n_blanks,
         )
 
 
@@ -108,8 +107,8 @@ class BlankEvalPacker(GPTPacker):
     def get_sample(self) -> BlanxExample:
         sample = super().get_sample()
 
-        input_tokens = sample.input_ids
-        target_tokens = sample.target_ids
+        input_tokens = sample.input_ids.tolist()
+        target_tokens = sample.target_ids.tolist()
         seq_len = len(input_tokens)
 
         # this will not see extended input, so it will generate valid position for blanks if we extend the input
@@ -130,14 +129,16 @@ class BlankEvalPacker(GPTPacker):
             )
             should_calculate_loss = [0] * seq_len
             should_calculate_loss[blank_insertion_point + self.n_blanks - 1] = 1
-            att_mask = make_blanks_attention_mask(
-                seq_len, blank_insertion_point, self.n_blanks
-            )
+            n_inserted_blanks = self.n_blanks
         else:
             should_calculate_loss = [0] * seq_len
             should_calculate_loss[blank_insertion_point - 1] = 1
-            att_mask = make_blanks_attention_mask(seq_len, blank_insertion_point, 0)
+            n_inserted_blanks = 0
 
         return BlanxExample(
-            input_tokens, target_tokens, should_calculate_loss, att_mask
+            input_tokens,
+            target_tokens,
+            should_calculate_loss,
+            blank_insertion_point,
+            n_inserted_blanks,
         )
@@ -13,6 +13,7 @@ from research.blanks.utils import (
     get_preblanks,
     get_last_blanks_in_series,
     make_blanks_attention_mask,
+    make_blanks_attention_mask_batch,
     make_blanks_fixed_positions,
     make_blanks_loss_mask,
 )
@@ -82,6 +83,15 @@ class TestUtils(GeneralTestCase):
         result = make_blanks_attention_mask(4, 1, 2)
         self.assertTrue(np.all(np.equal(result, expected)))
 
+    def test_make_blanks_attention_mask_batch(self):
+        seq_len = 8
+        insertion_points = torch.tensor([1, 3, 5, 2])
+        n_blanks = torch.tensor([2, 1, 3, 0])
+        result = make_blanks_attention_mask_batch(seq_len, insertion_points, n_blanks)
+        for mask, insertion_point, n in zip(result, insertion_points, n_blanks):
+            expected = make_blanks_attention_mask(seq_len, int(insertion_point), int(n))
+            self.assertTrue(np.array_equal(mask.numpy(), expected))
+
     def test_insert_blanks_input(self):
         input_sequence = [1, 2, 3, 4, 5]
         blank_ids = [101, 102]
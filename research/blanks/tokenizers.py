@@ -48,3 +48,6 @@ class BlankTokenizer(AbstractTokenizer):
     def text_to_ids(self, text: str) -> List[int]:
         # TODO: encode or tokenize + convert_tokens_to_ids?
         return self.tokenizer.encode(text)
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts)["input_ids"]
@@ -424,7 +424,7 @@ class BlankTrainer:
         self.model.train()
         processed_batch = self.train_dataloader.get_batch()
         for name, tensor in processed_batch:
-            tensor.data = tensor[:1].repeat(step + 1, 1).data
+            tensor.data = tensor[:1].repeat(step + 1, *[1] * (tensor.dim() - 1)).data
         loss, _aux_info = self._calculate_loss(
             batch=processed_batch,
             model=self.model,
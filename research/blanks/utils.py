@@ -155,6 +155,30 @@ def make_blanks_attention_mask(seq_len, blanks_insertion_point, n_blanks) -> np.
     return mask
 
 
+def make_blanks_attention_mask_batch(
+    seq_len: int, blanks_insertion_points: torch.Tensor, n_blanks: torch.Tensor
+) -> torch.Tensor:
+    """Batched make_blanks_attention_mask, built on the device of the inputs.
+
+    Args:
+        seq_len (int): length of the sequences
+        blanks_insertion_points (torch.Tensor): where the blanks are inserted in each sequence, shape (batch_size,)
+        n_blanks (torch.Tensor): number of blanks in each sequence, shape (batch_size,)
+
+    Returns:
+        torch.Tensor: which pairs take part in attention, shape (batch_size, seq_len, seq_len)
+    """
+    positions = torch.arange(seq_len, device=blanks_insertion_points.device)
+    query_positions = positions.reshape(1, -1, 1)
+    key_positions = positions.reshape(1, 1, -1)
+    blanks_start = blanks_insertion_points.reshape(-1, 1, 1)
+    blanks_end = blanks_start + n_blanks.reshape(-1, 1, 1)
+    is_blank_key = (key_positions >= blanks_start) & (key_positions < blanks_end)
+    return (key_positions <= query_positions) & ~(
+        is_blank_key & (query_positions >= blanks_end)
+    )
+
+
 def make_blanks_fixed_positions(
     x: torch.Tensor, blank_tokens_ids: torch.Tensor, n_blanks_block: int
 ) -> torch.Tensor:
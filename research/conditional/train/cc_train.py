@@ -1,5 +1,6 @@
 import argparse
 from collections import defaultdict
+from functools import partial
 import os
 import random
 from typing import Callable, Optional
@@ -11,6 +12,7 @@ from torch.distributed import init_process_group, destroy_process_group
 
 from lizrd.core import misc
 from lizrd.core.llm import EmbeddingLayer, Parallel
+from lizrd.support.cpu_threads import make_thread_plan
 from lizrd.support.logging import get_current_logger, get_logger
 from lizrd.support.misc import (
     get_argument_attributes,
@@ -22,8 +24,17 @@ from lizrd.train.train_utils import (
 )
 from lizrd.text import tokenizers
 from research.conditional.utils.check_args import check_args
-from research.datasets import DataloaderWrapper, get_processed_dataset
-from lizrd.train.scheduler import get_scheduler
+from research.datasets import (
+    DataloaderWrapper,
+    get_frozen_batches,
+    get_processed_dataset,
+)
+from lizrd.train.scheduler import (
+    BatchSizeCoupledLRScheduler,
+    get_batch_size_scheduler,
+    get_scheduler,
+    get_sequence_length_scheduler,
+)
 from research.conditional.utils.conditional_trainer import ConditionalTrainer
 from research.conditional.utils.argparse import introduce_parser_arguments
 from research.conditional.utils.model_utils import (
@@ -31,6 +42,7 @@ from research.conditional.utils.model_utils import (
     get_classes_from_module_names,
     get_ff_layer,
     get_attention_layer,
+    get_head_fn,
     get_mamba_layer,
     get_mixed_precision_ignored_classes,
     get_residual_layer,
@@ -126,6 +138,18 @@ def main(
     if args.deterministic_experiment:
         set_seed(args.torch_seed)
 
+    thread_plan = None
+    if args.thread_budget:
+        thread_plan = make_thread_plan(
+            num_workers=args.num_workers,
+            affinity=args.cpu_affinity,
+            main_process_cores=args.main_process_cores,
+            local_rank=rank or 0,
+            local_world_size=args.n_gpus if rank is not None else 1,
+        )
+        thread_plan.main.apply()
+        print(f"CPU thread plan of rank {rank or 0}:\n{thread_plan.report()}")
+
     VOCAB_SIZE = (
         tokenizers.BertTokenizer.VOCAB_SIZE
         if args.model_type == "bert"
@@ -222,6 +246,7 @@ def main(
         include_positional_embedding=(not args.no_positional_embedding)
         and (args.attention_mode != "rope"),
         checkpoint=checkpoint,
+        head_fn=get_head_fn(args, VOCAB_SIZE),
     )
 
     n_learnable_parameters = get_n_learnable_parameters(model)
@@ -262,6 +287,11 @@ def main(
 
     scheduler = get_scheduler(args, ratios_in_group_order)
     print(f"Scheduler_ratios: {scheduler.ratios}")
+    batch_size_scheduler = get_batch_size_scheduler(args)
+    if batch_size_scheduler is not None and args.batch_size_ramp_lr_coupling != "none":
+        scheduler = BatchSizeCoupledLRScheduler(
+            scheduler, batch_size_scheduler, args.batch_size_ramp_lr_coupling
+        )
 
     data_distributed = args.ddp_enabled or args.fsdp_enabled
     batch_size = args.batch_size // args.n_gpus if data_distributed else args.batch_size
@@ -275,12 +305,40 @@ def main(
         "model_type": args.model_type,
         "dataset_type": args.dataset_type,
         "use_dummy_dataset": args.use_dummy_dataset,
+        "document_buffer_size": args.document_buffer_size,
+        "streaming_packer": args.streaming_packer,
+        "prefetch_batches": args.prefetch_batches,
+        "token_weighted_sampling": args.token_weighted_sampling,
+        "mask_on_device": args.mask_on_device,
+        "tokenization_cache_dir": args.tokenization_cache_dir,
+        "tokenization_cache_size_gb": args.tokenization_cache_size_gb,
+        "sharded_sampling": args.sharded_sampling,
+        "local_shuffle_buffer_size": args.local_shuffle_buffer_size,
+        "local_shard_by": args.local_shard_by,
+        "local_text_field": args.local_text_field,
+        "shared_memory_batches": args.shared_memory_batches,
+        "rank": rank or 0,
+        "world_size": args.n_gpus if data_distributed else 1,
+        "thread_plan": thread_plan,
     }
 
+    train_data_state = None
+    if checkpoint is not None and checkpoint.get("data_state") is not None:
+        train_data_state = checkpoint["data_state"][rank or 0]
+
+    train_dataloader_kwargs = dict(common_dataloaders_kwargs)
+    if batch_size_scheduler is not None:
+        # the trainer fetches as many micro-batches per step as the ramp allows
+        train_dataloader_kwargs["batch_size"] = (
+            batch_size // args.gradient_accumulation_steps
+        )
     train_dataloader = get_processed_dataset(
-        **common_dataloaders_kwargs,
+        **train_dataloader_kwargs,
         dataset_split="train",
         dataset_path=args.train_dataset_path,
+        data_state=train_data_state,
+        echo_factor=args.data_echo_factor,
+        adaptive_echo=args.adaptive_data_echo,
     )
 
     eval_split = (
@@ -288,11 +346,34 @@ def main(
         if args.dataset_type == "wikibook"
         else ("train" if args.use_dummy_dataset else "validation")
     )
-    eval_dataloader = get_processed_dataset(
+    make_eval_dataloader = partial(
+        get_processed_dataset,
         **common_dataloaders_kwargs,
         dataset_split=eval_split,
         dataset_path=args.validation_dataset_path,
     )
+    if args.frozen_eval_set:
+        eval_cache_path = args.eval_cache_path
+        if eval_cache_path is not None and rank is not None:
+            eval_cache_path = f"{eval_cache_path}.rank{rank}"
+        eval_dataloader = get_frozen_batches(
+            make_eval_dataloader,
+            n_batches=args.n_eval_batches,
+            device=DEVICE,
+            cache_path=eval_cache_path,
+            settings={
+                "batch_size": batch_size,
+                "sequence_length": args.cutoff,
+                "model_type": args.model_type,
+                "dataset_type": args.dataset_type,
+                "use_dummy_dataset": args.use_dummy_dataset,
+                "dataset_path": args.validation_dataset_path,
+                "dataset_split": eval_split,
+                "seed": common_dataloaders_kwargs["seed"],
+            },
+        )
+    else:
+        eval_dataloader = make_eval_dataloader()
 
     if is_logging_process:
         logger = get_logger(args, model, VOCAB_SIZE)
@@ -334,6 +415,8 @@ def main(
         dataset_type=args.dataset_type,
         batch_size=args.batch_size,
         lr_scheduler=scheduler,
+        sequence_length_scheduler=get_sequence_length_scheduler(args),
+        batch_size_scheduler=batch_size_scheduler,
         model_type=args.model_type,
         logging_interval_loss=args.logging_interval_loss,
         logging_interval_light=args.logging_interval_light,
@@ -345,6 +428,7 @@ def main(
         save_weights_interval=args.save_weights_interval,
         gradient_clipping=args.grad_clip,
         loss_checkpoint_chungs=args.loss_checkpoint_chungs,
+        masked_head_loss=args.fused_loss or args.prediction_head != "linear",
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         log_gradients_and_weights=args.log_gradients_and_weights,
         max_sequence_length=args.cutoff,
@@ -37,6 +37,37 @@ def introduce_parser_arguments(
     parser.add_argument("--scheduler", type=str, required=True)
     parser.add_argument("--final_lr_step", type=int, required=False)
     parser.add_argument("--final_lr_fraction", type=float, required=False)
+    parser.add_argument(
+        "--batch_size_ramp_steps",
+        type=int,
+        default=0,
+        help="Batch size ramp: grow the batch from --initial_batch_size to --batch_size over this many steps, by accumulating more micro-batches of --batch_size / --gradient_accumulation_steps",
+    )
+    parser.add_argument(
+        "--initial_batch_size",
+        type=int,
+        default=None,
+        help="Batch size at the start of the batch size ramp, rounded to a multiple of the micro-batch size",
+    )
+    parser.add_argument(
+        "--batch_size_ramp_lr_coupling",
+        type=str,
+        choices=["none", "linear", "sqrt"],
+        default="none",
+        help="Scale the learning rate with the batch size during the batch size ramp",
+    )
+    parser.add_argument(
+        "--sequence_length_warmup_steps",
+        type=int,
+        default=0,
+        help="Sequence length warmup: train on sequences growing from --initial_sequence_length to --cutoff over this many steps, with the same number of tokens per batch",
+    )
+    parser.add_argument(
+        "--initial_sequence_length",
+        type=int,
+        default=64,
+        help="Sequence length at the start of the sequence length warmup, rounded to a divisor of --cutoff",
+    )
     parser.add_argument(
         "--init_type",
         type=str,
@@ -59,16 +90,116 @@ def introduce_parser_arguments(
     # CORE data hyperparameters, almost always specified in baseline configs
 
     parser.add_argument(
-        "--dataset_type", type=str, choices=["wikibook", "c4"], required=True
+        "--dataset_type", type=str, choices=["wikibook", "c4", "local"], required=True
     )
     parser.add_argument("--batch_size", type=int, required=True)
     parser.add_argument("--cutoff", type=int, required=True)
 
     # other data hyperparameters
     parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument(
+        "--thread_budget",
+        action="store_true",
+        help="Split the CPU cores between the training process and its dataloader workers and set torch/tokenizer thread counts accordingly, see lizrd/support/cpu_threads.py",
+    )
+    parser.add_argument(
+        "--cpu_affinity",
+        type=str,
+        choices=["none", "cores", "numa"],
+        default="cores",
+        help="With --thread_budget: pin every process to its own cores, pin workers to NUMA nodes, or only set thread counts",
+    )
+    parser.add_argument(
+        "--main_process_cores",
+        type=int,
+        default=None,
+        help="With --thread_budget: cores kept by the training process, by default an equal share with every worker",
+    )
+    parser.add_argument(
+        "--document_buffer_size",
+        type=int,
+        default=32,
+        help="How many documents each packer fetches and tokenizes in a single batched call",
+    )
+    parser.add_argument(
+        "--token_weighted_sampling",
+        action="store_true",
+        help="C4 only: sample documents proportionally to their length in tokens, needs the index from lizrd/scripts/index_token_lengths",
+    )
+    parser.add_argument(
+        "--shared_memory_batches",
+        action="store_true",
+        help="Dataloader workers collate batches into a reused ring of shared, page-locked memory instead of pickling them",
+    )
+    parser.add_argument(
+        "--sharded_sampling",
+        action="store_true",
+        help="Give every dataloader worker of every rank its own disjoint part of the dataset and go through it in epochs, reading blocks of consecutive documents",
+    )
+    parser.add_argument(
+        "--tokenization_cache_dir",
+        type=str,
+        default=None,
+        help="Cache tokenized documents there, shared by all dataloader workers; use a tmpfs dir, e.g. /dev/shm/tokenization_cache",
+    )
+    parser.add_argument(
+        "--tokenization_cache_size_gb",
+        type=float,
+        default=4.0,
+        help="Size bound of the tokenization cache, least recently used documents are evicted",
+    )
+    parser.add_argument(
+        "--mask_on_device",
+        action="store_true",
+        help="BERT only: mask whole batches on the training device instead of in the dataloader workers",
+    )
+    parser.add_argument(
+        "--streaming_packer",
+        action="store_true",
+        help="GPT only: emit consecutive windows from a rolling token buffer instead of one random window per tokenized set of documents",
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=0,
+        help="If positive, fetch batches and copy them to the device on a background thread, keeping this many ready",
+    )
+
+    parser.add_argument(
+        "--data_echo_factor",
+        type=int,
+        default=1,
+        help="Data echoing: train on every fetched batch up to this many times, re-masked (BERT) or with its window rolled (GPT)",
+    )
+    parser.add_argument(
+        "--adaptive_data_echo",
+        action="store_true",
+        help="Echo a batch only when no prefetched batch is ready, needs --prefetch_batches > 0",
+    )
+    parser.add_argument(
+        "--local_shuffle_buffer_size",
+        type=int,
+        default=10_000,
+        help="local dataset only: how many documents are shuffled together while streaming the files",
+    )
+    parser.add_argument(
+        "--local_shard_by",
+        type=str,
+        choices=["auto", "files", "documents"],
+        default="auto",
+        help="local dataset only: give every dataloader worker its own files, or every n-th document of all files",
+    )
+    parser.add_argument(
+        "--local_text_field",
+        type=str,
+        default="text",
+        help="local dataset only: the JSONL key / Parquet column holding the document text",
+    )
 
     # as of 8.02.2024 below only works for C4 dataset, as wikibook is technically two separate datasets, but wikibook is small enough to use hf datasets_cashe
     # as of 8.02.2024 it is set automatically on DGX, on other machines use manually
+    # a directory with pre-tokenized token shards (see lizrd/scripts/pretokenize) works for both dataset types
+    # for the local dataset type these are the .jsonl/.parquet/.txt files (directory or glob), optionally .gz/.zst compressed
     parser.add_argument("--train_dataset_path", type=str, default=None)
     parser.add_argument("--validation_dataset_path", type=str, default=None)
 
@@ -89,6 +220,24 @@ def introduce_parser_arguments(
     )
     parser.add_argument("--torch_compile", action="store_true")
     parser.add_argument("--loss_checkpoint_chungs", type=int, default=0)
+    parser.add_argument(
+        "--fused_loss",
+        action="store_true",
+        help="Compute the prediction head and the cross entropy together, tile by tile, without materializing the logits. "
+        "Works with and without --loss_checkpoint_chungs",
+    )
+    parser.add_argument(
+        "--fused_loss_token_chunk_size",
+        type=int,
+        default=4096,
+        help="Tokens in a tile of the logits with --fused_loss",
+    )
+    parser.add_argument(
+        "--fused_loss_vocab_chunk_size",
+        type=int,
+        default=8192,
+        help="Vocabulary entries in a tile of the logits with --fused_loss",
+    )
     parser.add_argument("--ddp_enabled", action="store_true")
     parser.add_argument("--fsdp_enabled", action="store_true")
     parser.add_argument(
@@ -121,6 +270,21 @@ def introduce_parser_arguments(
     )
     parser.add_argument("--detect_anomaly", action="store_true")
     parser.add_argument("--flash_attention", action="store_true")
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        choices=["flash", "sdpa", "math", "tiled"],
+        default=None,
+        help="flash: SDPA with the flash kernel on CUDA, sdpa: SDPA with the kernel chosen by PyTorch, "
+        "math: materialized scores, tiled: blocks of queries and keys with an online softmax, for long sequences on CPU. "
+        "By default flash with --flash_attention and math otherwise",
+    )
+    parser.add_argument(
+        "--attention_block_size",
+        type=int,
+        default=512,
+        help="Queries and keys in a block of the tiled attention backend",
+    )
 
     # other parameters usually not changed for experiments
 
@@ -146,6 +310,17 @@ def introduce_parser_arguments(
     parser.add_argument("--logging_interval_loss", type=int, default=1000)
     parser.add_argument("--eval_interval", type=int, default=1000)
     parser.add_argument("--n_eval_batches", type=int, default=10)
+    parser.add_argument(
+        "--frozen_eval_set",
+        action="store_true",
+        help="Take n_eval_batches once, keep them on the device and evaluate on the same batches every time; no eval dataloader is kept running",
+    )
+    parser.add_argument(
+        "--eval_cache_path",
+        type=str,
+        default=None,
+        help="With --frozen_eval_set: load the eval batches from this file if it exists, otherwise save them there",
+    )
     parser.add_argument("--log_gradients_and_weights", action="store_true")
     parser.add_argument("--path_to_entry_config", type=str, default=None)
     parser.add_argument("--all_config_paths", type=str, default=None)
@@ -342,6 +517,35 @@ def introduce_parser_arguments(
         default="layer_norm",
         required=False,
     )
+    parser.add_argument(
+        "--prediction_head",
+        type=str,
+        choices=["linear", "adaptive_softmax"],
+        default="linear",
+        help="adaptive_softmax: frequent tokens get a full-size softmax, rarer ones go through smaller clusters, "
+        "see AdaptiveSoftmaxHead in lizrd/core/llm.py",
+    )
+    parser.add_argument(
+        "--adaptive_softmax_cutoffs",
+        type=int,
+        nargs="+",
+        default=[2000, 10000],
+        help="Token ranks at which the clusters of the adaptive softmax start",
+    )
+    parser.add_argument(
+        "--adaptive_softmax_div_value",
+        type=float,
+        default=4.0,
+        help="Every next cluster of the adaptive softmax gets a projection that many times smaller",
+    )
+    parser.add_argument(
+        "--adaptive_softmax_counts_path",
+        type=str,
+        default=None,
+        help="A token shard directory (see lizrd/scripts/pretokenize), e.g. of the validation split, whose token counts "
+        "order the vocabulary for the adaptive softmax clusters. By default tokens are assumed to be ordered by frequency, "
+        "which roughly holds for the merge order of GPT-2 BPE",
+    )
 
     parser.add_argument(
         "--relative_lr",
@@ -1,3 +1,6 @@
+from lizrd.text.token_shards import is_token_shard_dir
+
+
 def check_args(args):
     if args.granularity_expert_config:
         print(
@@ -16,6 +19,14 @@ def check_args(args):
         args.fsdp_enabled and args.mixed_precision_dtype != "float16"
     ), "Our FSDP implementation currently does not support float16 precision (no distributed GradScaler implemented). Please use bfloat16 or disable mixed precision and set its type to None."
 
+    assert not (
+        args.fused_loss and args.fsdp_enabled and args.loss_checkpoint_chungs > 0
+    ), "With loss_checkpoint_chungs the head is called outside of the forward of the model, which FSDP doesn't support"
+
+    assert not (
+        args.fused_loss and args.prediction_head != "linear"
+    ), "The fused loss only works with the linear prediction head, the adaptive softmax head computes its own loss"
+
     assert (not args.profiler_enabled) or (
         args.profiler_enabled
         and args.profiler_schedule_wait is not None
@@ -26,6 +37,42 @@ def check_args(args):
         and args.profiler_trace_path is not None
     ), "To use profiler set all profiler_schedule arguments"
 
+    assert (
+        not args.streaming_packer or args.model_type == "gpt"
+    ), "Streaming packer is only implemented for GPT"
+    assert (
+        args.eval_cache_path is None or args.frozen_eval_set
+    ), "eval_cache_path is only used with --frozen_eval_set"
+    assert (
+        not args.mask_on_device or args.model_type == "bert"
+    ), "Masking on device only applies to BERT"
+    assert (
+        not args.token_weighted_sampling or args.dataset_type == "c4"
+    ), "Token weighted sampling needs the token index, which is only built for C4"
+    assert args.batch_size_ramp_steps == 0 or (
+        args.initial_batch_size is not None
+        and args.initial_batch_size < args.batch_size
+        and args.gradient_accumulation_steps > 1
+    ), "Batch size ramp needs --initial_batch_size below --batch_size and --gradient_accumulation_steps > 1, the ramp goes through micro-batches"
+    assert (
+        args.sequence_length_warmup_steps == 0
+        or args.initial_sequence_length <= args.cutoff
+    ), "Sequence length warmup has to start below --cutoff"
+    assert not args.adaptive_data_echo or (
+        args.prefetch_batches > 0 and args.data_echo_factor > 1
+    ), "Adaptive data echoing needs --prefetch_batches > 0 and --data_echo_factor > 1"
+    assert args.dataset_type != "local" or (
+        args.train_dataset_path is not None and args.validation_dataset_path is not None
+    ), "The local dataset needs --train_dataset_path and --validation_dataset_path"
+    assert args.tokenization_cache_dir is None or (
+        args.dataset_type in ["wikibook", "c4"]
+        and not is_token_shard_dir(args.train_dataset_path)
+        and not is_token_shard_dir(args.validation_dataset_path)
+    ), "The tokenization cache needs document ids, only the wikibook and c4 datasets have them (token shards are already tokenized)"
+    assert not (
+        args.sharded_sampling and args.token_weighted_sampling
+    ), "Sharded sampling goes through every document once per epoch, it can't be token weighted"
+
     if args.save_weights_path is not None:
         filename = args.save_weights_path.split("/")[-1]
         assert (
@@ -1,17 +1,21 @@
 from collections import defaultdict
 import copy
 from types import SimpleNamespace as SN
-from typing import Callable, Iterable, Optional, Literal
+from typing import Callable, Iterable, Optional, Literal, Union
 
 import torch
 from torch.profiler import profile, ProfilerActivity
 from attr import define
 from lizrd.core.misc import propagate_forward_pass_cache
-from lizrd.support.decoding import decode_single_example
+from lizrd.support.decoding import generate
 from lizrd.support.logging import AbstractLogger
 from lizrd.support.misc import get_ith_chunk
 from lizrd.text.data import LLMBatch
-from lizrd.train.scheduler import AbstractLRScheduler
+from lizrd.train.scheduler import (
+    AbstractLRScheduler,
+    BatchSizeScheduler,
+    SequenceLengthScheduler,
+)
 from research.conditional.moe_layers.continuous_moe import ContinuousMoE
 from research.conditional.moe_layers._expert_choice_old import ExpertChoiceFFOld
 from research.conditional.moe_layers.expert_choice import ExpertChoiceFF
@@ -21,7 +25,7 @@ from research.conditional.utils.model_utils import (
     make_loss_and_gradient_function,
     update_model_fit_gpu_info,
 )
-from research.datasets import DataloaderWrapper
+from research.datasets import DataloaderWrapper, FrozenBatches
 from lizrd.text.datasets import C4Dataset
 from transformers import GPT2Tokenizer
 from lizrd.train.load_and_save_model import load_scaler_state, save_checkpoint
@@ -32,13 +36,13 @@ class ConditionalTrainer:
     model: torch.nn.Module
     optimizer: torch.optim.Optimizer
     train_dataloader: DataloaderWrapper
-    eval_dataloader: DataloaderWrapper
+    eval_dataloader: Union[DataloaderWrapper, FrozenBatches]
     vocab_size: int
     mixed_precision: bool
     mixed_precision_dtype: torch.dtype
     logger: Optional[AbstractLogger]
     model_type: Literal["bert", "gpt"]
-    dataset_type: Literal["wikibook", "c4"]
+    dataset_type: Literal["wikibook", "c4", "local"]
     logging_interval_loss: int
     logging_interval_light: int
     logging_interval_heavy: int
@@ -47,6 +51,9 @@ class ConditionalTrainer:
     max_sequence_length: int
     batch_size: int
     lr_scheduler: AbstractLRScheduler
+    sequence_length_scheduler: Optional[SequenceLengthScheduler] = None
+    # with a batch size ramp, train_dataloader gives single micro-batches, see _get_train_batch
+    batch_size_scheduler: Optional[BatchSizeScheduler] = None
     _calculate_loss_and_gradient: Optional[Callable] = None
     mask_percent: Optional[float] = None
     scaler: Optional[torch.cuda.amp.GradScaler] = None
@@ -57,6 +64,8 @@ class ConditionalTrainer:
     save_weights_interval: int = 1000
     gradient_clipping: float = None
     loss_checkpoint_chungs: int = 0
+    # see calculate_masked_head_loss
+    masked_head_loss: bool = False
     gradient_accumulation_steps: int = 1
     log_gradients_and_weights: bool = False
     loss_log_intervals: tuple[int] = (1, 10, 100, 1000)
@@ -82,6 +91,8 @@ class ConditionalTrainer:
     def __attrs_post_init__(self):
         if self.mixed_precision_dtype == torch.float16:
             self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
+        # loaded on the first _decode_samples
+        self.decoding_tokenizer = None
         self.loss_accumulators = {
             f"loss_interval/{i}": SN(acc=0.0, interval=i)
             for i in self.loss_log_intervals
@@ -91,9 +102,13 @@ class ConditionalTrainer:
         )
         self.correct_tokens_accumulator = 0.0
         self.total_tokens_accumulator = 0.0
+        self.last_logged_data_wait_time = 0.0
+        self.last_logged_tokenization_cache_stats = (0, 0)
+        self.last_logged_echo_tokens = (0, 0)
         self.auxiliary_losses_accumulator = dict()
         self._calculate_loss_and_gradient = make_loss_and_gradient_function(
             loss_checkpoint_chungs=self.loss_checkpoint_chungs,
+            masked_head_loss=self.masked_head_loss,
         )
         self.layer_manager = LayerManager(
             self.model,
@@ -174,10 +189,16 @@ class ConditionalTrainer:
         self.model.train()
         if self.is_logging_process:
             self.layer_manager.prepare_for_logging(step)
-        processed_batch = self.train_dataloader.get_batch()
+        processed_batch, n_micro_batches = self._get_train_batch(step)
+        if self.sequence_length_scheduler is not None:
+            processed_batch = processed_batch.split_sequences(
+                self.sequence_length_scheduler.get_length(step)
+            )
 
         self.lr_scheduler.set_lr(step=step, optimizer=self.optimizer)
-        loss, aux_info = self.calculate_loss_and_gradient(processed_batch)
+        loss, aux_info = self.calculate_loss_and_gradient(
+            processed_batch, n_micro_batches
+        )
         self._apply_gradient()
         if self.is_logging_process:
             self._log_train_stats(loss, step)
@@ -185,31 +206,46 @@ class ConditionalTrainer:
             self.layer_manager.log(step)
             self._log_weights_and_gradients(step)
             self._log_auxiliary_losses(aux_info["losses"], step)
+            self._log_data_wait_time(step)
+            self._log_tokenization_cache_stats(step)
+            self._log_data_echoing(step)
         self._save_weights(step)
 
-    def calculate_loss_and_gradient(self, processed_batch: LLMBatch):
+    def _get_train_batch(self, step: int) -> tuple[LLMBatch, int]:
+        """The batch for a training step and the number of micro-batches to split it into."""
+        if self.batch_size_scheduler is None:
+            return self.train_dataloader.get_batch(), self.gradient_accumulation_steps
+        n_micro_batches = self.batch_size_scheduler.get_n_micro_batches(step)
+        micro_batches = [
+            self.train_dataloader.get_batch() for _ in range(n_micro_batches)
+        ]
+        return LLMBatch.concatenate(micro_batches), n_micro_batches
+
+    def calculate_loss_and_gradient(
+        self, processed_batch: LLMBatch, n_micro_batches: Optional[int] = None
+    ):
         """gradient accumulation: slice the batch into minibatches, get gradients from each, then average and apply them
         NOTE: this function will not set the gradients for the model if model is in eval mode
         """
+        if n_micro_batches is None:
+            n_micro_batches = self.gradient_accumulation_steps
         total_cross_entropy_loss = 0.0
         correct_tokens_value = 0
         total_masked_tokens_value = 0
         losses = {}
 
-        for i in range(self.gradient_accumulation_steps):
+        for i in range(n_micro_batches):
             # TODO: make a way to avoid copying the whole batch just to get a slice
             batch_copy = copy.deepcopy(processed_batch)
             for _, tensor in batch_copy:
-                tensor.data = get_ith_chunk(
-                    tensor.data, self.gradient_accumulation_steps, i
-                )
+                tensor.data = get_ith_chunk(tensor.data, n_micro_batches, i)
 
             cross_entropy_loss, aux_info = self._calculate_loss_and_gradient(
                 batch=batch_copy,
                 model=self.model,
                 mixed_precision=self.mixed_precision,
                 mixed_precision_dtype=self.mixed_precision_dtype,
-                num_checkpoint_accumulation_steps=self.gradient_accumulation_steps,
+                num_checkpoint_accumulation_steps=n_micro_batches,
                 scaler=self.scaler,
             )
 
@@ -332,17 +368,20 @@ class ConditionalTrainer:
             "Warsaw -> Poland Paris -> France Berlin ->",
             "Speech at a funeral of a fly: ",
         ]
-        tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-        for example in examples:
-            tokens = torch.tensor(
-                tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example))
-            ).to(self.train_dataloader.device)
-            output_tokens = decode_single_example(
-                self.model,
-                self.max_sequence_length,
-                tokens,
-                tokenizer._convert_token_to_id("<|endoftext|>"),
-            )
+        if self.decoding_tokenizer is None:
+            self.decoding_tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        tokenizer = self.decoding_tokenizer
+        prompts = [
+            torch.tensor(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example)))
+            for example in examples
+        ]
+        outputs = generate(
+            self.model,
+            self.max_sequence_length,
+            prompts,
+            tokenizer._convert_token_to_id("<|endoftext|>"),
+        )
+        for example, output_tokens in zip(examples, outputs):
             decoded_output = tokenizer.decode(output_tokens)
             print(f"{example}: {decoded_output}")
             self.logger.report_text(
@@ -356,7 +395,23 @@ class ConditionalTrainer:
         self.logger.report_scalar(
             title="lr", value=self.lr_scheduler.get_lr(step=step), iteration=step
         )
-        if self.dataset_type == "c4":
+        if self.batch_size_scheduler is not None:
+            self.logger.report_scalar(
+                title="batch_size",
+                value=self.batch_size_scheduler.get_n_micro_batches(step)
+                * (self.batch_size // self.gradient_accumulation_steps),
+                iteration=step,
+            )
+        if self.sequence_length_scheduler is not None:
+            self.logger.report_scalar(
+                title="sequence_length",
+                value=self.sequence_length_scheduler.get_length(step),
+                iteration=step,
+            )
+        if (
+            self.dataset_type == "c4"
+            or self.train_dataloader.dataset_total_tokens is not None
+        ):
             self._log_fraction_dataset_processed(step)
         for name, stats in self.loss_accumulators.items():
             stats.acc += loss_value
@@ -393,11 +448,22 @@ class ConditionalTrainer:
                 self.logger.report_scalar(title=name, value=value, iteration=step)
 
     def _log_fraction_dataset_processed(self, step):
-        processed = step * self.batch_size * self.max_sequence_length
-        total = C4Dataset.total_gpt2_tokens
+        # every data parallel rank consumes batches of the same size from its own stream
+        tokens_consumed = self.train_dataloader.tokens_consumed
+        world_size = (
+            torch.distributed.get_world_size()
+            if torch.distributed.is_initialized()
+            else 1
+        )
+        total = (
+            self.train_dataloader.dataset_total_tokens or C4Dataset.total_gpt2_tokens
+        )
+        self.logger.report_scalar(
+            title="tokens_consumed_per_rank", value=tokens_consumed, iteration=step
+        )
         self.logger.report_scalar(
-            title="Fraction of dataset that is processed (assumuing no DDP)",
-            value=processed / total,
+            title="Fraction of dataset that is processed",
+            value=tokens_consumed * world_size / total,
             iteration=step,
         )
 
@@ -413,6 +479,57 @@ class ConditionalTrainer:
             self.correct_tokens_accumulator = 0.0
             self.total_tokens_accumulator = 0.0
 
+    def _log_data_wait_time(self, step):
+        if step % self.logging_interval_loss == 0 and step > 0:
+            data_wait_time = self.train_dataloader.data_wait_time
+            self.logger.report_scalar(
+                title="time/data_wait_per_step",
+                value=(data_wait_time - self.last_logged_data_wait_time)
+                / self.logging_interval_loss,
+                iteration=step,
+            )
+            self.last_logged_data_wait_time = data_wait_time
+
+    def _log_tokenization_cache_stats(self, step):
+        cache = self.train_dataloader.tokenization_cache
+        if cache is None or step % self.logging_interval_loss != 0 or step == 0:
+            return
+        # the stats are shared by all processes using the cache, train and eval workers alike
+        hits, misses = cache.stats()
+        last_hits, last_misses = self.last_logged_tokenization_cache_stats
+        lookups = (hits - last_hits) + (misses - last_misses)
+        if lookups > 0:
+            self.logger.report_scalar(
+                title="tokenization_cache/hit_rate",
+                value=(hits - last_hits) / lookups,
+                iteration=step,
+            )
+        self.last_logged_tokenization_cache_stats = (hits, misses)
+
+    def _log_data_echoing(self, step):
+        if self.train_dataloader.echo_factor == 1:
+            return
+        if step % self.logging_interval_loss != 0 or step == 0:
+            return
+        unique_tokens = self.train_dataloader.tokens_consumed
+        echoed_tokens = self.train_dataloader.echoed_tokens
+        self.logger.report_scalar(
+            title="data/unique_tokens", value=unique_tokens, iteration=step
+        )
+        self.logger.report_scalar(
+            title="data/echoed_tokens", value=echoed_tokens, iteration=step
+        )
+        last_unique_tokens, last_echoed_tokens = self.last_logged_echo_tokens
+        new_echoed_tokens = echoed_tokens - last_echoed_tokens
+        new_tokens = unique_tokens - last_unique_tokens + new_echoed_tokens
+        if new_tokens > 0:
+            self.logger.report_scalar(
+                title="data/echoed_fraction",
+                value=new_echoed_tokens / new_tokens,
+                iteration=step,
+            )
+        self.last_logged_echo_tokens = (unique_tokens, echoed_tokens)
+
     def _log_auxiliary_losses(self, losses, step):
         for name, loss in losses.items():
             self.auxiliary_losses_accumulator[name] = (
@@ -441,6 +558,7 @@ class ConditionalTrainer:
                 self.save_weights_path,
                 self.rank,
                 step,
+                data_state=self.train_dataloader.state_dict(),
             )
 
     def _check_config(self):
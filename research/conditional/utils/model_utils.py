@@ -3,6 +3,7 @@ from functools import partial
 # import json
 # from diskcache import Cache
 from typing import Optional, Type, Union, Callable
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import LayerNorm
@@ -12,6 +13,7 @@ from torch.profiler import ProfilerAction
 
 from lizrd.core import llm
 from lizrd.text.data import LLMBatch
+from lizrd.text.token_shards import TokenShards
 from lizrd.core.llm import Parallel
 from research.conditional.moe_layers.cont_moe_designs.common_weighted_parameter_matrices import (
     ContinuousMoECommonWeightedParameters,
@@ -84,11 +86,19 @@ from research.conditional.moe_layers.expert_double_choice import DoubleChoiceFF
 
 def make_loss_and_gradient_function(
     loss_checkpoint_chungs: int,
+    masked_head_loss: bool = False,
 ) -> Callable:
+    """masked_head_loss: let the head compute the loss of masked tokens, i.e. the adaptive softmax head or the fused loss"""
     if loss_checkpoint_chungs == 0:
-        return calculate_llm_loss_and_gradient
+        return partial(
+            calculate_llm_loss_and_gradient, masked_head_loss=masked_head_loss
+        )
     else:
-        return partial(chungized_llm_loss_and_gradient, n_chungs=loss_checkpoint_chungs)
+        return partial(
+            chungized_llm_loss_and_gradient,
+            n_chungs=loss_checkpoint_chungs,
+            masked_head_loss=masked_head_loss,
+        )
 
 
 def calculate_single_chung_loss(
@@ -116,6 +126,24 @@ def calculate_single_chung_loss(
     return loss[mask.reshape(-1) == 1], correct_tokens, total_tokens
 
 
+def calculate_masked_head_loss(
+    head: torch.nn.Module,
+    encoder_output: torch.Tensor,
+    gt: torch.Tensor,
+    mask: torch.Tensor,
+):
+    """
+    Same as calculate_single_chung_loss, but only tokens in the mask go through the head, which computes their loss
+    itself: either the adaptive softmax head, or the linear head with fused_loss_chunk_sizes, see llm.LLM.forward
+    """
+    device = next(head.parameters()).device
+    mask = mask.to(device).reshape(-1) == 1
+    hidden = encoder_output.to(device).flatten(0, -2)[mask]
+    gt = gt.to(device).reshape(-1)[mask].long()
+    loss, correct_tokens = head(hidden, gt)
+    return loss, correct_tokens.sum(), mask.sum()
+
+
 def run_backward(
     loss: torch.Tensor,
     mixed_precision_dtype: torch.dtype,
@@ -136,6 +164,7 @@ def chungized_llm_loss_and_gradient(
     mixed_precision_dtype: torch.dtype,
     num_checkpoint_accumulation_steps: int,
     scaler: Optional[torch.cuda.amp.GradScaler] = None,
+    masked_head_loss: bool = False,
 ) -> tuple[float, dict]:
     input_tokens = batch.input_ids
     gt_tokens = batch.target_ids
@@ -158,17 +187,29 @@ def chungized_llm_loss_and_gradient(
         for chunged_encoder_output, chunged_gt, chunged_mask in zip(
             chunged_encoder_outputs, chunged_non_masked_inputs, chunged_non_masked_masks
         ):
-            (
-                single_chung_loss,
-                single_chung_correct_tokens,
-                single_chung_masked_tokens,
-            ) = calculate_single_chung_loss(
-                model.head,
-                mixed_precision_dtype,
-                chunged_encoder_output,
-                chunged_gt,
-                chunged_mask,
-            )
+            if masked_head_loss:
+                (
+                    single_chung_loss,
+                    single_chung_correct_tokens,
+                    single_chung_masked_tokens,
+                ) = calculate_masked_head_loss(
+                    model.head,
+                    chunged_encoder_output,
+                    chunged_gt,
+                    chunged_mask,
+                )
+            else:
+                (
+                    single_chung_loss,
+                    single_chung_correct_tokens,
+                    single_chung_masked_tokens,
+                ) = calculate_single_chung_loss(
+                    model.head,
+                    mixed_precision_dtype,
+                    chunged_encoder_output,
+                    chunged_gt,
+                    chunged_mask,
+                )
             partial_loss = (
                 single_chung_loss.mean() / n_chungs / num_checkpoint_accumulation_steps
             )
@@ -205,6 +246,7 @@ def calculate_llm_loss_and_gradient(
     mixed_precision_dtype: torch.dtype,
     num_checkpoint_accumulation_steps: int,
     scaler: Optional[torch.cuda.amp.GradScaler] = None,
+    masked_head_loss: bool = False,
 ) -> tuple[float, dict]:
     def hack_for_python_garbage_collection():
         """we want to have no reference to model output while backpropagating to allow torch to free memory,
@@ -213,6 +255,21 @@ def calculate_llm_loss_and_gradient(
         gt_tokens = batch.target_ids
         mask = batch.should_calculate_loss
 
+        if masked_head_loss:
+            with torch.autocast(
+                device_type="cuda", enabled=mixed_precision, dtype=mixed_precision_dtype
+            ):
+                mask_loss, correct_tokens = model(
+                    input_tokens, targets=gt_tokens, mask=mask
+                )
+            loss = mask_loss.mean() / num_checkpoint_accumulation_steps
+            aux_info = {
+                "correct_tokens": correct_tokens.sum(),
+                "total_masked_tokens": mask.sum(),
+                "losses": retrieve_additional_losses(model),
+            }
+            return loss, aux_info
+
         with torch.autocast(
             device_type="cuda", enabled=mixed_precision, dtype=mixed_precision_dtype
         ):
@@ -264,6 +321,8 @@ def get_attention_layer(args):
             causal=causal,
             dhead=args.dhead,
             flash=args.flash_attention,
+            attention_backend=args.attention_backend,
+            attention_block_size=args.attention_block_size,
             init_type=args.init_type,
             init_scale=args.init_scale,
         )
@@ -275,6 +334,8 @@ def get_attention_layer(args):
             causal=causal,
             dhead=args.dhead,
             flash=args.flash_attention,
+            attention_backend=args.attention_backend,
+            attention_block_size=args.attention_block_size,
             init_type=args.init_type,
             init_scale=args.init_scale,
         )
@@ -295,6 +356,43 @@ def get_norm_class(norm_class):
         raise NotImplementedError(f"Norm type {norm_class} not implemented")
 
 
+def get_head_fn(args, vocab_size: int) -> Optional[Callable[[], nn.Module]]:
+    """None for the default linear PredictionHead of get_model"""
+    if args.prediction_head == "linear":
+        if not args.fused_loss:
+            return None
+        return lambda: llm.PredictionHead(
+            args.dmodel,
+            vocab_size,
+            init_type=args.init_type,
+            init_scale=args.init_scale,
+            fused_loss_chunk_sizes=(
+                args.fused_loss_token_chunk_size,
+                args.fused_loss_vocab_chunk_size,
+            ),
+        )
+    elif args.prediction_head == "adaptive_softmax":
+        token_order = None
+        if args.adaptive_softmax_counts_path is not None:
+            token_counts = TokenShards(args.adaptive_softmax_counts_path).count_tokens(
+                vocab_size
+            )
+            token_order = torch.from_numpy(np.argsort(-token_counts, kind="stable"))
+        return lambda: llm.AdaptiveSoftmaxHead(
+            args.dmodel,
+            vocab_size,
+            cutoffs=args.adaptive_softmax_cutoffs,
+            init_type=args.init_type,
+            init_scale=args.init_scale,
+            div_value=args.adaptive_softmax_div_value,
+            token_order=token_order,
+        )
+    else:
+        raise NotImplementedError(
+            f"Prediction head {args.prediction_head} not implemented"
+        )
+
+
 def get_residual_layer(args):
     norm_class = get_norm_class(args.norm_class)
     if args.residual_mode == "pre_norm":
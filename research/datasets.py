@@ -1,27 +1,494 @@
+import copy
 from functools import partial
-from typing import Literal, Optional
+import os
+import queue
+import threading
+import time
+from typing import Callable, List, Literal, Optional, Union
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 
-from lizrd.text import datasets, packers, data, tokenizers
+from lizrd.text import datasets, packers, data, tokenizers, token_shards
+from lizrd.support.cpu_threads import ThreadPlan
+from lizrd.text.tokenization_cache import TokenizationCache
 
 
 class DataloaderWrapper:
-    def __init__(self, dataloader: DataLoader, device: torch.device):
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device: torch.device,
+        prefetch_batches: int = 0,
+        data_state: Optional[dict] = None,
+        device_masker: Optional[packers.BatchMasker] = None,
+        seed: int = 0,
+        batch_ring: Optional["SharedBatchRing"] = None,
+        echo_factor: int = 1,
+        adaptive_echo: bool = False,
+        echo_masker: Optional[packers.BatchMasker] = None,
+        echo_eot_id: Optional[int] = None,
+    ):
+        """
+        prefetch_batches: if positive, batches are fetched and transferred to the device
+            on a background thread, keeping up to this many ready batches in a queue.
+        data_state: output of state_dict from a previous run, the worker states in it
+            are loaded by make_dataloader_wrapper, here only the counters are restored.
+        device_masker: if given, MLM masking is done here, on the device, after the transfer.
+        batch_ring: the shared memory the dataloader collates batches into, if it does
+        echo_factor: data echoing, every fetched batch is handed out up to this many times,
+            for when the input pipeline can't keep up. Repeats are masked anew with echo_masker
+            if it is given (BERT), otherwise their windows are rolled by a random offset (GPT).
+        echo_eot_id: GPT echoing marks the wrap-around point of a rolled window with this token, see _echo
+        adaptive_echo: repeat a batch only when no prefetched batch is ready, needs prefetch_batches > 0
+        """
+        if adaptive_echo and prefetch_batches == 0:
+            raise ValueError("Adaptive echoing needs prefetch_batches > 0")
+        self.dataloader = dataloader
         self.generator = iter(dataloader)
-        self.device = device
+        self.device = torch.device(device)
+        self.prefetch_batches = prefetch_batches
+        self.device_masker = device_masker
+        self.batch_ring = batch_ring
+        if device_masker is not None:
+            self._mask_generator = torch.Generator(self.device).manual_seed(seed)
+        # total time the training loop spent blocked in get_batch, in seconds
+        self.data_wait_time = 0.0
+        # packer state of each worker as of the last batch from it that was handed out, see state_dict
+        self.n_workers = max(dataloader.num_workers, 1)
+        self._worker_states = [None] * self.n_workers
+        # batches handed out from each worker since its last state, workers only send it every few batches
+        self._batches_since_state = [0] * self.n_workers
+        # the worker the next batch comes from, a resumed DataLoader starts from it, see worker_init_fn
+        self._next_worker = 0
+        # exact number of tokens handed out to the training loop by this rank, not counting echoed batches
+        self.tokens_consumed = 0
+        self.echoed_tokens = 0
+        # exact size of the dataset in tokens, if it is known (token index or token shards),
+        # reported by the workers along with their batches, so that the dataset is never built here
+        self.dataset_total_tokens: Optional[int] = None
+        if data_state is not None:
+            self.tokens_consumed = data_state["tokens_consumed"]
+            self.echoed_tokens = data_state.get("echoed_tokens", 0)
+            self._worker_states = list(data_state["worker_states"])
+            self._batches_since_state = list(
+                data_state.get("batches_since_state", self._batches_since_state)
+            )
+            self._next_worker = data_state.get("next_worker", 0)
+
+        self.echo_factor = echo_factor
+        self.adaptive_echo = adaptive_echo
+        self.echo_masker = echo_masker
+        self.echo_eot_id = echo_eot_id
+        self._echo_rng = np.random.default_rng(seed)
+        if echo_masker is not None:
+            self._echo_generator = torch.Generator(self.device).manual_seed(seed)
+        self._last_batch = None
+        self._last_batch_uses = 0
+
+        self._closed = False
+        self._queue = None
+        if prefetch_batches > 0:
+            self._queue = queue.Queue(maxsize=prefetch_batches)
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_loop, daemon=True
+            )
+            self._prefetch_thread.start()
+
+    def get_batch(self) -> data.LLMBatch:
+        start = time.perf_counter()
+        if self._should_echo():
+            batch = self._echo(self._last_batch)
+            self._last_batch_uses += 1
+            self.echoed_tokens += batch.input_ids.numel()
+            self.data_wait_time += time.perf_counter() - start
+            return batch
+
+        if self._queue is None:
+            batch = self._to_device(next(self.generator))
+        else:
+            batch = self._queue.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            if self.device.type == "cuda":
+                # the batch was allocated on the prefetch stream, but will be used on the current one
+                for _, tensor in batch:
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+        self.data_wait_time += time.perf_counter() - start
+        self.tokens_consumed += batch.input_ids.numel()
+        if hasattr(batch, "data_state"):
+            worker_id, state, self.dataset_total_tokens = batch.data_state
+            if state is None:
+                self._batches_since_state[worker_id] += 1
+            else:
+                self._worker_states[worker_id] = state
+                self._batches_since_state[worker_id] = 0
+            self._next_worker = (worker_id + 1) % self.n_workers
+            del batch.data_state
+        if self.echo_factor > 1:
+            self._last_batch = batch
+            self._last_batch_uses = 1
+        return batch
+
+    def state_dict(self) -> dict:
+        """
+        Per-worker packer states, taken at consumption time, so batches prefetched by the
+        DataLoader or the prefetch thread but not yet trained on are produced again after resuming.
+        Workers send their state only every data_state_interval batches (see collate_with_state),
+        the batches handed out since then are skipped by the workers after resuming.
+        """
+        return {
+            "worker_states": list(self._worker_states),
+            "batches_since_state": list(self._batches_since_state),
+            "next_worker": self._next_worker,
+            "tokens_consumed": self.tokens_consumed,
+            "echoed_tokens": self.echoed_tokens,
+        }
+
+    @property
+    def tokenization_cache(self) -> Optional[TokenizationCache]:
+        return self.dataloader.dataset.tokenization_cache
+
+    def _should_echo(self) -> bool:
+        if self._last_batch is None or self._last_batch_uses >= self.echo_factor:
+            return False
+        return not self.adaptive_echo or self._queue.empty()
+
+    def _echo(self, batch: data.LLMBatch) -> data.LLMBatch:
+        """A new batch from the same tokens, the original is left untouched."""
+        if self.echo_masker is not None:
+            echoed = data.LLMBatch.from_tensors(
+                batch.target_ids, batch.target_ids, batch.should_calculate_loss
+            )
+            return self.echo_masker(echoed, self._echo_generator)
+        # input and target are rolled together, so every position still predicts its next token,
+        # but the tokens after the wrap-around point attend to the unrelated end of the window.
+        # The first of them is replaced with eot and left out of the loss, so that the wrap-around
+        # looks like a document boundary, as between packed documents
+        shift = int(self._echo_rng.integers(1, batch.input_ids.shape[1]))
+        input_ids, target_ids, should_calculate_loss = (
+            torch.roll(tensor, shift, dims=1)
+            for tensor in (
+                batch.input_ids,
+                batch.target_ids,
+                batch.should_calculate_loss,
+            )
+        )
+        if self.echo_eot_id is not None:
+            input_ids[:, shift] = self.echo_eot_id
+            should_calculate_loss[:, shift] = 0
+        return data.LLMBatch.from_tensors(input_ids, target_ids, should_calculate_loss)
+
+    def _to_device(self, batch: data.LLMBatch, non_blocking: bool = False):
+        if self.batch_ring is not None:
+            batch = self.batch_ring.read(batch)
+            if self.device.type == "cpu":
+                # no transfer would copy the batch out of its slot, which is soon reused
+                for name, tensor in batch:
+                    setattr(batch, name, tensor.clone())
+        batch = batch.to(self.device, non_blocking=non_blocking)
+        if self.device_masker is not None:
+            batch = self.device_masker(batch, self._mask_generator)
+        return batch
+
+    def _prefetch_loop(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            while not self._closed:
+                batch = next(self.generator)
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self._to_device(batch, non_blocking=True)
+                    stream.synchronize()
+                else:
+                    batch = self._to_device(batch)
+                self._queue.put(batch)
+        except BaseException as e:
+            self._queue.put(e)
+
+    def close(self):
+        """Stops the prefetch thread and shuts down the dataloader workers, get_batch can't be used afterwards."""
+        self._closed = True
+        if self._queue is not None:
+            # unblocks the prefetch thread, which then sees _closed and stops
+            while self._prefetch_thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        # the DataLoader iterator shuts its workers down when it is garbage collected
+        self.generator = None
+        if self.batch_ring is not None:
+            # transfers from the ring are synchronous, or synchronized by the prefetch thread
+            self.batch_ring.unpin_memory()
+
+
+class FrozenBatches:
+    """
+    A fixed set of batches with the interface of DataloaderWrapper, get_batch cycles through them.
+    Used for evaluation, so that every eval sees the same batches and no dataloader is kept running.
+    """
+
+    def __init__(self, batches: List[data.LLMBatch], settings: Optional[dict] = None):
+        """settings: what the batches were made with, saved along with them, see get_frozen_batches"""
+        self.batches = batches
+        self.settings = settings
+        self.device = batches[0].device
+        self.data_wait_time = 0.0
+        self.tokens_consumed = 0
+        self.tokenization_cache = None
+        self._next_batch = 0
 
     def get_batch(self) -> data.LLMBatch:
-        return next(self.generator).to(self.device)
+        batch = self.batches[self._next_batch]
+        self._next_batch = (self._next_batch + 1) % len(self.batches)
+        return batch
+
+    @classmethod
+    def from_dataloader(
+        cls,
+        dataloader: DataloaderWrapper,
+        n_batches: int,
+        settings: Optional[dict] = None,
+    ) -> "FrozenBatches":
+        """Takes n_batches from the dataloader, then closes it."""
+        batches = [dataloader.get_batch() for _ in range(n_batches)]
+        dataloader.close()
+        return cls(batches, settings)
+
+    def save(self, path: str):
+        batches = [
+            {name: tensor.cpu() for name, tensor in batch} for batch in self.batches
+        ]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"settings": self.settings, "batches": batches}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, device: torch.device) -> "FrozenBatches":
+        saved = torch.load(path)
+        if not isinstance(saved, dict):
+            raise ValueError(
+                f"{path} was saved without the settings of its batches, delete it to make a new one"
+            )
+        batches = []
+        for tensors in saved["batches"]:
+            batches.append(data.LLMBatch.from_tensors(**tensors).to(device))
+        return cls(batches, saved["settings"])
+
+
+def get_frozen_batches(
+    make_dataloader: Callable[[], DataloaderWrapper],
+    n_batches: int,
+    device: torch.device,
+    cache_path: Optional[str] = None,
+    settings: Optional[dict] = None,
+) -> FrozenBatches:
+    """
+    Batches are loaded from cache_path if it exists, otherwise they are taken from a dataloader
+    made only for that (and closed right after), and saved to cache_path.
+    settings: anything the batches depend on (batch size, sequence length, dataset, ...), stored in the cache,
+        which is only used if they match
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        frozen_batches = FrozenBatches.load(cache_path, device)
+        if len(frozen_batches.batches) != n_batches:
+            raise ValueError(
+                f"{cache_path} has {len(frozen_batches.batches)} batches, expected {n_batches}"
+            )
+        if frozen_batches.settings != settings:
+            raise ValueError(
+                f"{cache_path} was made with {frozen_batches.settings}, expected {settings}"
+            )
+        return frozen_batches
+
+    frozen_batches = FrozenBatches.from_dataloader(
+        make_dataloader(), n_batches, settings
+    )
+    if cache_path is not None:
+        frozen_batches.save(cache_path)
+    return frozen_batches
+
+
+class SharedBatchRing:
+    """
+    Preallocated shared-memory batches that dataloader workers collate into, so that only a small
+    SharedBatchHandle is pickled back to the main process. With CUDA the slots are page-locked once,
+    so transfers to the device need no per-batch pinned allocations.
+
+    The k-th batch of worker w is the (k * n_workers + w)-th batch consumed, and goes to the slot
+    with that index modulo n_slots. The DataLoader hands the next task to a worker only when it returns
+    a batch, so while the i-th batch is being read, workers can be writing batches up to
+    i + n_workers * prefetch_factor. DataloaderWrapper copies every batch out of its slot (to the device,
+    or a clone on CPU) before fetching the next one, so n_workers * prefetch_factor + 1 slots
+    are enough for a slot never to be overwritten before its batch was copied.
+    """
+
+    def __init__(self, n_slots: int, batch_size: int, sequence_length: int):
+        empty_example = data.LLMExample(
+            np.zeros(sequence_length, dtype=data.TOKEN_DTYPE),
+            np.zeros(sequence_length, dtype=data.TOKEN_DTYPE),
+            np.zeros(sequence_length, dtype=data.LOSS_MASK_DTYPE),
+        )
+        self.slots = [
+            data.LLMBatch([empty_example] * batch_size) for _ in range(n_slots)
+        ]
+        for slot in self.slots:
+            for _, tensor in slot:
+                tensor.share_memory_()
+        self.n_batches_written = 0  # separate counter in every worker process
+        self.pinned = False
+
+    def pin_memory(self):
+        """Page-locks the slots in place, must be called in the main process."""
+        for slot in self.slots:
+            for _, tensor in slot:
+                storage = tensor.untyped_storage()
+                result = torch.cuda.cudart().cudaHostRegister(
+                    storage.data_ptr(), storage.nbytes(), 0
+                )
+                assert result.value == 0, f"cudaHostRegister failed with {result}"
+        self.pinned = True
+
+    def unpin_memory(self):
+        """Releases the page-locked slots, no transfer from them may be in flight."""
+        if not self.pinned:
+            return
+        for slot in self.slots:
+            for _, tensor in slot:
+                result = torch.cuda.cudart().cudaHostUnregister(
+                    tensor.untyped_storage().data_ptr()
+                )
+                assert result.value == 0, f"cudaHostUnregister failed with {result}"
+        self.pinned = False
+
+    def write(
+        self, examples, transform: Optional[Callable[[data.LLMBatch], data.LLMBatch]]
+    ) -> "SharedBatchHandle":
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, n_workers = 0, 1
+        if worker_info is not None:
+            worker_id, n_workers = worker_info.id, worker_info.num_workers
+        slot_index = (self.n_batches_written * n_workers + worker_id) % len(self.slots)
+        self.n_batches_written += 1
+
+        slot = self.slots[slot_index]
+        batch = data.LLMBatch(examples, out=slot)
+        if transform is not None:
+            batch = transform(batch)
+            for name, tensor in batch:
+                if tensor is not getattr(slot, name):
+                    getattr(slot, name).copy_(tensor)
+        return SharedBatchHandle(slot_index)
+
+    def read(self, handle: "SharedBatchHandle") -> data.LLMBatch:
+        # a shallow copy, so that moving the batch to a device does not replace the slot's tensors
+        batch = copy.copy(self.slots[handle.slot_index])
+        if hasattr(handle, "data_state"):
+            batch.data_state = handle.data_state
+        return batch
+
+
+class SharedBatchHandle:
+    def __init__(self, slot_index: int):
+        self.slot_index = slot_index
+
+    def pin_memory(self):
+        return self
+
+
+def get_worker_id(first_worker: int = 0) -> int:
+    """
+    Id of the packer in the current DataLoader worker, 0 in the main process.
+    The DataLoader always takes its first batch from worker process 0, so after resuming
+    the packer ids are rotated for that batch to come from the packer whose turn it was.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        return 0
+    return (worker_info.id + first_worker) % worker_info.num_workers
 
 
-def worker_init_fn(seed, worker_id):
+def skip_batches(
+    packer: packers.AbstractPacker, n_batches: int, batch_size: int, masked: bool
+):
+    """Advances the packer and its rng as collate_with_state producing n_batches batches would."""
+    for _ in range(n_batches):
+        for _ in range(batch_size):
+            packer.get_sample()
+        packer.samples_produced += batch_size
+        if masked:
+            packer.np_rng.integers(2**62)
+
+
+def worker_init_fn(
+    seed,
+    process_id,
+    worker_states=None,
+    rank=0,
+    world_size=1,
+    thread_plan=None,
+    first_worker=0,
+    batches_to_skip=None,
+    batch_size=None,
+    masked=False,
+):
+    if thread_plan is not None:
+        thread_plan.worker(process_id).apply()
     worker_info = torch.utils.data.get_worker_info()
+    worker_id = get_worker_id(first_worker)
     packer: packers.AbstractPacker = (
         worker_info.dataset
     )  # the dataset copy in this worker process
     packer.set_rng(seed + worker_id)
+    packer.dataset.set_shard(
+        rank * worker_info.num_workers + worker_id,
+        world_size * worker_info.num_workers,
+    )
+    if worker_states is not None and worker_states[worker_id] is not None:
+        packer.load_state_dict(worker_states[worker_id])
+        # the batches handed out after the saved state were already trained on
+        skip_batches(packer, batches_to_skip[worker_id], batch_size, masked)
+
+
+def collate_with_state(
+    packer: packers.AbstractPacker,
+    examples,
+    masker: Optional[packers.BatchMasker] = None,
+    batch_ring: Optional[SharedBatchRing] = None,
+    state_interval: int = 1,
+    first_worker: int = 0,
+) -> Union[data.LLMBatch, SharedBatchHandle]:
+    """
+    Collates examples and attaches the id of the worker, the size of its dataset and,
+    every state_interval batches, the state of the packer that produced them (None otherwise),
+    as pickling the whole state with every batch can cost more than the batch itself.
+    With a masker, the batch is also masked here, with randomness drawn from the packer,
+    so that masking is reproduced after resuming from the packer state.
+    With a batch_ring, the batch is collated into shared memory and only a handle is returned.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    worker_id = get_worker_id(first_worker)
+    if worker_info is not None:
+        packer = worker_info.dataset
+
+    transform = None
+    if masker is not None:
+        generator = torch.Generator().manual_seed(int(packer.np_rng.integers(2**62)))
+        transform = partial(masker, generator=generator)
+
+    if batch_ring is not None:
+        batch = batch_ring.write(examples, transform)
+    else:
+        batch = data.LLMBatch(examples)
+        if transform is not None:
+            batch = transform(batch)
+    state = None
+    if (packer.samples_produced // len(examples) - 1) % state_interval == 0:
+        state = packer.state_dict()
+    batch.data_state = (worker_id, state, packer.dataset.total_tokens)
+    return batch
 
 
 def get_processed_dataset(
@@ -31,16 +498,72 @@ def get_processed_dataset(
     num_workers: int,
     seed: int,
     model_type: Literal["bert", "gpt"] = "bert",
-    dataset_type: Literal["wikibook", "c4"] = "wikibook",
+    dataset_type: Literal["wikibook", "c4", "local"] = "wikibook",
     use_dummy_dataset: bool = False,
     dataset_split: str = "train",
     dataset_path: Optional[str] = None,
+    document_buffer_size: int = 32,
+    streaming_packer: bool = False,
+    prefetch_batches: int = 0,
+    data_state: Optional[dict] = None,
+    token_weighted_sampling: bool = False,
+    mask_on_device: bool = False,
+    tokenization_cache_dir: Optional[str] = None,
+    tokenization_cache_size_gb: float = 4.0,
+    sharded_sampling: bool = False,
+    rank: int = 0,
+    world_size: int = 1,
+    shared_memory_batches: bool = False,
+    local_shuffle_buffer_size: int = 10_000,
+    local_shard_by: Literal["auto", "files", "documents"] = "auto",
+    local_text_field: str = "text",
+    echo_factor: int = 1,
+    adaptive_echo: bool = False,
+    thread_plan: Optional[ThreadPlan] = None,
 ):
+    """
+    data_state: DataloaderWrapper.state_dict from a checkpoint, to resume the data stream
+        where it was left. Requires the same num_workers as the run that saved it.
+    token_weighted_sampling: see C4Dataset
+    mask_on_device: BERT only, do the MLM masking on the device after the transfer
+        instead of in the dataloader workers
+    tokenization_cache_dir: if given, tokenized documents are cached there and shared by all workers,
+        should be on tmpfs, e.g. /dev/shm/tokenization_cache
+    sharded_sampling: every dataloader worker of every rank (out of world_size) goes through
+        its own disjoint part of the dataset, see ShardedIndexSampler
+    shared_memory_batches: workers collate into a ring of shared memory batches, see SharedBatchRing
+    local_*: see LocalCorpusDataset, used with dataset_type="local", which streams the files at dataset_path
+    echo_factor, adaptive_echo: data echoing, see DataloaderWrapper
+    thread_plan: cores and thread counts of the dataloader workers, see lizrd/support/cpu_threads.py
+    """
+    if token_shards.is_token_shard_dir(dataset_path):
+        packer = get_token_shard_packer(
+            sequence_length=sequence_length,
+            model_type=model_type,
+            dataset_path=dataset_path,
+        )
+        return make_dataloader_wrapper(
+            packer,
+            batch_size,
+            device,
+            num_workers,
+            seed,
+            prefetch_batches=prefetch_batches,
+            data_state=data_state,
+            rank=rank,
+            world_size=world_size,
+            shared_memory_batches=shared_memory_batches,
+            echo_factor=echo_factor,
+            adaptive_echo=adaptive_echo,
+            thread_plan=thread_plan,
+        )
+
     if dataset_type == "wikibook":
         dataset = partial(
             datasets.WikiBookDataset,
             use_dummy_dataset=use_dummy_dataset,
             split=dataset_split,
+            sharded_sampling=sharded_sampling,
         )
     elif dataset_type == "c4":
         dataset = partial(
@@ -48,33 +571,184 @@ def get_processed_dataset(
             use_dummy_dataset=use_dummy_dataset,
             split=dataset_split,
             dataset_path=dataset_path,
+            token_weighted_sampling=token_weighted_sampling,
+            sharded_sampling=sharded_sampling,
+        )
+    elif dataset_type == "local":
+        dataset = partial(
+            datasets.LocalCorpusDataset,
+            dataset_path=dataset_path,
+            text_field=local_text_field,
+            shuffle_buffer_size=local_shuffle_buffer_size,
+            shard_by=local_shard_by,
         )
     else:
         raise ValueError(f"Unknown dataset type: {dataset_type}")
 
+    tokenization_cache = None
+    if tokenization_cache_dir is not None:
+        tokenization_cache = TokenizationCache(
+            tokenization_cache_dir,
+            size_limit_bytes=int(tokenization_cache_size_gb * 2**30),
+        )
+
+    masker = None
     if model_type == "bert":
+        masker = packers.BatchMasker(tokenizer_maker=tokenizers.BertTokenizer)
         packer = packers.BERTPacker(
             sequence_length=sequence_length,
             dataset=dataset,
             tokenizer_maker=tokenizers.BertTokenizer,
+            document_buffer_size=document_buffer_size,
+            tokenization_cache=tokenization_cache,
         )
     elif model_type == "gpt":
         packer = packers.GPTPacker(
             sequence_length=sequence_length,
             dataset_maker=dataset,
             tokenizer_maker=tokenizers.GPTTokenizer,
+            document_buffer_size=document_buffer_size,
+            streaming=streaming_packer,
+            tokenization_cache=tokenization_cache,
         )
     else:
         raise ValueError(f"Unknown model type: {model_type}")
 
+    return make_dataloader_wrapper(
+        packer,
+        batch_size,
+        device,
+        num_workers,
+        seed,
+        prefetch_batches=prefetch_batches,
+        data_state=data_state,
+        masker=masker,
+        mask_on_device=mask_on_device,
+        rank=rank,
+        world_size=world_size,
+        shared_memory_batches=shared_memory_batches,
+        echo_factor=echo_factor,
+        adaptive_echo=adaptive_echo,
+        thread_plan=thread_plan,
+    )
+
+
+def get_token_shard_packer(
+    sequence_length: int,
+    model_type: Literal["bert", "gpt"],
+    dataset_path: str,
+) -> packers.AbstractPacker:
+    manifest = token_shards.read_manifest(dataset_path)
+    if model_type != "gpt" or manifest["tokenizer"] != "gpt":
+        raise ValueError(
+            f"Token shards in {dataset_path} were made with the {manifest['tokenizer']} tokenizer, "
+            f"only gpt token shards are supported (model_type={model_type})"
+        )
+    return packers.TokenShardGPTPacker(
+        sequence_length=sequence_length,
+        dataset_maker=partial(datasets.TokenShardDataset, dataset_path=dataset_path),
+    )
+
+
+def make_dataloader_wrapper(
+    packer: packers.AbstractPacker,
+    batch_size: int,
+    device: torch.device,
+    num_workers: int,
+    seed: int,
+    prefetch_batches: int = 0,
+    data_state: Optional[dict] = None,
+    masker: Optional[packers.BatchMasker] = None,
+    mask_on_device: bool = False,
+    rank: int = 0,
+    world_size: int = 1,
+    shared_memory_batches: bool = False,
+    echo_factor: int = 1,
+    adaptive_echo: bool = False,
+    thread_plan: Optional[ThreadPlan] = None,
+    data_state_interval: int = 16,
+) -> DataloaderWrapper:
+    """
+    data_state_interval: workers send their packer state every this many batches, see collate_with_state.
+        After resuming, each worker produces again, and skips, up to this many batches.
+    """
+    if num_workers == 0:
+        packer.dataset.set_shard(rank, world_size)
+
+    echo_eot_id = None
+    if echo_factor > 1 and masker is None:
+        # token shard packers have no tokenizer, their tokens are always from the gpt one
+        tokenizer_maker = packer.tokenizer_maker or tokenizers.GPTTokenizer
+        echo_eot_id = tokenizer_maker().eot_id
+
+    worker_states = None
+    first_worker = 0
+    batches_to_skip = [0] * max(num_workers, 1)
+    masked = masker is not None and not mask_on_device
+    if data_state is not None:
+        worker_states = data_state["worker_states"]
+        first_worker = data_state.get("next_worker", 0)
+        batches_to_skip = data_state.get("batches_since_state", batches_to_skip)
+        if len(worker_states) != max(num_workers, 1):
+            raise ValueError(
+                f"Data state was saved with {len(worker_states)} workers, "
+                f"cannot restore it with num_workers={num_workers}"
+            )
+        if num_workers == 0 and worker_states[0] is not None:
+            packer.load_state_dict(worker_states[0])
+            skip_batches(packer, batches_to_skip[0], batch_size, masked)
+
+    prefetch_factor = 2 if num_workers > 0 else None  # the DataLoader default
+    batch_ring = None
+    if shared_memory_batches:
+        # batches written by workers, plus the one being read, see SharedBatchRing
+        batch_ring = SharedBatchRing(
+            n_slots=num_workers * (prefetch_factor or 0) + 1,
+            batch_size=batch_size,
+            sequence_length=packer.sequence_length,
+        )
+        if torch.device(device).type == "cuda":
+            batch_ring.pin_memory()
+
     dataloader = DataLoader(
         packer,
         num_workers=num_workers,
         batch_size=batch_size,
-        collate_fn=data.LLMBatch,
-        worker_init_fn=partial(worker_init_fn, seed),
+        collate_fn=partial(
+            collate_with_state,
+            packer,
+            masker=None if mask_on_device else masker,
+            batch_ring=batch_ring,
+            state_interval=data_state_interval,
+            first_worker=first_worker,
+        ),
+        worker_init_fn=partial(
+            worker_init_fn,
+            seed,
+            worker_states=worker_states,
+            rank=rank,
+            world_size=world_size,
+            thread_plan=thread_plan,
+            first_worker=first_worker,
+            batches_to_skip=batches_to_skip,
+            batch_size=batch_size,
+            masked=masked,
+        ),
         shuffle=False,
-        pin_memory=True,
+        prefetch_factor=prefetch_factor,
+        pin_memory=batch_ring is None,  # ring slots are page-locked once, up front
     )
 
-    return DataloaderWrapper(dataloader, device)
+    return DataloaderWrapper(
+        dataloader,
+        device,
+        prefetch_batches=prefetch_batches,
+        data_state=data_state,
+        device_masker=masker if mask_on_device else None,
+        seed=seed,
+        batch_ring=batch_ring,
+        echo_factor=echo_factor,
+        adaptive_echo=adaptive_echo,
+        echo_masker=masker,
+        echo_eot_id=echo_eot_id,
+    )
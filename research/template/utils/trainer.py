@@ -7,7 +7,7 @@ import torch
 from torch.profiler import profile, ProfilerActivity
 from attr import define
 from lizrd.core.misc import propagate_forward_pass_cache
-from lizrd.support.decoding import decode_single_example
+from lizrd.support.decoding import generate
 from lizrd.support.logging import AbstractLogger
 from lizrd.support.misc import get_ith_chunk
 from lizrd.text.data import LLMBatch
@@ -78,6 +78,8 @@ class TemplateTrainer:
     def __attrs_post_init__(self):
         if self.mixed_precision_dtype == torch.float16:
             self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
+        # loaded on the first _decode_samples
+        self.decoding_tokenizer = None
         self.loss_accumulators = {
             f"loss_interval/{i}": SN(acc=0.0, interval=i)
             for i in self.loss_log_intervals
@@ -288,17 +290,20 @@ class TemplateTrainer:
             "Warsaw -> Poland Paris -> France Berlin ->",
             "Speech at a funeral of a fly: ",
         ]
-        tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-        for example in examples:
-            tokens = torch.tensor(
-                tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example))
-            ).to(self.train_dataloader.device)
-            output_tokens = decode_single_example(
-                self.model,
-                self.max_sequence_length,
-                tokens,
-                tokenizer._convert_token_to_id("<|endoftext|>"),
-            )
+        if self.decoding_tokenizer is None:
+            self.decoding_tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        tokenizer = self.decoding_tokenizer
+        prompts = [
+            torch.tensor(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example)))
+            for example in examples
+        ]
+        outputs = generate(
+            self.model,
+            self.max_sequence_length,
+            prompts,
+            tokenizer._convert_token_to_id("<|endoftext|>"),
+        )
+        for example, output_tokens in zip(examples, outputs):
             decoded_output = tokenizer.decode(output_tokens)
             print(f"{example}: {decoded_output}")
             self.logger.report_text(
@@ -0,0 +1,263 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import torch
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.packers import BatchMasker, BERTPacker, GPTPacker
+from lizrd.text.test_packers import (
+    IndexedNumbersDataset,
+    MaskingTokenizer,
+    NumbersDataset,
+    NumbersTokenizer,
+)
+from research.datasets import get_frozen_batches, make_dataloader_wrapper
+
+
+class TestPrefetching(GeneralTestCase):
+    def make_wrapper(self, prefetch_batches):
+        return make_dataloader_wrapper(
+            GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0),
+            batch_size=4,
+            device="cpu",
+            num_workers=0,
+            seed=0,
+            prefetch_batches=prefetch_batches,
+        )
+
+    def test_same_batches_as_without_prefetching(self):
+        wrappers = [self.make_wrapper(0), self.make_wrapper(3)]
+        for _ in range(10):
+            batch, prefetched_batch = [wrapper.get_batch() for wrapper in wrappers]
+            self.assertTensorEqual(batch.input_ids, prefetched_batch.input_ids)
+            self.assertTensorEqual(batch.target_ids, prefetched_batch.target_ids)
+        wrappers[1].close()
+
+    def test_data_wait_time(self):
+        wrapper = self.make_wrapper(2)
+        wait_times = []
+        for _ in range(5):
+            wrapper.get_batch()
+            wait_times.append(wrapper.data_wait_time)
+        self.assertGreater(wait_times[0], 0.0)
+        self.assertEqual(wait_times, sorted(wait_times))
+        wrapper.close()
+
+    def test_close(self):
+        wrapper = self.make_wrapper(2)
+        wrapper.get_batch()
+        # the prefetch thread is blocked on the full queue
+        while not wrapper._queue.full():
+            time.sleep(0.01)
+        closing = threading.Thread(target=wrapper.close)
+        closing.start()
+        closing.join(timeout=10)
+        self.assertFalse(closing.is_alive())
+        self.assertFalse(wrapper._prefetch_thread.is_alive())
+
+
+class TestDatasetTotalTokens(GeneralTestCase):
+    def test_reported_by_workers(self):
+        packer = GPTPacker(8, IndexedNumbersDataset, NumbersTokenizer, seed=0)
+        wrapper = make_dataloader_wrapper(
+            packer, batch_size=4, device="cpu", num_workers=2, seed=0
+        )
+        self.assertIsNone(wrapper.dataset_total_tokens)
+        wrapper.get_batch()
+        self.assertEqual(
+            wrapper.dataset_total_tokens, IndexedNumbersDataset().lengths.sum()
+        )
+        # the dataset was only built in the workers
+        self.assertIsNone(packer._dataset)
+        wrapper.close()
+
+
+class TestResuming(GeneralTestCase):
+    def make_wrapper(self, data_state=None, shared_memory_batches=False, bert=False):
+        packer = GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0)
+        if bert:
+            packer = BERTPacker(8, NumbersDataset, MaskingTokenizer, seed=0)
+        return make_dataloader_wrapper(
+            packer,
+            batch_size=4,
+            device="cpu",
+            num_workers=2,
+            seed=0,
+            data_state=data_state,
+            masker=BatchMasker(MaskingTokenizer) if bert else None,
+            shared_memory_batches=shared_memory_batches,
+            data_state_interval=3,
+        )
+
+    def test_same_batches_as_uninterrupted(self):
+        for shared_memory_batches, bert in [
+            (False, False),
+            (True, False),
+            (False, True),
+        ]:
+            wrapper = self.make_wrapper(None, shared_memory_batches, bert)
+            for _ in range(7):
+                wrapper.get_batch()
+            data_state = wrapper.state_dict()
+            # the workers sent their states with their 1st and 4th batch
+            self.assertEqual(data_state["batches_since_state"], [0, 2])
+            self.assertEqual(data_state["next_worker"], 1)
+            expected = [
+                {name: tensor.clone() for name, tensor in wrapper.get_batch()}
+                for _ in range(5)
+            ]
+            wrapper.close()
+
+            resumed = self.make_wrapper(data_state, shared_memory_batches, bert)
+            for tensors in expected:
+                for name, tensor in resumed.get_batch():
+                    self.assertTensorEqual(tensor, tensors[name])
+            resumed.close()
+
+
+class TestSharedMemoryBatches(GeneralTestCase):
+    def test_same_batches_as_pickled(self):
+        for num_workers in [0, 2]:
+            batches = []
+            for shared_memory_batches in [False, True]:
+                wrapper = make_dataloader_wrapper(
+                    GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0),
+                    batch_size=4,
+                    device="cpu",
+                    num_workers=num_workers,
+                    seed=0,
+                    prefetch_batches=2,
+                    shared_memory_batches=shared_memory_batches,
+                )
+                # more batches than ring slots, each one is kept
+                batches.append([wrapper.get_batch() for _ in range(20)])
+
+            for batch, shared_batch in zip(*batches):
+                self.assertTensorEqual(batch.input_ids, shared_batch.input_ids)
+                self.assertTensorEqual(batch.target_ids, shared_batch.target_ids)
+                self.assertEqual(shared_batch.input_ids.dtype, torch.int32)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs CUDA")
+    def test_pinned_slots(self):
+        batches = []
+        for shared_memory_batches in [False, True]:
+            wrapper = make_dataloader_wrapper(
+                GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0),
+                batch_size=4,
+                device="cuda",
+                num_workers=2,
+                seed=0,
+                prefetch_batches=2,
+                shared_memory_batches=shared_memory_batches,
+            )
+            batches.append([wrapper.get_batch() for _ in range(20)])
+            if shared_memory_batches:
+                ring = wrapper.batch_ring
+                self.assertTrue(ring.pinned)
+                self.assertTrue(all(slot.input_ids.is_pinned() for slot in ring.slots))
+            wrapper.close()
+            if shared_memory_batches:
+                self.assertFalse(ring.pinned)
+                self.assertFalse(any(slot.input_ids.is_pinned() for slot in ring.slots))
+
+        for batch, shared_batch in zip(*batches):
+            self.assertEqual(shared_batch.input_ids.device.type, "cuda")
+            self.assertTensorEqual(batch.input_ids, shared_batch.input_ids)
+            self.assertTensorEqual(batch.target_ids, shared_batch.target_ids)
+
+
+class TestFrozenBatches(GeneralTestCase):
+    def test_cached_eval_set(self):
+        def make_dataloader():
+            return make_dataloader_wrapper(
+                GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0),
+                batch_size=4,
+                device="cpu",
+                num_workers=2,
+                seed=0,
+                prefetch_batches=2,
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "eval_batches.pt")
+            settings = {"batch_size": 4, "sequence_length": 8}
+            frozen = get_frozen_batches(make_dataloader, 3, "cpu", cache_path, settings)
+            first_pass = [frozen.get_batch() for _ in range(3)]
+            for batch in first_pass:
+                self.assertIs(frozen.get_batch(), batch)
+
+            loaded = get_frozen_batches(None, 3, "cpu", cache_path, settings)
+            for batch, loaded_batch in zip(first_pass, loaded.batches):
+                self.assertTensorEqual(batch.input_ids, loaded_batch.input_ids)
+                self.assertTensorEqual(
+                    batch.should_calculate_loss, loaded_batch.should_calculate_loss
+                )
+            with self.assertRaises(ValueError):
+                get_frozen_batches(None, 4, "cpu", cache_path, settings)
+            with self.assertRaises(ValueError):
+                get_frozen_batches(
+                    None, 3, "cpu", cache_path, {**settings, "sequence_length": 16}
+                )
+
+
+class TestDataEchoing(GeneralTestCase):
+    def test_rolled_repeats(self):
+        wrapper = make_dataloader_wrapper(
+            GPTPacker(8, NumbersDataset, NumbersTokenizer, seed=0),
+            batch_size=4,
+            device="cpu",
+            num_workers=0,
+            seed=0,
+            echo_factor=3,
+        )
+        for _ in range(2):
+            batch = wrapper.get_batch()
+            original_input_ids = batch.input_ids.clone()
+            for _ in range(2):
+                echoed = wrapper.get_batch()
+                self.assertTensorEqual(batch.input_ids, original_input_ids)
+                shifts = [
+                    shift
+                    for shift in range(1, 8)
+                    if torch.equal(
+                        torch.roll(batch.target_ids, shift, dims=1), echoed.target_ids
+                    )
+                ]
+                self.assertEqual(len(shifts), 1)
+                shift = shifts[0]
+                # the wrap-around point is marked with eot and left out of the loss
+                expected_input_ids = torch.roll(batch.input_ids, shift, dims=1)
+                expected_input_ids[:, shift] = NumbersTokenizer.eot_id
+                self.assertTensorEqual(echoed.input_ids, expected_input_ids)
+                self.assertFalse(echoed.should_calculate_loss[:, shift].any())
+                self.assertEqual(echoed.should_calculate_loss.sum(), 4 * 7)
+        self.assertEqual(wrapper.tokens_consumed, 2 * 4 * 8)
+        self.assertEqual(wrapper.echoed_tokens, 4 * 4 * 8)
+        self.assertEqual(wrapper.state_dict()["echoed_tokens"], 4 * 4 * 8)
+
+    def test_remasked_repeats(self):
+        wrapper = make_dataloader_wrapper(
+            BERTPacker(16, NumbersDataset, MaskingTokenizer, seed=0),
+            batch_size=8,
+            device="cpu",
+            num_workers=0,
+            seed=0,
+            masker=BatchMasker(MaskingTokenizer),
+            echo_factor=2,
+        )
+        batch = wrapper.get_batch()
+        original = {name: tensor.clone() for name, tensor in batch}
+        echoed = wrapper.get_batch()
+        for name, tensor in batch:
+            self.assertTensorEqual(tensor, original[name])
+
+        self.assertTensorEqual(echoed.target_ids, batch.target_ids)
+        self.assertFalse(
+            torch.equal(echoed.should_calculate_loss, batch.should_calculate_loss)
+        )
+        is_mask = echoed.should_calculate_loss.bool()
+        self.assertTrue(is_mask.any())
+        self.assertTensorEqual(echoed.input_ids[~is_mask], echoed.target_ids[~is_mask])